@@ -0,0 +1,63 @@
+"""
+Measures construction time, traced peak memory and peak RSS of a template
+whose functions hold many identical Refs, using interned Ref objects or the
+previous valley schema based Ref. Each variant runs in its own process.
+
+    python -m benchmarks.intrinsics_memory 10000
+"""
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from valley.properties import CharProperty
+
+import sammy as sm
+
+
+class SchemaRef(sm.SAMSchema):
+    Ref = CharProperty(required=True)
+
+
+def build_template(size, ref_class):
+    sam = sm.SAM()
+    for i in range(size):
+        sam.add_resource(sm.Function(
+            name='Function{}'.format(i),
+            Handler='index.handler',
+            Runtime='python3.6',
+            Role=ref_class(Ref='FunctionRole'),
+            Environment=sm.Environment(Variables={
+                'TABLE_NAME': ref_class(Ref='Table'),
+                'BUCKET_NAME': ref_class(Ref='Bucket'),
+                'TOPIC_ARN': ref_class(Ref='Topic'),
+            })))
+    return sam
+
+
+def run_variant(variant, size):
+    ref_class = sm.Ref if variant == 'interned' else SchemaRef
+    tracemalloc.start()
+    start = time.perf_counter()
+    sam = build_template(size, ref_class)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print('{:>9}  construction {:7.3f}s  traced peak {:7.1f}MB  peak RSS {:7.1f}MB'.format(
+        variant, elapsed, peak / 2 ** 20, rss / 1024.0))
+    return sam
+
+
+def main(size):
+    for variant in ('schema', 'interned'):
+        subprocess.check_call([sys.executable, '-m', 'benchmarks.intrinsics_memory',
+                               '--variant', variant, str(size)])
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--variant']:
+        run_variant(sys.argv[2], int(sys.argv[3]))
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,196 @@
+"""
+Times template construction, validation, rendering and publish orchestration
+on synthetic templates and writes the results as JSON, so runs of different
+versions can be compared.
+
+    python -m benchmarks.suite --functions 100 1000 10000 --output results.json
+
+Every size is measured in its own process so peak memory figures do not
+include earlier runs. Publishing talks to sammy.fake.FakeAWS, which adds
+--latency seconds to every call and finishes the changeset and stack after
+a few polls.
+"""
+import argparse
+import contextlib
+import json
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import sammy as sm
+from sammy.fake import FakeAWS
+from sammy.waiters import Backoff
+
+
+EVENT_BUILDERS = (
+    lambda i, j: sm.APIEvent(name='Api{}'.format(j), Path='/items/{}/{}'.format(i, j),
+                             Method='get'),
+    lambda i, j: sm.SNSEvent(name='Topic{}'.format(j), Topic=sm.Ref(Ref='Topic')),
+    lambda i, j: sm.SQSEvent(name='Queue{}'.format(j), Queue=sm.Ref(Ref='QueueArn'),
+                             BatchSize=10),
+)
+
+
+def build_template(functions, events=1, parameters=None):
+    """
+    Builds a synthetic SAM template
+    :param functions: Number of functions
+    :param events: Number of events per function
+    :param parameters: Number of parameters, one per ten functions by default
+    :return: SAM
+    """
+    if parameters is None:
+        parameters = max(1, functions // 10)
+    sam = sm.SAM(Description='Synthetic benchmark template.')
+    sam.add_parameters([sm.Parameter(name='Bucket', Type='String'),
+                        sm.Parameter(name='QueueArn', Type='String')])
+    sam.add_parameters(sm.Parameter(name='Setting{}'.format(i), Type='String', Default='x')
+                       for i in range(parameters))
+    sam.add_resources([sm.SimpleTable(name='Table'), sm.SNS(name='Topic')])
+    for i in range(functions):
+        sam.add_resource(sm.Function(
+            name='Function{}'.format(i),
+            Handler='index.handler{}'.format(i),
+            Runtime='python3.6',
+            CodeUri=sm.S3URI(Bucket=sm.Ref(Ref='Bucket'), Key='code{}.zip'.format(i)),
+            Environment=sm.Environment(Variables={
+                'TABLE_NAME': sm.Ref(Ref='Table'),
+                'SETTING': sm.Ref(Ref='Setting{}'.format(i % parameters)),
+            }),
+            Events=[EVENT_BUILDERS[j % len(EVENT_BUILDERS)](i, j) for j in range(events)]))
+    return sam
+
+
+def measure(func):
+    """
+    Runs func with tracemalloc enabled
+    :return: Tuple of the return value and a dict with seconds, peak bytes
+        and the bytes still allocated when func returned
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    value = func()
+    elapsed = time.perf_counter() - start
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return value, {'seconds': round(elapsed, 6), 'peak_bytes': peak,
+                   'retained_bytes': retained}
+
+
+def publish(sam, latency, poll_delay):
+    # The changeset finishes after about three polls and the stack after about five
+    aws = FakeAWS(latency=latency, changeset_seconds=poll_delay * 3,
+                  resource_seconds=poll_delay * 5)
+    sam.build_clients_resources(session=aws)
+    sam.template_bucket = 'benchmark-templates'
+    sam.changeset_wait = Backoff(min_delay=poll_delay, max_delay=poll_delay * 4, jitter=False)
+    sam.stack_wait = Backoff(min_delay=poll_delay, max_delay=poll_delay * 4, jitter=False)
+    result = sam.publish_stack('benchmark')
+    return {'calls': sum(aws.calls.values()), 'polls': result.polls,
+            'timings': {k: round(v, 6) for k, v in result.timings.items()}}
+
+
+def run(functions, events, parameters, latency, poll_delay):
+    """
+    Measures every phase for one template size
+    :return: Result dict
+    """
+    def construct():
+        with sm.deferred_validation():
+            return build_template(functions, events, parameters)
+
+    phases = {}
+    sam, phases['construct'] = measure(construct)
+    _, phases['validate'] = measure(sam.validate_tree)
+    _, phases['to_dict'] = measure(sam.to_dict)
+    _, phases['to_json'] = measure(lambda: sam.get_template('json'))
+    _, phases['to_yaml'] = measure(lambda: sam.get_template('yaml'))
+    sam.invalidate()
+    details, phases['publish'] = measure(lambda: publish(sam, latency, poll_delay))
+    phases['publish'].update(details)
+    return {
+        'functions': functions,
+        'events': events,
+        'parameters': len(sam.parameters),
+        'resources': len(sam.resources),
+        'template_bytes': {k: len(sam.get_template(k).encode('utf-8'))
+                           for k in ('json', 'yaml')},
+        'phases': phases,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run_in_process(functions, args):
+    command = [sys.executable, '-m', 'benchmarks.suite', '--single',
+               '--functions', str(functions), '--events', str(args.events),
+               '--latency', str(args.latency), '--poll-delay', str(args.poll_delay)]
+    if args.parameters is not None:
+        command += ['--parameters', str(args.parameters)]
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if process.returncode:
+        raise RuntimeError('Benchmark of {} functions failed:\n{}'.format(
+            functions, process.stderr.decode('utf-8')))
+    return json.loads(process.stdout.decode('utf-8'))
+
+
+def revision():
+    try:
+        output = subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                         stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode('utf-8').strip()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--functions', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='Template sizes in functions')
+    parser.add_argument('--events', type=int, default=1, help='Events per function')
+    parser.add_argument('--parameters', type=int, default=None,
+                        help='Number of parameters, one per ten functions by default')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Seconds added to every stubbed AWS call')
+    parser.add_argument('--poll-delay', type=float, default=0.05,
+                        help='Minimum delay between status polls')
+    parser.add_argument('--output', help='Write the JSON results to this file')
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.single:
+        # publish reports progress on stdout, which carries the result
+        with contextlib.redirect_stdout(sys.stderr):
+            result = run(args.functions[0], args.events, args.parameters,
+                         args.latency, args.poll_delay)
+        print(json.dumps(result))
+        return
+
+    results = {
+        'revision': revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'latency': args.latency,
+        'runs': [],
+    }
+    for functions in args.functions:
+        result = run_in_process(functions, args)
+        results['runs'].append(result)
+        sys.stderr.write('{:>6} functions  {}\n'.format(functions, '  '.join(
+            '{} {:.3f}s'.format(k, v['seconds']) for k, v in result['phases'].items())))
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Compares SAM.to_yaml against the previous JSON round-trip rendering path on
+large synthetic templates.
+
+    python -m benchmarks.yaml_render 1000 5000
+"""
+import json
+import sys
+import time
+import tracemalloc
+
+import yaml
+from valley.utils.json_utils import ValleyEncoderNoType
+
+import sammy as sm
+
+
+def build_template(size):
+    sam = sm.SAM(Description='Synthetic benchmark template.')
+    sam.add_parameter(sm.Parameter(name='Bucket', Type='String'))
+    sam.add_resource(sm.SimpleTable(name='Table'))
+    for i in range(size):
+        sam.add_resource(sm.Function(
+            name='Function{}'.format(i),
+            Handler='index.handler{}'.format(i),
+            Runtime='python3.6',
+            CodeUri=sm.S3URI(Bucket=sm.Ref(Ref='Bucket'), Key='code{}.zip'.format(i)),
+            Environment=sm.Environment(Variables={'TABLE_NAME': sm.Ref(Ref='Table')}),
+            Events=[sm.APIEvent(name='Api{}'.format(i), Path='/resource/{}'.format(i), Method='get')]
+        ))
+    return sam
+
+
+def json_round_trip(sam):
+    jd = json.dumps(sam.get_template_dict(), cls=ValleyEncoderNoType)
+    return yaml.safe_dump(json.loads(jd), default_flow_style=False)
+
+
+def measure(func, sam):
+    tracemalloc.start()
+    start = time.perf_counter()
+    output = func(sam)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return output, elapsed, peak
+
+
+def main(sizes):
+    for size in sizes:
+        sam = build_template(size)
+        old, old_time, old_peak = measure(json_round_trip, sam)
+        new, new_time, new_peak = measure(lambda s: s.to_yaml(), sam)
+        assert old == new, 'Rendered templates differ'
+        print('{:>6} functions  round-trip {:8.3f}s {:8.1f}MB  '
+              'direct {:8.3f}s {:8.1f}MB  ({:.2f}x)'.format(
+                  size, old_time, old_peak / 2 ** 20,
+                  new_time, new_peak / 2 ** 20, old_time / new_time))
+
+
+if __name__ == '__main__':
+    main([int(i) for i in sys.argv[1:]] or [100, 1000, 5000])
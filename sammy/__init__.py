@@ -1,21 +1,33 @@
 import collections
+import contextlib
+import hashlib
+import io
 
-import boto3
 import json
 import time
 
-import botocore
 import sys
-import yaml
-from botocore.exceptions import ProfileNotFound
+import threading
+import types
+import weakref
 
+from valley.exceptions import ValidationException
 from valley.properties import *
 from valley.contrib import Schema
 from valley.utils.json_utils import ValleyEncoderNoType
 
+from sammy import clients, instrumentation, state
 from sammy.custom_properties import ForeignInstanceListProperty, \
     CharForeignProperty, IntForeignProperty
-from sammy.exceptions import DeployFailedError
+from sammy.events import StackEventTail
+from sammy.exceptions import DanglingReferenceError, DeployFailedError, \
+    DuplicateLogicalIdError, StackFailedError, TemplateValidationError
+from sammy.stacksets import DEFAULT_OPERATION_PREFERENCES, StackSetOperation, \
+    list_stack_instances
+from sammy.waiters import Backoff
+
+# Keep in step with setup.py
+__version__ = '0.4.2'
 
 API_METHODS = {
     'post': 'post',
@@ -28,70 +40,435 @@ API_METHODS = {
     'any': 'any'
 }
 
-RENDER_FORMATS = {'json': 'json', 'yaml': 'yaml'}
+RENDER_FORMATS = {'json': 'json', 'yaml': 'yaml', 'json-compact': 'json-compact'}
+
+# Widest line the YAML emitter accepts, so minified YAML is never wrapped
+YAML_MAX_WIDTH = 2 ** 31 - 1
 
 LOG = logging.getLogger(__name__)
 
+_validation = threading.local()
+
+VALIDATION_MODES = ('eager', 'deferred')
+
 ChangeSetResult = collections.namedtuple(
     "ChangeSetResult", ["changeset_id", "changeset_type"])
 
+CHANGESET_DONE_STATUSES = ('CREATE_COMPLETE', 'FAILED')
+
+NO_CHANGES_REASONS = ("didn't contain changes", "No updates are to be performed")
+
+DIGEST_TAG = 'sammy:template-digest'
+
+DIGEST_STORES = ('tag', 'file')
+
+# Largest template CloudFormation accepts inline through TemplateBody
+TEMPLATE_BODY_LIMIT = 51200
+
+S3_MISSING_CODES = ('404', 'NoSuchKey', 'NotFound')
+
+SizeReport = collections.namedtuple(
+    "SizeReport", ["render_type", "original", "minified", "saved"])
+
+CacheInfo = collections.namedtuple(
+    "CacheInfo", ["hits", "misses", "template_hits", "template_misses"])
+
+
+class PublishResult(object):
+    """
+    Outcome of SAM.publish_stack. Timings and poll counts are keyed by
+    phase (digest, upload, changeset, execute). skipped is True when the digest
+    matched the deployed one and no changeset was created. events holds the
+    stack events of the execution and resource_durations the seconds each
+    resource took.
+    """
+
+    def __init__(self, stack_name):
+        self.stack_name = stack_name
+        self.changeset_id = None
+        self.changeset_type = None
+        self.status = None
+        self.status_reason = None
+        self.stack = None
+        self.digest = None
+        self.skipped = False
+        self.template_url = None
+        self.timings = {}
+        self.polls = {}
+        self.events = []
+        self.resource_durations = {}
 
-def remove_nulls(obj_dict):
-    null_keys = []
-    for k, v in obj_dict.items():
-        if not v:
-            null_keys.insert(0, k)
-    for k in null_keys:
-        obj_dict.pop(k)
-    return obj_dict
+    def __repr__(self):
+        return '<PublishResult: {} {} >'.format(self.stack_name, self.status)
+
+    @property
+    def no_changes(self):
+        """
+        True when the changeset failed only because there was nothing to change
+        """
+        return self.status == 'FAILED' and any(
+            i in (self.status_reason or '') for i in NO_CHANGES_REASONS)
+
+
+@contextlib.contextmanager
+def deferred_validation():
+    """
+    Skips validation of schema objects created inside the block. They are
+    validated in a single pass when a template containing them is rendered.
+    """
+    previous = getattr(_validation, 'deferred', False)
+    _validation.deferred = True
+    try:
+        yield
+    finally:
+        _validation.deferred = previous
+
+
+def iter_schemas(value):
+    if isinstance(value, SAMSchema):
+        yield value
+    elif isinstance(value, (list, tuple)):
+        for i in value:
+            for j in iter_schemas(i):
+                yield j
+    elif isinstance(value, dict):
+        for i in value.values():
+            for j in iter_schemas(i):
+                yield j
+
+
+def is_stable(stack):
+    """
+    True when a described stack finished its last operation successfully
+    """
+    if stack is None:
+        return False
+    status = stack['StackStatus']
+    return status.endswith('_COMPLETE') and 'ROLLBACK' not in status \
+        and not status.startswith('DELETE')
+
+
+def aws_property(service_name, kind='client'):
+    """
+    Builds a property that returns a pooled boto3 client or resource for the
+    SAM object's region and profile, created the first time it is used.
+    Assigning the property overrides it for that object only.
+    """
+    key = (kind, service_name)
+
+    def getter(self):
+        override = self._aws_overrides.get(key)
+        if override is not None:
+            return override
+        region_name, profile_name = self._aws_config
+        if self._aws_pool is not None:
+            if kind == 'client':
+                return self._aws_pool.client(service_name, region_name)
+            return self._aws_pool.resource(service_name, region_name)
+        if kind == 'client':
+            return self.get_client(service_name, region_name=region_name, profile_name=profile_name)
+        return self.get_service_resource(service_name, region_name=region_name, profile_name=profile_name)
+
+    def setter(self, value):
+        self._aws_overrides[key] = value
+
+    return property(getter, setter)
+
+
+def strip_empty_properties(template):
+    """
+    Returns a copy of a template dict without empty Properties maps on
+    resources and function events. Cached fragments are never modified.
+    """
+    resources = {}
+    for name, resource in template.get('Resources', {}).items():
+        if 'Properties' in resource:
+            properties = resource['Properties']
+            if not properties:
+                resource = {k: v for k, v in resource.items() if k != 'Properties'}
+            elif isinstance(properties.get('Events'), dict):
+                events = strip_empty_properties({'Resources': properties['Events']})['Resources']
+                resource = dict(resource, Properties=dict(properties, Events=events))
+        resources[name] = resource
+    return dict(template, Resources=resources)
+
+
+# Types whose empty values are left out of templates, like None. 0 and False are kept.
+NULLABLE_TYPES = (str, list, tuple, dict)
+
+
+def is_null(value):
+    return value is None or (not value and isinstance(value, NULLABLE_TYPES))
+
+
+def render_named(items):
+    """
+    :param items: Schema objects with a name
+    :return: Dict of each object's rendering keyed by its name
+    """
+    return {i._data['name']: i.render()['r'] for i in items}
+
+
+class Intrinsic(object):
+    """
+    Immutable intrinsic function. Instances built from the same arguments are
+    interned, so identical references share one object, hash and compare by
+    value and can be used as dict keys.
+    """
+    __slots__ = ('_key', '__weakref__')
+    _interned = weakref.WeakValueDictionary()
+
+    @classmethod
+    def intern(cls, key, **attrs):
+        key = (cls,) + key
+        obj = cls._interned.get(key)
+        if obj is None:
+            obj = object.__new__(cls)
+            object.__setattr__(obj, '_key', key)
+            for k, v in attrs.items():
+                object.__setattr__(obj, k, v)
+            obj = cls._interned.setdefault(key, obj)
+        return obj
+
+    def __setattr__(self, name, value):
+        raise AttributeError('{} objects are immutable'.format(self.__class__.__name__))
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __eq__(self, other):
+        return isinstance(other, Intrinsic) and self._key == other._key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<{}: {} >'.format(self.__class__.__name__, ', '.join(
+            str(i) for i in self._key[1:]))
 
 
 class SAMSchema(Schema):
+    _render_cache = None
+    _deferred = False
+    # The object itself awaits deferred validation
+    _unvalidated = False
+    # The object or a schema object in its properties awaits deferred validation
+    _pending = False
 
     def __init__(self, **kwargs):
         super(SAMSchema, self).__init__(**kwargs)
-        self.validate()
+        self._parents = weakref.WeakSet()
+        for value in self._data.values():
+            self.adopt(value)
+        if self.validation_deferred():
+            self.defer_validation()
+        else:
+            self.validate()
+
+    def process_schema_kwargs(self, kwargs):
+        """
+        Unlike valley, keeps 0 and False arguments instead of replacing them
+        with the default. Properties that are not given stay None, even
+        booleans, so they are left out of the template.
+        """
+        data = {}
+        for key, prop in self._base_properties.items():
+            value = kwargs.get(key)
+            if is_null(value):
+                # BooleanProperty defaults to False, which means unset here
+                value = prop.get_default_value() or None
+            # valley converts 0 to None, so only truthy values are converted
+            if value:
+                try:
+                    value = prop.get_python_value(value)
+                except ValueError:
+                    pass
+            data[key] = value
+        for i in self.BUILTIN_DOC_ATTRS:
+            if kwargs.get(i):
+                data[i] = kwargs[i]
+        return data
+
+    def template_properties(self, exclude=()):
+        """
+        Collects the properties that belong in the template in one pass,
+        leaving out the name and null values
+        :param exclude: Other property names to leave out
+        :return: dict
+        """
+        # is_null inlined, this runs for every property of every resource
+        return {k: v for k, v in self._data.items()
+                if v is not None and (v or not isinstance(v, NULLABLE_TYPES))
+                and k != 'name' and k not in exclude}
+
+    def validation_deferred(self):
+        return self._deferred or getattr(_validation, 'deferred', False)
+
+    def defer_validation(self):
+        self._unvalidated = True
+        self.mark_pending()
+
+    def mark_pending(self):
+        """
+        Flags the object and its parents, so only the templates containing
+        it walk down to it when they validate
+        """
+        if not self._pending:
+            self._pending = True
+            for parent in list(self._parents):
+                parent.mark_pending()
+
+    def validation_errors(self):
+        """
+        Validates every property, including its {key}_validate hook like
+        validate(), instead of stopping at the first invalid one
+        :return: List of error messages
+        """
+        errors = []
+        for key, prop in self._base_properties.items():
+            value = self._data.get(key)
+            prop_validate = getattr(self, '{}_validate'.format(key), None)
+            try:
+                prop.validate(value, key)
+                if callable(prop_validate):
+                    prop_validate(value)
+            except ValidationException as e:
+                errors.append(e.error_msg)
+        return errors
+
+    def __setattr__(self, name, value):
+        super(SAMSchema, self).__setattr__(name, value)
+        if name in self._base_properties:
+            self.adopt(value)
+            self.invalidate()
+
+    def adopt(self, value):
+        """
+        Registers this object as a parent of any schema objects in value so
+        their mutations invalidate this object's cached rendering.
+        :param value: Property value (schema object, list or dict)
+        """
+        if isinstance(value, SAMSchema):
+            value._parents.add(self)
+            if value._pending:
+                self.mark_pending()
+        elif isinstance(value, (list, tuple)):
+            for i in value:
+                self.adopt(i)
+        elif isinstance(value, dict):
+            for i in value.values():
+                self.adopt(i)
+
+    def invalidate(self):
+        """
+        Drops the cached rendering of this object and of every object that
+        contains it. Call this after mutating a property value in place.
+        """
+        self._render_cache = None
+        for parent in list(self._parents):
+            parent.invalidate()
 
+    def render(self, stats=None):
+        """
+        Returns the cached to_dict() output, rendering it only if the object
+        changed since the last call. The returned dict is shared and must
+        not be mutated.
+        :param stats: Optional Counter that records cache hits and misses
+        :return: dict
+        """
+        if self._render_cache is None:
+            self._render_cache = self.to_dict()
+            if stats is not None:
+                stats['misses'] += 1
+        elif stats is not None:
+            stats['hits'] += 1
+        return self._render_cache
+
+
+# Values accepted wherever a property takes any template object
+TEMPLATE_OBJECTS = (SAMSchema, Intrinsic)
+
+
+class Ref(Intrinsic):
+    __slots__ = ()
+
+    def __new__(cls, Ref):
+        if not isinstance(Ref, str) or not Ref:
+            raise ValidationException('Ref: This value should be a non-empty string.')
+        return cls.intern((Ref,))
 
-class Ref(SAMSchema):
-    Ref = CharProperty(required=True)
+    def __reduce__(self):
+        return (self.__class__, (self.Ref,))
 
+    @property
+    def Ref(self):
+        return self._key[1]
 
-class Sub(SAMSchema):
-    Sub = CharForeignProperty(Ref, required=True)
-    Map = DictProperty()
+    def to_dict(self):
+        return {'Ref': self._key[1]}
+
+
+class Sub(Intrinsic):
+    __slots__ = ('Sub', 'Map')
+
+    def __new__(cls, Sub, Map=None):
+        if not isinstance(Sub, (str, Ref)) or not Sub:
+            raise ValidationException('Sub: This value should be a string or Ref.')
+        if Map is not None and not isinstance(Map, dict):
+            raise ValidationException('Map: This value should be a dict.')
+        # Interned objects are shared, so Map is a read-only view of a private copy
+        Map = types.MappingProxyType(dict(Map)) if Map else None
+        frozen_map = json.dumps(dict(Map), sort_keys=True, cls=ValleyEncoderNoType) if Map else None
+        return cls.intern((Sub, frozen_map), Sub=Sub, Map=Map)
+
+    def __reduce__(self):
+        return (self.__class__, (self.Sub, dict(self.Map) if self.Map else None))
 
     def to_dict(self):
-        obj = remove_nulls(self._data.copy())
-        Map = obj.get('Map', None)
-        if not Map:
+        if not self.Map:
             return {
-                "Fn::Sub": obj.get('Sub'),
+                "Fn::Sub": self.Sub,
             }
         else:
             return {
-                "Fn::Sub": [obj.get('Sub'), obj.get('Map')]
+                "Fn::Sub": [self.Sub, dict(self.Map)]
             }
 
 
-class S3URI(SAMSchema):
-    Bucket = CharForeignProperty(Ref, required=True)
-    Key = CharForeignProperty(Ref, required=True)
+class S3URI(Intrinsic):
+    __slots__ = ()
+
+    def __new__(cls, Bucket, Key):
+        for name, value in (('Bucket', Bucket), ('Key', Key)):
+            if not isinstance(value, (str, Ref)) or not value:
+                raise ValidationException(
+                    '{}: This value should be a non-empty string or Ref.'.format(name))
+        return cls.intern((Bucket, Key))
+
+    def __reduce__(self):
+        return (self.__class__, self._key[1:])
+
+    @property
+    def Bucket(self):
+        return self._key[1]
+
+    @property
+    def Key(self):
+        return self._key[2]
 
     def to_dict(self):
-        obj = remove_nulls(self._data.copy())
-        return obj
+        return {'Bucket': self._key[1], 'Key': self._key[2]}
 
 
 class LambdaCode(SAMSchema):
-    S3Bucket = CharForeignProperty(Ref, required=True)
-    S3Key = CharForeignProperty(Ref, required=True)
-    S3ObjectVersion = CharForeignProperty(Ref, required=True)
-    ZipFile = CharForeignProperty(Ref, required=True)
+    # Either S3Bucket and S3Key, or ZipFile with inline code
+    S3Bucket = CharForeignProperty(Ref)
+    S3Key = CharForeignProperty(Ref)
+    S3ObjectVersion = CharForeignProperty(Ref)
+    ZipFile = CharForeignProperty(Ref)
 
     def to_dict(self):
-        obj = remove_nulls(self._data.copy())
-        return obj
+        return self.template_properties()
 
 
 class S3KeyFilter(SAMSchema):
@@ -107,11 +484,9 @@ class Parameter(SAMSchema):
     Type = CharForeignProperty(Ref, required=True)
 
     def to_dict(self):
-        obj = remove_nulls(self._data.copy())
-        name = obj.pop('name')
         return {
-            'name': name,
-            'r': obj
+            'name': self._data['name'],
+            'r': self.template_properties()
         }
 
 
@@ -122,29 +497,33 @@ class Output(SAMSchema):
     Export = DictProperty()
 
     def to_dict(self):
-        obj = remove_nulls(self._data.copy())
-        name = obj.pop('name')
         return {
-            'name': name,
-            'r': obj
+            'name': self._data['name'],
+            'r': self.template_properties()
         }
 
 class Resource(SAMSchema):
     _resource_type = None
+    # Properties holding named schema objects, rendered as a dict keyed by name
+    _named_properties = ()
 
     name = CharForeignProperty(Ref, required=True)
+    # Resources only some environments need. SAM.prune_resources drops
+    # them when nothing refers to them.
+    prunable = BooleanProperty()
 
     def to_dict(self):
-        obj = remove_nulls(self._data.copy())
-        name = obj.pop('name')
-
         r_attrs = {
             'Type': self._resource_type
         }
-        if len(obj.keys()) > 0:
-            r_attrs['Properties'] = {k: v for k, v in obj.items() if v}
+        properties = self.template_properties(self._named_properties + ('prunable',))
+        for key in self._named_properties:
+            if not is_null(self._data.get(key)):
+                properties[key] = render_named(self._data[key])
+        if properties:
+            r_attrs['Properties'] = properties
         return {
-            'name': name,
+            'name': self._data['name'],
             'r': r_attrs
         }
 
@@ -158,15 +537,14 @@ class EventSchema(SAMSchema):
     name = CharForeignProperty(Ref, required=True)
 
     def to_dict(self):
-        obj = remove_nulls(self._data.copy())
-        event = {'name': obj.pop('name'),
+        event = {'name': self._data['name'],
                  'r': {
                      'Type': self._event_type
                  }
                  }
-
-        if len(obj.keys()) > 0:
-            event['r']['Properties'] = obj
+        properties = self.template_properties()
+        if properties:
+            event['r']['Properties'] = properties
         return event
 
 
@@ -242,11 +620,10 @@ class DeadLetterQueueSchema(SAMSchema):
     TargetArn = CharForeignProperty(Ref, required=True)
 
     def to_dict(self):
-        obj = remove_nulls(self._data.copy())
-        event = {'name': obj.pop('name'),
+        event = {'name': self._data['name'],
                  'r': {
                      'Type': self._dlq_type,
-                     'Properties': obj
+                     'Properties': self.template_properties()
                  }}
 
         return event
@@ -289,14 +666,14 @@ class SQS(Resource):
     _serverless_type = False
 
     ContentBasedDeduplication = BooleanProperty()
-    DelaySeconds = IntForeignProperty(SAMSchema)
+    DelaySeconds = IntForeignProperty(TEMPLATE_OBJECTS)
     FifoQueue = BooleanProperty()
-    KmsMasterKeyId = CharForeignProperty(SAMSchema)
-    KmsDataKeyReusePeriodSeconds = IntForeignProperty(SAMSchema)
-    MaximumMessageSize = IntForeignProperty(SAMSchema)
-    MessageRetentionPeriod = IntForeignProperty(SAMSchema)
-    ReceiveMessageWaitTimeSeconds = IntForeignProperty(SAMSchema)
-    VisibilityTimeout = IntForeignProperty(SAMSchema)
+    KmsMasterKeyId = CharForeignProperty(TEMPLATE_OBJECTS)
+    KmsDataKeyReusePeriodSeconds = IntForeignProperty(TEMPLATE_OBJECTS)
+    MaximumMessageSize = IntForeignProperty(TEMPLATE_OBJECTS)
+    MessageRetentionPeriod = IntForeignProperty(TEMPLATE_OBJECTS)
+    ReceiveMessageWaitTimeSeconds = IntForeignProperty(TEMPLATE_OBJECTS)
+    VisibilityTimeout = IntForeignProperty(TEMPLATE_OBJECTS)
     QueueName = CharForeignProperty(Ref)
 
 
@@ -307,36 +684,21 @@ class AbstractFunction(Resource):
     Description = CharForeignProperty(Ref)
     MemorySize = IntegerProperty()
     Timeout = IntegerProperty()
-    Role = CharForeignProperty(SAMSchema)
+    Role = CharForeignProperty(TEMPLATE_OBJECTS)
     Environment = ForeignProperty(Environment)
     VpcConfig = DictProperty()
     KmsKeyArn = CharForeignProperty(Ref)
     Tags = DictProperty()
 
-    def to_dict(self):
-
-        obj = super(AbstractFunction, self).to_dict()
-        try:
-            events = [i.to_dict() for i in obj['r']['Properties'].pop('Events')]
-
-            obj['r']['Properties']['Events'] = {i.get('name'): i.get('r') for i in events}
-        except KeyError:
-            pass
-
-        try:
-            dlq = [i.to_dict() for i in obj['r']['Properties'].pop('DeadLetterQueue')]
-            obj['r']['Properties']['DeadLetterQueue'] = {i.get('name'): i.get('r') for i in dlq}
-        except KeyError:
-            pass
-
-        return obj
+    _named_properties = ('Events', 'DeadLetterQueue')
 
 
 class Function(AbstractFunction):
     _resource_type = 'AWS::Serverless::Function'
     _serverless_type = True
 
-    CodeUri = ForeignProperty(S3URI)
+    # S3URI, an s3:// URI or a local path packaged by SAM.package
+    CodeUri = CharForeignProperty(S3URI)
     Policies = CharForeignProperty(Ref)
     Events = ForeignInstanceListProperty(EventSchema)
     Tracing = CharForeignProperty(Ref)
@@ -348,7 +710,8 @@ class CFunction(AbstractFunction):
     _resource_type = 'AWS::Lambda::Function'
     _serverless_type = False
 
-    Code = ForeignProperty(LambdaCode)
+    # LambdaCode or a local path packaged by SAM.package
+    Code = CharForeignProperty(LambdaCode)
     Layers = ListProperty()
     TracingConfig = DictProperty()
 
@@ -379,7 +742,7 @@ class DynamoDBTable(Resource):
     _serverless_type = False
 
     AttributeDefinitions = ListProperty(required=True)
-    TableName = CharForeignProperty(SAMSchema, required=True)
+    TableName = CharForeignProperty(TEMPLATE_OBJECTS, required=True)
     GlobalSecondaryIndexes = ListProperty()
     KeySchema = ListProperty(required=True)
     BillingMode = CharForeignProperty(Ref)
@@ -392,90 +755,692 @@ class DynamoDBTable(Resource):
     TimeToLiveSpecification = DictProperty()
 
 
+class GlobalsSection(SAMSchema):
+
+    def to_dict(self):
+        return self.template_properties()
+
+
+class FunctionGlobals(GlobalsSection):
+    Handler = CharForeignProperty(Ref)
+    Runtime = CharForeignProperty(Ref, max_length=15)
+    CodeUri = CharForeignProperty(S3URI)
+    Description = CharForeignProperty(Ref)
+    MemorySize = IntegerProperty()
+    Timeout = IntegerProperty()
+    Environment = ForeignProperty(Environment)
+    VpcConfig = DictProperty()
+    KmsKeyArn = CharForeignProperty(Ref)
+    Tags = DictProperty()
+    Tracing = CharForeignProperty(Ref)
+    Layers = ListProperty()
+    ReservedConcurrentExecutions = IntegerProperty()
+
+
+class APIGlobals(GlobalsSection):
+    DefinitionUri = CharForeignProperty(Ref)
+    CacheClusterEnabled = BooleanProperty()
+    CacheClusterSize = CharForeignProperty(Ref)
+    Variables = DictProperty()
+
+
+class Globals(GlobalsSection):
+    """
+    Properties the SAM transform applies to every serverless function and
+    API. Values set on a resource override or extend them.
+    """
+    Function = ForeignProperty(FunctionGlobals)
+    Api = ForeignProperty(APIGlobals)
+
+    def to_dict(self):
+        return {k: v.render() for k, v in self.template_properties().items()}
+
+
 class SAM(SAMSchema):
+    """
+    Template of serverless resources that renders, packages and publishes
+    itself. With skip_unchanged set, publishing is skipped when the template
+    and parameters hash to the digest of the last successful publish. The
+    digest is kept in state_file by default. digest_store = 'tag' keeps it in
+    a stack tag instead, which CloudFormation copies to every taggable
+    resource, so each publish that is not skipped also updates all of them.
+    """
     aws_template_format_version = '2010-09-09'
     transform = 'AWS::Serverless-2016-10-31'
     Description = CharProperty()
+    Globals = ForeignProperty(Globals)
     resources = ForeignInstanceListProperty(Resource)
     parameters = ForeignInstanceListProperty(Parameter)
     render_type = CharProperty(choices=RENDER_FORMATS, default_value='yaml')
+    minify = BooleanProperty()
 
-    def __init__(self, region_name='us-east-1', profile_name='default', **kwargs):
+    _registries = ('resources', 'parameters')
+
+    def __init__(self, region_name='us-east-1', profile_name='default', validate='eager',
+                 **kwargs):
+        """
+        :param validate: 'deferred' checks the template's own properties and
+            the objects added to it in the validate_tree pass at render time
+            instead of right away
+        """
+        if validate not in VALIDATION_MODES:
+            raise ValueError('validate must be one of {}'.format(', '.join(VALIDATION_MODES)))
+        self._deferred = validate == 'deferred'
         super(SAM, self).__init__(**kwargs)
+        for registry in self._registries:
+            items = self._data.get(registry) or []
+            self._data[registry] = collections.OrderedDict()
+            self.register(registry, items)
         self.region_name = region_name
         self.profile_name = profile_name
         self.changeset_prefix = 'sammy-deploy-'
+        self.changeset_wait = Backoff(min_delay=1, max_delay=10)
+        self.stack_wait = Backoff(min_delay=2, max_delay=30)
+        self.stackset_wait = Backoff(min_delay=5, max_delay=60, timeout=7200)
+        self.skip_unchanged = False
+        self.digest_store = 'file'
+        self.state_file = '.sammy-state.json'
+        self.template_bucket = None
+        self.template_prefix = ''
+        self.upload_all_templates = False
+        self.code_bucket = None
+        self.code_prefix = ''
+        self.hoist_globals = False
+        self.verify_globals = False
+        self.fold_parameters = False
+        self.prune_resources = False
+        self.check_references = False
+        self.print_timings = True
+        self.capabilities = ['CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM']
+        self.render_stats = collections.Counter()
+        self._template_cache = {}
         self.build_clients_resources()
 
-    def build_clients_resources(self, region_name=None, profile_name=None):
+    cf_client = aws_property('cloudformation')
+    cf_resource = aws_property('cloudformation', 'resource')
+    s3 = aws_property('s3', 'resource')
+    sts = aws_property('sts')
+
+    def build_clients_resources(self, region_name=None, profile_name=None, session=None):
+        """
+        Points the AWS clients and resources at a region and profile. Nothing
+        is constructed until a client is first used, and clients are shared
+        through sammy.clients with every other object using the same
+        profile, region and service.
+        :param session: Object with boto3 Session's client and resource methods that
+            creates the clients instead, such as a boto3 Session or sammy.fake.FakeAWS.
+            Its clients are created once and its resources once per thread.
+        """
         region_name = region_name or self.region_name
         profile_name = profile_name or self.profile_name
 
-        self.cf_client = self.get_client('cloudformation', region_name=region_name, profile_name=profile_name)
-        self.cf_resource = self.get_resource('cloudformation', region_name=region_name, profile_name=profile_name)
-        self.s3 = self.get_resource('s3', region_name=region_name, profile_name=profile_name)
-        self.sts = self.get_client('sts', region_name=region_name,profile_name=profile_name)
-
-    def add_parameter(self, parameter):
-        self._base_properties.get('parameters').validate([parameter], 'parameters')
-        parameters = self._data.get('parameters') or []
-        parameters.append(parameter)
-        parameters = set(parameters)
-        self._data['parameters'] = list(parameters)
-
-    def add_resource(self, resource):
-        self._base_properties.get('resources').validate([resource], 'resources')
-        resources = self._data.get('resources') or []
-        resources.append(resource)
-        resources = set(resources)
-        self._data['resources'] = list(resources)
+        self._aws_config = (region_name, profile_name)
+        self._aws_pool = clients.SessionPool(session) if session is not None else None
+        self._aws_overrides = {}
+
+    def __getattr__(self, name):
+        if name in self._registries:
+            return list(self._data[name].values())
+        return super(SAM, self).__getattr__(name)
+
+    def __setattr__(self, name, value):
+        if name in self._registries:
+            self.validate_items(name, value)
+            value = list(value or [])
+            # Check the new items before dropping the old ones
+            self.check_names(name, value, collections.OrderedDict())
+            for item in self._data[name].values():
+                item._parents.discard(self)
+            self._data[name] = collections.OrderedDict()
+            self.register(name, value)
+        else:
+            super(SAM, self).__setattr__(name, value)
+
+    def register(self, registry, items, replace=False):
+        """
+        Adds already validated objects to a registry keyed by logical name.
+        Re-adding the same object is a no-op.
+        :param registry: Registry name (resources, parameters or outputs)
+        :param items: Iterable of Resource, Parameter or Output objects
+        :param replace: Replace existing objects with the same name instead of raising
+        """
+        items = list(items)
+        index = self._data[registry]
+        self.check_names(registry, items, index, replace)
+        for item in items:
+            name = item._data['name']
+            existing = index.get(name)
+            if existing is item:
+                continue
+            if existing is not None:
+                existing._parents.discard(self)
+            index[name] = item
+            self.adopt(item)
+        self.invalidate()
+
+    @staticmethod
+    def check_names(registry, items, index, replace=False):
+        """
+        Checks a batch for logical names it repeats or that are already
+        registered, so a failing batch adds nothing
+        :param index: Registered objects keyed by logical name
+        :raises: DuplicateLogicalIdError
+        """
+        batch = {}
+        for item in items:
+            name = item._data['name']
+            existing = index.get(name)
+            if batch.setdefault(name, item) is not item or \
+                    (existing is not None and existing is not item and not replace):
+                raise DuplicateLogicalIdError(
+                    'Duplicate logical name {} in {}.'.format(name, registry))
+
+    def validate_items(self, registry, items):
+        if not self.validation_deferred():
+            self._base_properties.get(registry).validate(items, registry)
+            return
+        # Items are keyed by name when registered, so only schema objects are accepted now
+        for item in items or []:
+            if not isinstance(item, SAMSchema):
+                raise ValidationException('{}: This value ({}) should be an instance of {}.'.format(
+                    registry, item, self._base_properties[registry].foreign_class.__name__))
+        self.defer_validation()
+
+    def validate(self):
+        registries = {i: self._data[i] for i in self._registries}
+        for k, v in registries.items():
+            if isinstance(v, dict):
+                self._data[k] = list(v.values())
+        try:
+            super(SAM, self).validate()
+        finally:
+            self._data.update(registries)
+
+    def validation_errors(self):
+        registries = {i: self._data[i] for i in self._registries}
+        self._data.update((k, list(v.values())) for k, v in registries.items())
+        try:
+            return super(SAM, self).validation_errors()
+        finally:
+            self._data.update(registries)
+
+    def validate_tree(self):
+        """
+        Validates every object in the template whose validation was deferred.
+        Only branches holding such objects are walked, shared objects are
+        validated once and all errors are reported together.
+        :raises: TemplateValidationError
+        """
+        if not self._pending:
+            return
+        with instrumentation.span('validate_tree') as s:
+            s.set(validated=self._validate_tree())
+
+    def _validate_tree(self):
+        """
+        :return: Number of objects validated
+        """
+        errors, validated = [], []
+        # id of each visited object to whether it still awaits validation
+        seen = {id(self): True}
+
+        def validate(obj, path):
+            validated.append(obj)
+            obj_errors = obj.validation_errors()
+            errors.extend('{}: {}'.format(path, i) if path else i for i in obj_errors)
+            obj._unvalidated = bool(obj_errors)
+
+        def visit(obj, path):
+            if id(obj) in seen:
+                return seen[id(obj)]
+            if not obj._pending:
+                return False
+            seen[id(obj)] = True
+            if obj._unvalidated:
+                validate(obj, path)
+            pending = obj._unvalidated
+            for key, value in obj._data.items():
+                for child in iter_schemas(value):
+                    pending = visit(child, '{}.{}'.format(path, key)) or pending
+            obj._pending = seen[id(obj)] = pending
+            return pending
+
+        if self._unvalidated:
+            validate(self, None)
+        pending = self._unvalidated
+        for key, value in self._data.items():
+            if key in self._registries:
+                children = value.items()
+            else:
+                children = ((key, i) for i in iter_schemas(value))
+            for path, child in children:
+                pending = visit(child, path) or pending
+        self._pending = pending
+        if errors:
+            raise TemplateValidationError(errors)
+        return len(validated)
+
+    def add_parameter(self, parameter, replace=False):
+        self.validate_items('parameters', [parameter])
+        self.register('parameters', [parameter], replace=replace)
+
+    def add_parameters(self, parameters, replace=False):
+        parameters = list(parameters)
+        self.validate_items('parameters', parameters)
+        self.register('parameters', parameters, replace=replace)
+
+    def add_resource(self, resource, replace=False):
+        self.validate_items('resources', [resource])
+        self.register('resources', [resource], replace=replace)
+
+    def add_resources(self, resources, replace=False):
+        """
+        Adds many resources at once, validating the whole batch in one pass.
+        :param resources: Iterable of Resource objects
+        :param replace: Replace existing resources with the same name instead of raising
+        """
+        resources = list(resources)
+        self.validate_items('resources', resources)
+        self.register('resources', resources, replace=replace)
+
+    def get_resource(self, name):
+        """
+        Looks up a resource by logical name
+        :param name: Logical name of the resource
+        :return: Resource or None
+        """
+        return self._data['resources'].get(name)
+
+    def remove_resource(self, name):
+        """
+        Removes a resource by logical name
+        :param name: Logical name of the resource
+        :return: The removed Resource
+        """
+        resource = self._data['resources'].pop(name)
+        resource._parents.discard(self)
+        self.invalidate()
+        return resource
 
     def check_global_valid(self):
         """
         Makes sure there aren't any SAM resources in a template that will be used in a CloudFormation StackSet
         :return: bool
         """
-        serverless_cnt = len(list(filter(lambda x: x._serverless_type, self._data['resources'])))
+        serverless_cnt = len(list(filter(lambda x: x._serverless_type, self._data['resources'].values())))
         if serverless_cnt > 0:
             return False
         return True
 
-    def to_dict(self):
-        obj = remove_nulls(self._data.copy())
-        rl = [i.to_dict() for i in obj.get('resources')]
+    def invalidate(self):
+        self._template_cache = {}
+        super(SAM, self).invalidate()
 
-        resources = {i.get('name'): i.get('r') for i in rl}
+    def cache_info(self):
+        """
+        Reports how often rendered resources and template strings were
+        reused instead of being rendered again.
+        :return: CacheInfo
+        """
+        return CacheInfo(self.render_stats['hits'], self.render_stats['misses'],
+                         self.render_stats['template_hits'],
+                         self.render_stats['template_misses'])
 
+    def to_dict(self, resources=None):
+        """
+        :param resources: Mapping used as the Resources section instead of
+            rendering every resource, such as a streaming.ResourceStream
+        """
+        with instrumentation.span('to_dict', resources=len(self._data['resources'])):
+            return self._to_dict(resources)
+
+    def _to_dict(self, resources=None):
+        stats = self.render_stats
+        if resources is None:
+            resources = {name: i.render(stats)['r']
+                         for name, i in self._data['resources'].items()}
         template = {
             'AWSTemplateFormatVersion': self.aws_template_format_version,
             'Resources': resources
         }
         if self.transform:
             template['Transform'] = self.transform
-        if obj.get('Description'):
-            template['Description'] = obj.get('Description')
-        if obj.get('parameters'):
-            pl = [i.to_dict() for i in obj.get('parameters')]
-            parameters = {i.get('name'): i.get('r') for i in pl}
-            if len(parameters.keys()) > 0:
-                template['Parameters'] = parameters
+        if self._data.get('Description'):
+            template['Description'] = self._data['Description']
+        if self._data.get('Globals'):
+            template['Globals'] = self._data['Globals'].render()
+        if self._data['parameters']:
+            template['Parameters'] = {name: i.render()['r']
+                                      for name, i in self._data['parameters'].items()}
         return template
 
-    def get_template_dict(self):
-        return self.to_dict()
+    def get_template_dict(self, minify=False, parameters=None):
+        """
+        :param parameters: Dict of parameter values folded into the template when fold_parameters is set
+        """
+        self.validate_tree()
+        template = self.to_dict()
+        if self.fold_parameters or self.prune_resources or self.check_references:
+            template = self.optimize_template(template, parameters).template
+        if self.hoist_globals:
+            from sammy import hoisting
+
+            with instrumentation.span('hoist_globals'):
+                template = hoisting.hoist(template, verify=self.verify_globals)
+        if minify:
+            template = strip_empty_properties(template)
+        return template
+
+    def prunable_resources(self):
+        return [k for k, v in self._data['resources'].items() if v._data.get('prunable')]
+
+    def references(self):
+        """
+        Indexes the references between the resources, outputs and Globals of the template
+        :return: sammy.references.ReferenceIndex
+        """
+        from sammy import references
+        from sammy.hoisting import plain
+
+        return references.ReferenceIndex(plain(self.to_dict()))
+
+    def optimize_template(self, template=None, parameters=None):
+        """
+        Folds parameters when fold_parameters is set and prunes unreferenced
+        prunable resources when prune_resources is set
+        :param template: Rendered template dict, defaults to to_dict()
+        :param parameters: Dict of parameter values known at publish time
+        :raises: DanglingReferenceError when check_references is set and
+            the template refers to logical IDs it does not declare
+        :return: sammy.references.Optimized
+        """
+        from sammy import references
+
+        with instrumentation.span('optimize_template') as s:
+            result = references.optimize(
+                template or self.to_dict(), parameters if self.fold_parameters else None,
+                self.prunable_resources() if self.prune_resources else ())
+            s.set(folded=len(result.folded), pruned=len(result.pruned),
+                  dangling=len(result.dangling))
+        if self.check_references and result.dangling:
+            raise DanglingReferenceError(result.dangling)
+        return result
+
+    def render_options(self, parameters=None):
+        """
+        Settings that change the rendered template, part of the template cache key
+        """
+        folded = tuple(sorted((parameters or {}).items())) if self.fold_parameters else ()
+        return (self.hoist_globals, self.prune_resources, self.check_references, folded)
+
+    @property
+    def template_extension(self):
+        if self.render_type.startswith('json'):
+            return 'json'
+        return 'yaml'
 
-    def publish_template(self, bucket, name):
+    def publish_template(self, bucket, name, part_size=None):
+        """
+        Streams the template to S3. Templates larger than one part are sent
+        as a multipart upload while they are rendered.
+        :param bucket: Name of the S3 bucket
+        :param name: Object key without the extension
+        :param part_size: Bytes per uploaded part, at least 5 MiB
+        """
+        from sammy.streaming import MIN_PART_SIZE, S3StreamWriter
 
-        filename = '{}.{}'.format(name, self.render_type)
+        filename = '{}.{}'.format(name, self.template_extension)
+
+        part_size = max(part_size or MIN_PART_SIZE, MIN_PART_SIZE)
+        with S3StreamWriter(self.s3.Object(bucket, filename), part_size) as writer:
+            self.write_template(writer)
+
+    @property
+    def rewrites_template(self):
+        """
+        True when a setting rewrites or checks the whole template after it is rendered
+        """
+        return bool(self.hoist_globals or self.fold_parameters or self.prune_resources or
+                    self.check_references)
 
-        self.s3.Object(bucket, filename).put(
-            Body=self.get_template())
+    def iter_template(self, render_type=None, minify=None):
+        """
+        Yields the rendered template in fragments of one section or resource.
+        Joined, they equal get_template with the same arguments. Resources
+        are rendered one at a time as they are written, unless a setting
+        such as hoist_globals needs the whole template first.
+        :param render_type: json, yaml or json-compact, defaults to render_type
+        :param minify: Minify the template, defaults to the minify setting
+        """
+        from sammy import streaming
 
-    def get_template(self):
-        if self.render_type == 'json':
-            return self.to_json()
+        render_type = render_type or self.render_type
+        if minify is None:
+            minify = self.minify or render_type == 'json-compact'
+        if self.rewrites_template:
+            template = self.get_template_dict(minify=minify)
         else:
-            return self.to_yaml()
+            self.validate_tree()
+            template = self.to_dict(streaming.ResourceStream(self._data['resources'], minify))
+        if render_type.startswith('json'):
+            return streaming.iter_json(template, minify)
+        return streaming.iter_yaml(template, minify)
+
+    def write_template(self, fileobj, format=None, minify=None):
+        """
+        Writes the template to a file-like object one resource at a time,
+        without building the whole string
+        :param fileobj: Text or binary file, socket file or S3StreamWriter
+        :param format: json, yaml or json-compact, defaults to render_type
+        :param minify: Minify the template, defaults to the minify setting
+        :return: Number of bytes written
+        """
+        binary = isinstance(fileobj, (io.RawIOBase, io.BufferedIOBase))
+        written = 0
+        with instrumentation.span('write_template', render_type=format or self.render_type) as s:
+            for fragment in self.iter_template(format, minify):
+                data = fragment.encode('utf-8')
+                fileobj.write(data if binary else fragment)
+                written += len(data)
+            s.set(bytes=written)
+        return written
+
+    def get_template(self, render_type=None, minify=None, parameters=None):
+        render_type = render_type or self.render_type
+        if minify is None:
+            minify = self.minify or render_type == 'json-compact'
+        key = (render_type, minify) + self.render_options(parameters)
+        if key in self._template_cache:
+            self.render_stats['template_hits'] += 1
+            return self._template_cache[key]
+        self.render_stats['template_misses'] += 1
+        with instrumentation.span('get_template', render_type=render_type) as s:
+            if render_type.startswith('json'):
+                template = self.to_json(minify, parameters)
+            else:
+                template = self.to_yaml(minify, parameters)
+            s.set(bytes=len(template))
+        self._template_cache[key] = template
+        return template
+
+    def size_report(self):
+        """
+        Compares the size of the template rendered normally and minified in
+        the current render format
+        :return: SizeReport with byte counts
+        """
+        render_type = 'json' if self.render_type == 'json-compact' else self.render_type
+        original = len(self.get_template(render_type, minify=False).encode('utf-8'))
+        minified = len(self.get_template(render_type, minify=True).encode('utf-8'))
+        return SizeReport(render_type, original, minified, original - minified)
+
+    def template_digest(self, parameters=None):
+        """
+        Stable digest of the canonical rendered template and the parameters
+        :param parameters: Dict of template parameter values
+        :return: Hex encoded SHA-256 digest
+        """
+        with instrumentation.span('template_digest') as s:
+            canonical = json.dumps({'Template': self.get_template_dict(),
+                                    'Parameters': parameters or {}},
+                                   cls=ValleyEncoderNoType, sort_keys=True,
+                                   separators=(',', ':'))
+            s.set(bytes=len(canonical))
+            return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def state_key(self, stack_name):
+        return '{}/{}'.format(self._aws_config[0], stack_name)
+
+    def get_deployed_digest(self, stack_name, stack=None):
+        """
+        Returns the digest recorded for the last successful publish of the stack
+        :param stack_name: Name of the CloudFormation stack
+        :param stack: Stack description from describe_stack, used for the tag store
+        :return: str or None
+        """
+        if self.digest_store == 'file':
+            return state.read_digest(self.state_file, self.state_key(stack_name))
+        for tag in (stack or {}).get('Tags', []):
+            if tag['Key'] == DIGEST_TAG:
+                return tag['Value']
+
+    def upload_template(self, template=None, extension=None):
+        """
+        Uploads the rendered template to template_bucket under a key derived
+        from its content. The upload is skipped if that key already exists.
+        :param template: Rendered template, defaults to get_template()
+        :param extension: File extension of the key, defaults to template_extension
+        :return: HTTPS URL of the template object
+        """
+        body = (template or self.get_template()).encode('utf-8')
+        key = '{}{}.{}'.format(self.template_prefix, hashlib.sha256(body).hexdigest(),
+                               extension or self.template_extension)
+        obj = self.s3.Object(self.template_bucket, key)
+        with instrumentation.span('upload_template', bytes=len(body), uploaded=False) as s:
+            try:
+                instrumentation.call('s3.head_object', obj.load)
+            except clients.client_error() as e:
+                if e.response['Error']['Code'] not in S3_MISSING_CODES:
+                    raise e
+                instrumentation.call('s3.put_object', obj.put, Body=body)
+                s.set(uploaded=True)
+        return 'https://{}.s3.{}.amazonaws.com/{}'.format(
+            self.template_bucket, self._aws_config[0], key)
+
+    def template_source(self, result=None, parameters=None):
+        """
+        Chooses how the template is passed to CloudFormation. Templates over
+        the inline size limit, or all templates when upload_all_templates is
+        set, are uploaded to template_bucket and passed by URL.
+        :param result: Optional PublishResult that records the URL and upload time
+        :param parameters: Dict of parameter values the stack is published with
+        :return: Dict with either TemplateBody or TemplateURL
+        """
+        template = self.get_template(parameters=parameters)
+        oversized = len(template.encode('utf-8')) > TEMPLATE_BODY_LIMIT
+        if not self.template_bucket:
+            if oversized:
+                raise DeployFailedError(
+                    'The template is larger than {} bytes. Set template_bucket '
+                    'to publish it through S3.'.format(TEMPLATE_BODY_LIMIT))
+            return {'TemplateBody': template}
+        if not (oversized or self.upload_all_templates):
+            return {'TemplateBody': template}
+        started = time.monotonic()
+        url = self.upload_template(template)
+        if result is not None:
+            result.template_url = url
+            result.timings['upload'] = time.monotonic() - started
+        return {'TemplateURL': url}
+
+    def get_deployed_template(self, stack_name):
+        """
+        Fetches the template a stack was last deployed with, before transforms
+        :param stack_name: Name or ID of the stack
+        :return: Template dict, empty if the stack does not exist
+        """
+        from sammy.diff import load_template
+
+        try:
+            body = instrumentation.call(
+                'cloudformation.get_template', self.cf_client.get_template,
+                StackName=stack_name, TemplateStage='Original')['TemplateBody']
+        except clients.client_error() as e:
+            if 'does not exist' in str(e):
+                return {}
+            raise e
+        return load_template(body)
+
+    def diff(self, stack_name=None, template=None):
+        """
+        Predicts the resource changes publishing would make without creating
+        a changeset
+        :param stack_name: Stack whose deployed template is fetched and compared
+        :param template: Saved template (dict, body or file path) to compare against instead
+        :return: TemplateDiff
+        """
+        from sammy.diff import diff as diff_templates
+
+        if template is None:
+            template = self.get_deployed_template(stack_name)
+        return diff_templates(template, json.loads(self.get_template('json')))
+
+    def package(self, bucket=None, prefix=None, jobs=None):
+        """
+        Zips the function code given as local paths, uploads the archives
+        that are not in S3 yet and points the functions at them. publish
+        calls this before rendering the template.
+        :param bucket: Name of the S3 bucket, defaults to code_bucket or else template_bucket
+        :param prefix: Prefix of the object keys, defaults to code_prefix
+        :param jobs: Number of zip worker processes, defaults to the number of CPUs
+        :return: List of sammy.packaging.PackagedCode
+        """
+        from sammy import packaging
+
+        if not packaging.local_code(self):
+            return []
+        bucket = bucket or self.code_bucket or self.template_bucket
+        if not bucket:
+            raise DeployFailedError('Function code given as a local path is published '
+                                    'through S3. Set code_bucket.')
+        return packaging.package(self, bucket, self.code_prefix if prefix is None else prefix,
+                                 jobs)
+
+    def partition(self, max_resources=None, max_bytes=None, prefix='Stack'):
+        """
+        Splits the template into nested stack templates along its reference graph
+        :param max_resources: Most resources per child template, CloudFormation's limit by default
+        :param max_bytes: Most bytes of resources per child template
+        :param prefix: Prefix of the nested stack logical IDs
+        :return: sammy.partition.NestedStacks
+        """
+        from sammy import partition
+
+        return partition.partition(json.loads(self.get_template('json')),
+                                   max_resources or partition.MAX_RESOURCES,
+                                   max_bytes or partition.MAX_BYTES, prefix)
+
+    def publish_nested(self, stack_name, parameters=None, max_resources=None, max_bytes=None):
+        """
+        Partitions the template, uploads the child templates to template_bucket
+        and publishes a parent stack that deploys them as nested stacks
+        :param stack_name: Name of the parent CloudFormation stack
+        :param parameters: Dict of template parameter values
+        :param max_resources: Most resources per child template
+        :param max_bytes: Most bytes of resources per child template
+        :return: PublishResult of the parent stack
+        """
+        from sammy.partition import ParentStack
+
+        if not self.template_bucket:
+            raise DeployFailedError('Nested stack templates are published through S3. '
+                                    'Set template_bucket.')
+        self.package()
+        nested = self.partition(max_resources, max_bytes)
+        urls = {name: self.upload_template(json.dumps(child, separators=(',', ':')), 'json')
+                for name, child in nested.children.items()}
+        parent = ParentStack(self, nested.parent_template(urls))
+        return parent.publish_stack(stack_name, parameters)
 
     def has_stack(self, stack_name):
         """
@@ -483,11 +1448,20 @@ class SAM(SAMSchema):
         :param stack_name: Name or ID of the stack
         :return: True if stack exists. False otherwise
         """
+        return self.describe_stack(stack_name) is not None
+
+    def describe_stack(self, stack_name):
+        """
+        Describes a CloudFormation stack
+        :param stack_name: Name or ID of the stack
+        :return: Stack description dict or None if the stack does not exist
+        """
         cf = self.cf_client
         try:
-            resp = cf.describe_stacks(StackName=stack_name)
+            resp = instrumentation.call('cloudformation.describe_stacks', cf.describe_stacks,
+                                        StackName=stack_name)
             if len(resp["Stacks"]) != 1:
-                return False
+                return None
 
             # When you run CreateChangeSet on a a stack that does not exist,
             # CloudFormation will create a stack and set it's status
@@ -496,9 +1470,11 @@ class SAM(SAMSchema):
             # this stack does not exist and call CreateChangeSet will
             # ChangeSetType set to CREATE and not UPDATE.
             stack = resp["Stacks"][0]
-            return stack["StackStatus"] != "REVIEW_IN_PROGRESS"
+            if stack["StackStatus"] == "REVIEW_IN_PROGRESS":
+                return None
+            return stack
 
-        except botocore.exceptions.ClientError as e:
+        except clients.client_error() as e:
             # If a stack does not exist, describe_stacks will throw an
             # exception. Unfortunately we don't have a better way than parsing
             # the exception msg to understand the nature of this exception.
@@ -507,7 +1483,7 @@ class SAM(SAMSchema):
             if "Stack with id {0} does not exist".format(stack_name) in msg:
                 LOG.debug("Stack with id {0} does not exist".format(
                     stack_name))
-                return False
+                return None
             else:
                 # We don't know anything about this exception. Don't handle
                 LOG.debug("Unable to get stack details.", exc_info=e)
@@ -515,137 +1491,229 @@ class SAM(SAMSchema):
 
     def get_changeset_status(self, change_set_name):
         print(change_set_name)
-        response = self.cf_client.describe_change_set(
+        response = instrumentation.call(
+            'cloudformation.describe_change_set', self.cf_client.describe_change_set,
             ChangeSetName=change_set_name,
         )
         return response['Status']
 
     def is_stack_instances_current(self, stackset_name, op_id, no_replication_groups):
-        obj_list = self.cf_client.list_stack_instances(StackSetName=stackset_name)['Summaries']
+        obj_list = list_stack_instances(self.cf_client, stackset_name)
         current_list = len(list(filter(lambda x: x.get('Status') == 'CURRENT', obj_list)))
         if current_list != no_replication_groups:
             print(
                 'Only {} of the {} replication groups (stack instances) are ready yet. '.format(
                     current_list, no_replication_groups),
-                'Checking again in 30 seconds. Stack Name: {}, Operation ID: {}'.format(stackset_name, op_id)
+                'Stack Name: {}, Operation ID: {}'.format(stackset_name, op_id)
             )
             return False
         return True
 
     def get_session(self, profile_name='default'):
-        try:
-            return boto3.Session(profile_name=profile_name)
-        except ProfileNotFound:
-            return boto3.Session()
+        return clients.get_session(profile_name=profile_name)
 
     def get_client(self, service_name, region_name='us-east-1', profile_name='default'):
-        s = self.get_session(profile_name=profile_name)
-        return s.client(service_name, region_name=region_name)
+        return clients.get_client(service_name, region_name=region_name, profile_name=profile_name)
 
-    def get_resource(self, service_name, region_name='us-east-1', profile_name='default'):
-        s = self.get_session(profile_name=profile_name)
-        return s.resource(service_name, region_name=region_name)
+    def get_service_resource(self, service_name, region_name='us-east-1', profile_name='default'):
+        return clients.get_resource(service_name, region_name=region_name, profile_name=profile_name)
 
-    def publish_global(self, stackset_name, replication_groups):
+    def publish_global(self, stackset_name, replication_groups, operation_preferences=None,
+                       wait=True):
+        """
+        Publishes the template as a stack set with an instance in each region
+        :param stackset_name: Name of the stack set
+        :param replication_groups: List of regions
+        :param operation_preferences: CloudFormation OperationPreferences. Defaults to all regions in parallel with no failures tolerated.
+        :param wait: Block until the rollout finishes. Otherwise return the operation handle right away.
+        :return: StackSetOperation
+        """
+        if operation_preferences is None:
+            operation_preferences = DEFAULT_OPERATION_PREFERENCES
         if not self.check_global_valid():
             raise DeployFailedError('The publish_global method cannot publish SAM templates.')
         # Create Stack Set
         print('Creating {} Stack Set'.format(stackset_name))
 
-        self.cf_client.create_stack_set(
+        instrumentation.call(
+            'cloudformation.create_stack_set', self.cf_client.create_stack_set,
             StackSetName=stackset_name,
-            TemplateBody=self.get_template(),
+            **self.template_source()
         )
         # Create Stack Instances
         print('Creating {} Stack Instances'.format(stackset_name))
-        op_id = self.cf_client.create_stack_instances(
+        account = instrumentation.call('sts.get_caller_identity',
+                                       self.sts.get_caller_identity).get('Account')
+        op_id = instrumentation.call(
+            'cloudformation.create_stack_instances', self.cf_client.create_stack_instances,
             StackSetName=stackset_name,
-            Accounts=[
-                self.sts.get_caller_identity().get('Account')
-            ],
-            Regions=replication_groups
+            Accounts=[account],
+            Regions=replication_groups,
+            OperationPreferences=operation_preferences
         )['OperationId']
-        # Number of Replication Groups
-        no_replication_groups = len(replication_groups)
+        operation = StackSetOperation(self.cf_client, stackset_name, op_id, replication_groups,
+                                      self.stackset_wait, operation_preferences)
+        if not wait:
+            return operation
         # Wait until all stack instances are created.
-        while not self.is_stack_instances_current(stackset_name, op_id, no_replication_groups):
-            time.sleep(30)
-        print('Stack Set Creation Completed')
+        return operation.wait()
+
+    def get_stack_status(self, stack_name):
+        response = instrumentation.call('cloudformation.describe_stacks',
+                                        self.cf_client.describe_stacks, StackName=stack_name)
+        return response['Stacks'][0]['StackStatus']
+
+    def wait_for_changeset(self, change_set_name):
+        def check():
+            response = self.get_changeset_status(change_set_name)
+            print(str(response))
+            if response in CHANGESET_DONE_STATUSES:
+                return response
+        with instrumentation.span('changeset_wait') as s:
+            result = self.changeset_wait.wait(check, 'changeset {}'.format(change_set_name))
+            s.set(polls=result.polls)
+        return result
+
+    def wait_for_stack(self, stack_name, tail=None):
+        """
+        Follows the stack events until the stack operation finishes
+        :param stack_name: Name of the CloudFormation stack
+        :param tail: StackEventTail marked before the operation started. Without one the latest stack event decides.
+        :return: WaitResult with the final stack status
+        """
+        if tail is None:
+            tail = StackEventTail(self.cf_client, stack_name)
+        with instrumentation.span('stack_wait') as s:
+            result = self.stack_wait.wait(tail.poll, 'stack {}'.format(stack_name))
+            s.set(polls=result.polls)
+        return result
 
     def publish(self, stack_name, **kwargs):
-        param_list = [{'ParameterKey': k, 'ParameterValue': v} for k, v in kwargs.items()]
+        with instrumentation.SpanCollector() as collector:
+            try:
+                return self.publish_stack(stack_name, kwargs).stack
+            finally:
+                if self.print_timings:
+                    print(collector.breakdown())
+
+    def publish_stack(self, stack_name, parameters=None):
+        """
+        Creates and executes a changeset for the stack
+        :param stack_name: Name of the CloudFormation stack
+        :param parameters: Dict of template parameter values
+        :return: PublishResult
+        """
+        parameters = parameters or {}
+        param_list = [{'ParameterKey': k, 'ParameterValue': v} for k, v in parameters.items()]
         changeset_name = self.changeset_prefix + str(int(time.time()))
-        if self.has_stack(stack_name):
+        stack = self.describe_stack(stack_name)
+        if stack is not None:
             changeset_type = "UPDATE"
         else:
             changeset_type = "CREATE"
 
         cf = self.cf_client
-
-        resp = cf.create_change_set(StackName=stack_name, TemplateBody=self.get_template(),
-                                    Parameters=param_list, ChangeSetName=changeset_name,
-                                    Capabilities=['CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM'],
-                                    ChangeSetType=changeset_type)
-        change_set_name = resp['Id']
-
-        result = ChangeSetResult(resp["Id"], changeset_type)
+        result = PublishResult(stack_name)
+        result.changeset_type = changeset_type
+        changeset_kwargs = {}
+
+        started = time.monotonic()
+        if self.package():
+            result.timings['package'] = time.monotonic() - started
+
+        if self.skip_unchanged:
+            if self.digest_store not in DIGEST_STORES:
+                raise ValueError('digest_store must be one of {}'.format(', '.join(DIGEST_STORES)))
+            started = time.monotonic()
+            result.digest = self.template_digest(parameters)
+            deployed_digest = self.get_deployed_digest(stack_name, stack)
+            result.timings['digest'] = time.monotonic() - started
+            if result.digest == deployed_digest and is_stable(stack):
+                print('Stack {} is unchanged, skipping publish'.format(stack_name))
+                result.skipped = True
+                result.status = stack['StackStatus']
+                result.stack = self.cf_resource.Stack(stack_name)
+                return result
+            if self.digest_store == 'tag':
+                tags = [i for i in (stack or {}).get('Tags', []) if i['Key'] != DIGEST_TAG]
+                tags.append({'Key': DIGEST_TAG, 'Value': result.digest})
+                changeset_kwargs['Tags'] = tags
+
+        changeset_kwargs.update(self.template_source(result, parameters))
+        resp = instrumentation.call(
+            'cloudformation.create_change_set', cf.create_change_set, StackName=stack_name,
+            Parameters=param_list, ChangeSetName=changeset_name,
+            Capabilities=self.capabilities,
+            ChangeSetType=changeset_type, **changeset_kwargs)
+        result.changeset_id = resp['Id']
 
         sys.stdout.write("Waiting for {} changeset {} to complete\n".format(
             stack_name, changeset_type.lower()))
 
         sys.stdout.flush()
 
-        while True:
-            response = self.get_changeset_status(change_set_name)
-            print(str(response))
-            time.sleep(10)
-            if response in ['CREATE_COMPLETE', 'FAILED']:
-                print('Changeset {}'.format(response))
-                break
+        response, result.polls['changeset'], result.timings['changeset'] = \
+            self.wait_for_changeset(result.changeset_id)
+        print('Changeset {}'.format(response))
 
         if response == 'CREATE_COMPLETE':
-            cf.execute_change_set(
+            tail = StackEventTail(cf, stack_name)
+            tail.mark()
+            instrumentation.call(
+                'cloudformation.execute_change_set', cf.execute_change_set,
                 ChangeSetName=result.changeset_id,
                 StackName=stack_name)
 
             sys.stdout.write("Waiting for {} stack {} to complete\n".format(
                 stack_name, changeset_type.lower()))
             sys.stdout.flush()
-            # Pick the right waiter
-            if changeset_type == "CREATE":
-                waiter = cf.get_waiter("stack_create_complete")
-            elif changeset_type == "UPDATE":
-                waiter = cf.get_waiter("stack_update_complete")
-            else:
-                raise RuntimeError("Invalid changeset type {0}"
-                                   .format(changeset_type))
-            try:
-                waiter.wait(StackName=stack_name,
-                            WaiterConfig={'Delay': 5, 'MaxAttempts': 720})
-            except botocore.exceptions.WaiterError as ex:
-                LOG.debug("Execute changeset waiter exception", exc_info=ex)
-                raise DeployFailedError
-
-            return self.cf_resource.Stack(stack_name)
+            result.status, result.polls['execute'], result.timings['execute'] = \
+                self.wait_for_stack(stack_name, tail)
+            result.events = tail.events
+            result.resource_durations = tail.durations
+            if result.status != '{}_COMPLETE'.format(changeset_type):
+                message = 'Stack {} finished with status {}'.format(stack_name, result.status)
+                if tail.failure is not None:
+                    message = '{}. First failure: {}'.format(message, tail.failure_reason())
+                raise StackFailedError(message, result.status, tail.failure)
+            if tail.durations:
+                print('Slowest resources: {}'.format(', '.join(
+                    '{} {:.0f}s'.format(*i) for i in tail.slowest())))
+
+            if self.skip_unchanged and self.digest_store == 'file':
+                state.write_digest(self.state_file, self.state_key(stack_name), result.digest)
+            result.stack = self.cf_resource.Stack(stack_name)
         else:
             # Print the reason for failure
-            print(cf.describe_change_set(
-                ChangeSetName=change_set_name,
-            )['StatusReason'])
+            result.status = response
+            result.status_reason = instrumentation.call(
+                'cloudformation.describe_change_set', cf.describe_change_set,
+                ChangeSetName=result.changeset_id,
+            )['StatusReason']
+            print(result.status_reason)
+            if result.no_changes and self.skip_unchanged and self.digest_store == 'file':
+                state.write_digest(self.state_file, self.state_key(stack_name), result.digest)
+        return result
 
     def unpublish(self, stack_name):
         print('Deleting {} stack'.format(stack_name))
-        self.cf_client.delete_stack(StackName=stack_name)
+        instrumentation.call('cloudformation.delete_stack', self.cf_client.delete_stack,
+                             StackName=stack_name)
 
-    def to_yaml(self):
-        jd = json.dumps(self.get_template_dict(), cls=ValleyEncoderNoType)
-        # TODO: Write this without converting to JSON first
-        jl = json.loads(jd)
-        return yaml.safe_dump(jl,
-                              default_flow_style=False)
+    def to_yaml(self, minify=False, parameters=None):
+        # PyYAML is only imported once a template is rendered as YAML
+        from sammy import dumper
 
-    def to_json(self):
-        return json.dumps(self.get_template_dict(), cls=ValleyEncoderNoType)
+        template = self.get_template_dict(minify, parameters)
+        if minify:
+            return dumper.dump(template, default_flow_style=True, width=YAML_MAX_WIDTH)
+        return dumper.dump(template, default_flow_style=False)
+
+    def to_json(self, minify=False, parameters=None):
+        template = self.get_template_dict(minify, parameters)
+        if minify:
+            return json.dumps(template, cls=ValleyEncoderNoType, separators=(',', ':'))
+        return json.dumps(template, cls=ValleyEncoderNoType)
 
 
 class CFT(SAM):
@@ -653,19 +1721,15 @@ class CFT(SAM):
 
     outputs = ForeignInstanceListProperty(Output)
 
-    def add_output(self, output):
-        self._base_properties.get('outputs').validate([output], 'outputs')
-        outputs = self._data.get('outputs') or []
-        outputs.append(output)
-        outputs = set(outputs)
-        self._data['outputs'] = list(outputs)
+    _registries = SAM._registries + ('outputs',)
 
-    def to_dict(self):
-        template = super(CFT, self).to_dict()
-        obj = remove_nulls(self._data.copy())
-        if obj.get('outputs'):
-            pl = [i.to_dict() for i in obj.get('outputs')]
-            outputs = {i.get('name'): i.get('r') for i in pl}
-            if len(outputs.keys()) > 0:
-                template['Outputs'] = outputs
+    def add_output(self, output, replace=False):
+        self.validate_items('outputs', [output])
+        self.register('outputs', [output], replace=replace)
+
+    def to_dict(self, resources=None):
+        template = super(CFT, self).to_dict(resources)
+        if self._data['outputs']:
+            template['Outputs'] = {name: i.render()['r']
+                                   for name, i in self._data['outputs'].items()}
         return template
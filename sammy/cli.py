@@ -0,0 +1,291 @@
+"""
+Command line interface.
+
+    sammy render sammy.examples.hello_world 'templates/*.py:sam' -o build -f yaml
+"""
+import argparse
+import glob
+import hashlib
+import importlib
+import importlib.util
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from sammy import __version__
+
+
+MANIFEST = '.sammy-render.json'
+
+RENDERED = 'rendered'
+UNCHANGED = 'unchanged'
+FAILED = 'failed'
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def add_cwd_to_path():
+    # Modules in the working directory can be rendered like installed ones
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+
+
+class Target(object):
+    """
+    A SAM object to render, given as module:attribute or path.py:attribute.
+    The attribute defaults to sam. Targets that cannot be found keep the
+    reason in error and are reported as failed.
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.error = None
+        module, _, self.attribute = spec.partition(':')
+        self.attribute = self.attribute or 'sam'
+        if module.endswith('.py'):
+            self.path = os.path.abspath(module)
+            relative = os.path.splitext(os.path.relpath(self.path))[0]
+            if relative.startswith(os.pardir):
+                relative = os.path.basename(relative)
+            self.module = relative.replace(os.sep, '.')
+            if not os.path.isfile(self.path):
+                self.error = 'Cannot find file {}'.format(module)
+        else:
+            self.module = module
+            try:
+                found = importlib.util.find_spec(module)
+            except (ImportError, ValueError):
+                found = None
+            self.path = found.origin if found is not None else None
+            if not self.path:
+                self.error = 'Cannot find module {}'.format(module)
+
+    def __repr__(self):
+        return '<Target: {} >'.format(self.name)
+
+    @property
+    def name(self):
+        if self.attribute == 'sam':
+            return self.module
+        return '{}.{}'.format(self.module, self.attribute)
+
+    def load(self):
+        if self.spec.partition(':')[0].endswith('.py'):
+            spec = importlib.util.spec_from_file_location(self.module, self.path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        else:
+            module = importlib.import_module(self.module)
+        return getattr(module, self.attribute)
+
+
+def expand_targets(specs):
+    """
+    Expands globs of Python files into targets, keeping the attribute suffix
+    :param specs: module:attribute strings or globs such as templates/*.py
+    :return: List of Target
+    """
+    targets = []
+    for spec in specs:
+        pattern, sep, attribute = spec.partition(':')
+        if pattern.endswith('.py') and glob.has_magic(pattern):
+            paths = sorted(glob.glob(pattern))
+            if not paths:
+                target = Target(spec)
+                target.error = 'No files match {}'.format(pattern)
+                targets.append(target)
+            targets.extend(Target(i + sep + attribute) for i in paths
+                           if os.path.basename(i) != '__init__.py')
+        else:
+            targets.append(Target(spec))
+    return targets
+
+
+def options_digest(target, render_type, minify):
+    h = hashlib.sha256(file_digest(target.path).encode('utf-8'))
+    h.update(json.dumps([target.spec, render_type, minify, __version__]).encode('utf-8'))
+    return h.hexdigest()
+
+
+def first_party_sources(roots, exclude=None):
+    """
+    Finds the source files of the imported modules that live under the given
+    directories, leaving out installed packages and the standard library.
+    Workers are reused, so modules imported for earlier targets may be
+    included, which only costs an extra render when they change.
+    :param roots: Directories of first-party code
+    :param exclude: Source path to leave out, such as the target's own
+    :return: Dict of source path to its digest
+    """
+    roots = tuple(os.path.join(os.path.abspath(i), '') for i in roots)
+    installed = tuple(os.path.join(i, '') for i in {sys.prefix, sys.base_prefix, sys.exec_prefix})
+    sources = {}
+    for module in list(sys.modules.values()):
+        path = getattr(module, '__file__', None)
+        if not path or not path.endswith('.py'):
+            continue
+        path = os.path.abspath(path)
+        if path == exclude or not path.startswith(roots) or path.startswith(installed) or \
+                'site-packages' in path.split(os.sep):
+            continue
+        sources[path] = file_digest(path)
+    return sources
+
+
+def render_target(target, output_dir, render_type=None, minify=None):
+    """
+    Imports and renders one target, writing its template to output_dir.
+    Runs in a worker process.
+    :return: Dict with the output path, its digest, the byte count, the digests of the
+        first-party modules imported and the seconds spent importing and rendering
+    """
+    add_cwd_to_path()
+    started = time.perf_counter()
+    sam = target.load()
+    loaded = time.perf_counter()
+    render_type = render_type or sam.render_type
+    body = sam.get_template(render_type, minify).encode('utf-8')
+    rendered = time.perf_counter()
+    extension = 'json' if render_type.startswith('json') else 'yaml'
+    path = os.path.join(output_dir, '{}.{}'.format(target.name, extension))
+    with open(path, 'wb') as f:
+        f.write(body)
+    dependencies = first_party_sources([os.getcwd(), os.path.dirname(target.path)], target.path)
+    return {'output': path, 'output_digest': hashlib.sha256(body).hexdigest(),
+            'bytes': len(body), 'dependencies': dependencies,
+            'import': loaded - started, 'render': rendered - loaded}
+
+
+def read_manifest(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def is_unchanged(entry, source_digest):
+    if not entry or entry.get('source_digest') != source_digest:
+        return False
+    for path, digest in entry.get('dependencies', {}).items():
+        if not os.path.isfile(path) or file_digest(path) != digest:
+            return False
+    return os.path.exists(entry['output']) and \
+        file_digest(entry['output']) == entry.get('output_digest')
+
+
+def render(specs, output_dir='.', render_type=None, minify=None, jobs=None, force=False):
+    """
+    Renders many targets in a process pool. Targets whose module source,
+    first-party imports, options and sammy version match the manifest, and
+    whose output file is unmodified, are skipped.
+    :param specs: module:attribute strings or globs of Python files
+    :param output_dir: Directory for the templates and the manifest
+    :param render_type: json, yaml or json-compact. Defaults to each object's render_type.
+    :param minify: Minify the templates, defaults to each object's setting
+    :param jobs: Number of worker processes, defaults to the number of CPUs
+    :param force: Render every target
+    :return: List of (Target, result dict) in the given order
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST)
+    manifest = read_manifest(manifest_path)
+    targets = expand_targets(specs)
+    results = {}
+    todo = []
+    for target in targets:
+        if target.error:
+            results[target.spec] = {'status': FAILED, 'error': target.error}
+            manifest.pop(target.spec, None)
+            continue
+        source_digest = options_digest(target, render_type, minify)
+        entry = manifest.get(target.spec)
+        if not force and is_unchanged(entry, source_digest):
+            results[target.spec] = dict(entry, status=UNCHANGED)
+        else:
+            todo.append((target, source_digest))
+
+    if todo:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = {pool.submit(render_target, target, output_dir, render_type, minify):
+                       (target, source_digest) for target, source_digest in todo}
+            for future in as_completed(futures):
+                target, source_digest = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    results[target.spec] = {'status': FAILED, 'error': repr(e)}
+                    manifest.pop(target.spec, None)
+                    continue
+                result.update(status=RENDERED, source_digest=source_digest)
+                results[target.spec] = result
+                manifest[target.spec] = {k: result[k] for k in (
+                    'output', 'output_digest', 'source_digest', 'bytes', 'dependencies')}
+
+    tmp_path = '{}.tmp'.format(manifest_path)
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+    return [(target, results[target.spec]) for target in targets]
+
+
+def summary(results):
+    lines = ['{:<50} {:<10} {:>9} {:>9} {:>10}'.format(
+        'target', 'status', 'import', 'render', 'bytes')]
+    for target, result in results:
+        timings = ['{:.3f}s'.format(result[i]) if i in result else '-'
+                   for i in ('import', 'render')]
+        line = '{:<50} {:<10} {:>9} {:>9} {:>10}'.format(
+            target.name, result['status'], timings[0], timings[1], result.get('bytes', '-'))
+        if result.get('error'):
+            line = '{}  {}'.format(line, result['error'])
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='sammy')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    render_parser = commands.add_parser(
+        'render', help='Render templates defined in Python modules')
+    render_parser.add_argument('targets', nargs='+',
+                               help='module:attribute or a glob of Python files. '
+                                    'The attribute defaults to sam.')
+    render_parser.add_argument('-o', '--output-dir', default='.',
+                               help='Directory the templates are written to')
+    render_parser.add_argument('-f', '--format', choices=['json', 'yaml', 'json-compact'],
+                               help="Render format, defaults to each object's render_type")
+    render_parser.add_argument('--minify', action='store_true', default=None,
+                               help='Minify the templates')
+    render_parser.add_argument('-j', '--jobs', type=int, help='Number of worker processes')
+    render_parser.add_argument('--force', action='store_true',
+                               help='Render targets even if they are unchanged')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    add_cwd_to_path()
+    started = time.perf_counter()
+    results = render(args.targets, args.output_dir, args.format, args.minify,
+                     args.jobs, args.force)
+    print(summary(results))
+    counts = {}
+    for _, result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    print('{} in {:.2f}s'.format(', '.join(
+        '{} {}'.format(v, k) for k, v in sorted(counts.items())), time.perf_counter() - started))
+    return 1 if counts.get(FAILED) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
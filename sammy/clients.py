@@ -0,0 +1,122 @@
+import threading
+
+
+_lock = threading.RLock()
+_sessions = {}
+_clients = {}
+# Resources live as long as their thread. clear() bumps the generation so
+# every thread drops the resources it made before.
+_resources = threading.local()
+_generation = 0
+
+
+def get_session(profile_name='default'):
+    """
+    Returns the shared boto3 session for a profile, falling back to the
+    default credential chain when the profile does not exist.
+    """
+    with _lock:
+        session = _sessions.get(profile_name)
+        if session is None:
+            # boto3 takes long to import, so it is loaded with the first session
+            import boto3
+            from botocore.exceptions import ProfileNotFound
+
+            try:
+                session = boto3.Session(profile_name=profile_name)
+            except ProfileNotFound:
+                session = boto3.Session()
+            _sessions[profile_name] = session
+        return session
+
+
+def get_client(service_name, region_name='us-east-1', profile_name='default'):
+    """
+    Returns a client shared by every caller asking for the same profile,
+    region and service. boto3 clients are thread safe.
+    """
+    key = (profile_name, region_name, service_name)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = get_session(profile_name).client(service_name, region_name=region_name)
+            _clients[key] = client
+        return client
+
+
+def get_resource(service_name, region_name='us-east-1', profile_name='default'):
+    """
+    Returns a service resource for the profile, region and service. boto3
+    resources are not thread safe, so each thread gets its own.
+    """
+    key = (profile_name, region_name, service_name)
+    if getattr(_resources, 'generation', None) != _generation:
+        _resources.generation, _resources.cache = _generation, {}
+    resource = _resources.cache.get(key)
+    if resource is None:
+        # The session is shared, so resources are created under the lock
+        with _lock:
+            resource = get_session(profile_name).resource(service_name, region_name=region_name)
+        _resources.cache[key] = resource
+    return resource
+
+
+class SessionPool(object):
+    """
+    Clients and resources created from one session object, such as a boto3
+    Session or sammy.fake.FakeAWS. Clients are shared and resources are kept
+    per thread, like the pooled ones. Sessions are not thread safe, so both
+    are created under a lock.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._resources = threading.local()
+
+    def __repr__(self):
+        return '<SessionPool: {!r} >'.format(self.session)
+
+    def client(self, service_name, region_name):
+        key = (region_name, service_name)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = self.session.client(service_name, region_name=region_name)
+                self._clients[key] = client
+            return client
+
+    def resource(self, service_name, region_name):
+        key = (region_name, service_name)
+        cache = getattr(self._resources, 'cache', None)
+        if cache is None:
+            cache = self._resources.cache = {}
+        resource = cache.get(key)
+        if resource is None:
+            with self._lock:
+                resource = self.session.resource(service_name, region_name=region_name)
+            cache[key] = resource
+        return resource
+
+
+def client_error():
+    """
+    Returns botocore's ClientError without importing botocore up front. Use
+    it in except clauses, which are only evaluated once an error is raised.
+    """
+    from botocore.exceptions import ClientError
+
+    return ClientError
+
+
+def clear():
+    """
+    Drops every cached session, client and resource
+    """
+    global _generation
+
+    with _lock:
+        _sessions.clear()
+        _clients.clear()
+        _generation += 1
@@ -20,6 +20,22 @@ class ForeignSubclassListValidator(ForeignListValidator):
 
 
 
+class ForeignClassValidator(ForeignValidator):
+    """
+    ForeignValidator that also accepts a tuple of classes
+    """
+
+    def validate(self, value, key):
+        if value:
+            if not isinstance(value, self.foreign_class):
+                if isinstance(self.foreign_class, tuple):
+                    names = ' or '.join(i.__name__ for i in self.foreign_class)
+                else:
+                    names = self.foreign_class.__name__
+                raise ValidationException('{0}: This value ({1}) should be an instance of {2}.'.format(
+                    key, value, names))
+
+
 class ForeignSubclassListMixin(ListMixin):
 
     def get_validators(self):
@@ -54,7 +70,7 @@ class CharForeignProperty(MultiProperty):
     def __init__(self,foreign_class,**kwargs):
 
         super(CharForeignProperty, self).__init__(
-            validators=[ForeignValidator(foreign_class),
+            validators=[ForeignClassValidator(foreign_class),
                         StringValidator()],**kwargs)
 
 
@@ -63,5 +79,5 @@ class IntForeignProperty(MultiProperty):
     def __init__(self,foreign_class,**kwargs):
 
         super(IntForeignProperty, self).__init__(
-            validators=[ForeignValidator(foreign_class),
+            validators=[ForeignClassValidator(foreign_class),
                         IntegerValidator()],**kwargs)
\ No newline at end of file
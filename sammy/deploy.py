@@ -0,0 +1,213 @@
+import collections
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from sammy import CFT
+
+
+SUCCEEDED = 'SUCCEEDED'
+UNCHANGED = 'UNCHANGED'
+FAILED = 'FAILED'
+SKIPPED = 'SKIPPED'
+
+
+class StackReport(object):
+    """
+    Outcome of a single stack in publish_many
+    """
+
+    def __init__(self, stack_name, depends_on=None):
+        self.stack_name = stack_name
+        self.depends_on = sorted(depends_on or [])
+        self.status = None
+        self.result = None
+        self.error = None
+        self.started = None
+        self.finished = None
+
+    def __repr__(self):
+        return '<StackReport: {} {} >'.format(self.stack_name, self.status)
+
+    @property
+    def duration(self):
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    @property
+    def ok(self):
+        return self.status in (SUCCEEDED, UNCHANGED)
+
+
+class DeployReport(object):
+    """
+    Per-stack reports of a publish_many run, in the order the targets were given
+    """
+
+    def __init__(self, stacks):
+        self.stacks = stacks
+        self.duration = None
+
+    def __iter__(self):
+        return iter(self.stacks.values())
+
+    def __getitem__(self, stack_name):
+        return self.stacks[stack_name]
+
+    @property
+    def ok(self):
+        return all(i.ok for i in self)
+
+    @property
+    def failed(self):
+        return [i for i in self if i.status in (FAILED, SKIPPED)]
+
+    def summary(self):
+        lines = []
+        for i in self:
+            duration = '' if i.duration is None else '{:.1f}s'.format(i.duration)
+            line = '{:<40} {:<10} {:>8}'.format(i.stack_name, i.status, duration)
+            if i.error is not None:
+                line = '{}  {}'.format(line, i.error)
+            lines.append(line)
+        return '\n'.join(lines)
+
+
+def find_intrinsics(node, name):
+    """
+    Yields the arguments of every intrinsic function with the given name in a
+    rendered template
+    :param node: Template dict or any value inside it, intrinsics may be objects
+    :param name: Intrinsic function name such as Fn::ImportValue
+    """
+    if hasattr(node, 'to_dict'):
+        node = node.to_dict()
+    if isinstance(node, dict):
+        for k, v in node.items():
+            if k == name:
+                yield v
+            for i in find_intrinsics(v, name):
+                yield i
+    elif isinstance(node, list):
+        for i in node:
+            for j in find_intrinsics(i, name):
+                yield j
+
+
+def infer_dependencies(targets):
+    """
+    Finds stacks that import an export declared by another target. Only
+    literal export names are matched.
+    :param targets: List of (SAM, stack_name, params) tuples
+    :return: Dict of stack name to a set of stack names it depends on
+    """
+    exporters = {}
+    templates = {}
+    for sam, stack_name, params in targets:
+        # Uses the cached resource renders that the publish reuses
+        templates[stack_name] = sam.get_template_dict(parameters=params)
+        if isinstance(sam, CFT):
+            for output in sam.outputs:
+                export_name = (output.Export or {}).get('Name')
+                if isinstance(export_name, str):
+                    exporters[export_name] = stack_name
+
+    dependencies = {}
+    for stack_name, template in templates.items():
+        for export_name in find_intrinsics(template, 'Fn::ImportValue'):
+            exporter = exporters.get(export_name) if isinstance(export_name, str) else None
+            if exporter is not None and exporter != stack_name:
+                dependencies.setdefault(stack_name, set()).add(exporter)
+    return dependencies
+
+
+def check_acyclic(dependencies):
+    visiting, done = set(), set()
+
+    def visit(name, path):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError('Stack dependency cycle: {}'.format(' -> '.join(path + [name])))
+        visiting.add(name)
+        for i in dependencies.get(name, ()):
+            visit(i, path + [name])
+        visiting.discard(name)
+        done.add(name)
+
+    for name in dependencies:
+        visit(name, [])
+
+
+def publish_stack(sam, report, params):
+    report.started = time.time()
+    try:
+        report.result = sam.publish_stack(report.stack_name, params or {})
+        if report.result.skipped:
+            report.status = UNCHANGED
+        elif report.result.stack is not None:
+            report.status = SUCCEEDED
+        elif report.result.no_changes:
+            report.status = UNCHANGED
+        else:
+            report.status = FAILED
+            report.error = report.result.status_reason
+    except Exception as e:
+        report.status = FAILED
+        report.error = e
+    report.finished = time.time()
+    return report
+
+
+def publish_many(targets, dependencies=None, max_workers=4, infer=True):
+    """
+    Publishes many stacks concurrently. A stack starts once every stack it
+    depends on has succeeded or was unchanged, and is skipped when one of
+    them failed.
+    :param targets: Iterable of (SAM, stack_name, params) tuples, params being a dict of template parameters
+    :param dependencies: Dict of stack name to stack names it depends on. Names that are not targets are ignored.
+    :param max_workers: Maximum number of stacks deployed at the same time
+    :param infer: Also add dependencies found through Fn::ImportValue of other targets' exports
+    :return: DeployReport
+    """
+    targets = list(targets)
+    names = [i[1] for i in targets]
+    if len(set(names)) != len(names):
+        raise ValueError('Each stack can only be published once per run.')
+
+    graph = {i: set() for i in names}
+    if infer:
+        for k, v in infer_dependencies(targets).items():
+            graph[k].update(v)
+    for k, v in (dependencies or {}).items():
+        if k in graph:
+            graph[k].update(i for i in v if i in graph)
+    check_acyclic(graph)
+
+    reports = collections.OrderedDict(
+        (name, StackReport(name, graph[name])) for name in names)
+    waiting = collections.OrderedDict((i[1], i) for i in targets)
+    running = {}
+    start = time.time()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while waiting or running:
+            for name, (sam, stack_name, params) in list(waiting.items()):
+                deps = [reports[i] for i in graph[name]]
+                if any(i.status in (FAILED, SKIPPED) for i in deps):
+                    reports[name].status = SKIPPED
+                    reports[name].error = 'Dependency failed: {}'.format(', '.join(
+                        i.stack_name for i in deps if not i.ok))
+                    del waiting[name]
+                elif all(i.ok for i in deps):
+                    running[pool.submit(publish_stack, sam, reports[name], params)] = name
+                    del waiting[name]
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+
+    report = DeployReport(reports)
+    report.duration = time.time() - start
+    return report
@@ -0,0 +1,205 @@
+import collections
+import json
+import os
+
+import yaml
+
+try:
+    from yaml import CSafeLoader as BaseLoader
+except ImportError:
+    from yaml import SafeLoader as BaseLoader
+
+
+ADD = 'Add'
+REMOVE = 'Remove'
+MODIFY = 'Modify'
+
+# Properties whose change makes CloudFormation replace the resource
+REPLACEMENT_PROPERTIES = {
+    'AWS::DynamoDB::Table': ('TableName', 'KeySchema', 'LocalSecondaryIndexes'),
+    'AWS::IAM::Role': ('RoleName', 'Path'),
+    'AWS::Lambda::Function': ('FunctionName',),
+    'AWS::S3::Bucket': ('BucketName',),
+    'AWS::SNS::Topic': ('TopicName', 'FifoTopic'),
+    'AWS::SQS::Queue': ('QueueName', 'FifoQueue'),
+    'AWS::Serverless::Function': ('FunctionName',),
+    'AWS::Serverless::SimpleTable': ('TableName', 'PrimaryKey'),
+}
+
+PropertyChange = collections.namedtuple("PropertyChange", ["name", "old", "new"])
+
+
+class TemplateLoader(BaseLoader):
+    """
+    YAML loader that understands CloudFormation short form intrinsic tags
+    """
+
+
+def construct_intrinsic(loader, tag_suffix, node):
+    if isinstance(node, yaml.ScalarNode):
+        value = loader.construct_scalar(node)
+    elif isinstance(node, yaml.SequenceNode):
+        value = loader.construct_sequence(node, deep=True)
+    else:
+        value = loader.construct_mapping(node, deep=True)
+    if tag_suffix in ('Ref', 'Condition'):
+        return {tag_suffix: value}
+    if tag_suffix == 'GetAtt' and isinstance(value, str):
+        value = value.split('.', 1)
+    return {'Fn::{}'.format(tag_suffix): value}
+
+
+TemplateLoader.add_multi_constructor('!', construct_intrinsic)
+
+
+def load_template(source):
+    """
+    Loads a template from a dict, a JSON or YAML string or a file path
+    :param source: Template dict, template body or path of a saved template
+    :return: dict
+    """
+    if isinstance(source, dict):
+        return source
+    if os.path.isfile(source):
+        with open(source, 'r') as f:
+            source = f.read()
+    if source.lstrip().startswith('{'):
+        return json.loads(source)
+    return yaml.load(source, Loader=TemplateLoader) or {}
+
+
+def contains_intrinsic(value):
+    if isinstance(value, dict):
+        if any(k == 'Ref' or k.startswith('Fn::') for k in value):
+            return True
+        return any(contains_intrinsic(i) for i in value.values())
+    if isinstance(value, list):
+        return any(contains_intrinsic(i) for i in value)
+    return False
+
+
+class ResourceChange(object):
+    """
+    Predicted change of one resource. replacement is 'True', 'False' or
+    'Conditional', like CloudFormation changesets report it; Conditional
+    means a replacement property changed but depends on intrinsic values.
+    """
+
+    def __init__(self, logical_id, action, resource_type, properties=None, replacement=None):
+        self.logical_id = logical_id
+        self.action = action
+        self.resource_type = resource_type
+        self.properties = properties or []
+        self.replacement = replacement
+
+    def __repr__(self):
+        return '<ResourceChange: {} {} >'.format(self.action, self.logical_id)
+
+    def __str__(self):
+        symbol = {ADD: '+', REMOVE: '-', MODIFY: '~'}[self.action]
+        line = '{} {} ({})'.format(symbol, self.logical_id, self.resource_type)
+        if self.properties:
+            line = '{} {}'.format(line, ', '.join(i.name for i in self.properties))
+        if self.replacement in ('True', 'Conditional'):
+            line = '{} [replacement: {}]'.format(line, self.replacement)
+        return line
+
+
+class TemplateDiff(object):
+    """
+    Resource level differences between two templates
+    """
+
+    def __init__(self, changes):
+        self.changes = changes
+
+    def __iter__(self):
+        return iter(self.changes)
+
+    def __len__(self):
+        return len(self.changes)
+
+    def __bool__(self):
+        return bool(self.changes)
+
+    def __str__(self):
+        return '\n'.join(str(i) for i in self.changes)
+
+    def by_action(self, action):
+        return [i for i in self.changes if i.action == action]
+
+    @property
+    def added(self):
+        return self.by_action(ADD)
+
+    @property
+    def removed(self):
+        return self.by_action(REMOVE)
+
+    @property
+    def modified(self):
+        return self.by_action(MODIFY)
+
+    @property
+    def replacements(self):
+        return [i for i in self.changes if i.replacement in ('True', 'Conditional')]
+
+
+def diff_resource(logical_id, old, new):
+    old_type, new_type = old.get('Type'), new.get('Type')
+    changes = []
+    old_props, new_props = old.get('Properties') or {}, new.get('Properties') or {}
+    if old_props != new_props:
+        for name in sorted(set(old_props) | set(new_props)):
+            if old_props.get(name) != new_props.get(name):
+                changes.append(PropertyChange(name, old_props.get(name), new_props.get(name)))
+    for key in sorted((set(old) | set(new)) - {'Type', 'Properties'}):
+        if old.get(key) != new.get(key):
+            changes.append(PropertyChange(key, old.get(key), new.get(key)))
+
+    if old_type != new_type:
+        replacement = 'True'
+    else:
+        replacement = 'False'
+        replaced_by = REPLACEMENT_PROPERTIES.get(new_type, ())
+        for change in changes:
+            if change.name in replaced_by:
+                if contains_intrinsic(change.old) or contains_intrinsic(change.new):
+                    replacement = 'Conditional'
+                else:
+                    replacement = 'True'
+                    break
+    return ResourceChange(logical_id, MODIFY, new_type, changes, replacement)
+
+
+def resources(template):
+    """
+    :return: Resources of a loaded template with its Globals applied
+    """
+    if template.get('Globals'):
+        from sammy.hoisting import expand
+
+        template = expand(template)
+    return template.get('Resources') or {}
+
+
+def diff(old_template, new_template):
+    """
+    Compares the resources of two templates without calling AWS. Globals are
+    applied first, so moving values into or out of Globals is not a change.
+    :param old_template: Deployed template as a dict, template body or file path
+    :param new_template: New template as a dict, template body or file path
+    :return: TemplateDiff
+    """
+    old = resources(load_template(old_template))
+    new = resources(load_template(new_template))
+    changes = []
+    for logical_id, resource in new.items():
+        if logical_id not in old:
+            changes.append(ResourceChange(logical_id, ADD, resource.get('Type')))
+        elif old[logical_id] != resource:
+            changes.append(diff_resource(logical_id, old[logical_id], resource))
+    for logical_id, resource in old.items():
+        if logical_id not in new:
+            changes.append(ResourceChange(logical_id, REMOVE, resource.get('Type')))
+    return TemplateDiff(changes)
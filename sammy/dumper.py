@@ -0,0 +1,36 @@
+import collections
+
+import yaml
+from valley.contrib import Schema
+from yaml.representer import SafeRepresenter
+
+try:
+    from yaml import CSafeDumper as BaseDumper
+except ImportError:
+    from yaml import SafeDumper as BaseDumper
+
+from sammy import Intrinsic
+
+
+class TemplateDumper(BaseDumper):
+    """
+    YAML dumper that renders valley schema objects inline. Aliases are never
+    emitted because CloudFormation rejects YAML anchors.
+    """
+
+    def ignore_aliases(self, data):
+        return True
+
+
+def represent_schema(dumper, data):
+    return dumper.represent_dict(data.to_dict())
+
+
+TemplateDumper.add_multi_representer(Schema, represent_schema)
+TemplateDumper.add_multi_representer(Intrinsic, represent_schema)
+TemplateDumper.add_representer(collections.OrderedDict, SafeRepresenter.represent_dict)
+TemplateDumper.add_representer(tuple, SafeRepresenter.represent_list)
+
+
+def dump(data, **kwargs):
+    return yaml.dump(data, Dumper=TemplateDumper, **kwargs)
@@ -0,0 +1,122 @@
+from sammy import instrumentation
+
+
+STACK_RESOURCE_TYPE = 'AWS::CloudFormation::Stack'
+
+
+def format_event(event):
+    line = '{} {} {} {}'.format(event['Timestamp'], event['LogicalResourceId'],
+                                event.get('ResourceType'), event['ResourceStatus'])
+    if event.get('ResourceStatusReason'):
+        line = '{}: {}'.format(line, event['ResourceStatusReason'])
+    return line
+
+
+def is_failure(event):
+    return event['ResourceStatus'].endswith('_FAILED')
+
+
+class StackEventTail(object):
+    """
+    Follows the events of a stack. Each poll pages through
+    describe_stack_events only until the last event already seen, so the
+    stack history is downloaded once. The stack's own events tell when the
+    operation finished, replacing separate describe_stacks calls.
+    """
+
+    def __init__(self, cf_client, stack_name, echo=print):
+        """
+        :param cf_client: CloudFormation client
+        :param stack_name: Name of the stack
+        :param echo: Called with a line per new event, None to stay silent
+        """
+        self.cf_client = cf_client
+        self.stack_name = stack_name
+        self.echo = echo
+        self.last_event_id = None
+        self.events = []
+        self.status = None
+        self.failure = None
+        self.durations = {}
+        self._started = {}
+
+    def __repr__(self):
+        return '<StackEventTail: {} {} >'.format(self.stack_name, self.status)
+
+    def fetch(self, first_page_only=False):
+        """
+        Fetches the events newer than the last seen one
+        :param first_page_only: Stop after the first page, used to skip old history
+        :return: List of new events, oldest first
+        """
+        events = []
+        kwargs = {'StackName': self.stack_name}
+        while True:
+            response = instrumentation.call('cloudformation.describe_stack_events',
+                                            self.cf_client.describe_stack_events, **kwargs)
+            for event in response['StackEvents']:
+                if event['EventId'] == self.last_event_id:
+                    return events[::-1]
+                events.append(event)
+            if first_page_only or not response.get('NextToken'):
+                return events[::-1]
+            kwargs['NextToken'] = response['NextToken']
+
+    def mark(self):
+        """
+        Remembers the newest existing event so later polls only report
+        events of the operation that is about to start
+        """
+        events = self.fetch(first_page_only=True)
+        if events:
+            self.last_event_id = events[-1]['EventId']
+
+    def is_stack_event(self, event):
+        # The stack's own events carry its name as the logical ID and its ARN
+        # as the physical ID, and the stack may be given by either
+        return (event.get('ResourceType') == STACK_RESOURCE_TYPE and
+                self.stack_name in (event['LogicalResourceId'], event.get('PhysicalResourceId')))
+
+    def record(self, event):
+        self.events.append(event)
+        if self.echo is not None:
+            self.echo(format_event(event))
+        logical_id, status = event['LogicalResourceId'], event['ResourceStatus']
+        if self.is_stack_event(event):
+            self.status = status
+            return
+        if status.endswith('_IN_PROGRESS'):
+            self._started.setdefault(logical_id, event['Timestamp'])
+        elif logical_id in self._started:
+            started = self._started.pop(logical_id)
+            # Keep the first operation on a resource, not the cleanup or rollback
+            self.durations.setdefault(
+                logical_id, (event['Timestamp'] - started).total_seconds())
+        if self.failure is None and is_failure(event):
+            self.failure = event
+
+    def poll(self):
+        """
+        Records the new events
+        :return: Final stack status once the operation finished, otherwise None
+        """
+        events = self.fetch()
+        if events:
+            self.last_event_id = events[-1]['EventId']
+        for event in events:
+            self.record(event)
+        if self.status is not None and not self.status.endswith('_IN_PROGRESS'):
+            return self.status
+
+    def slowest(self, count=5):
+        """
+        :return: List of (logical ID, seconds) for the resources that took longest
+        """
+        return sorted(self.durations.items(), key=lambda i: i[1], reverse=True)[:count]
+
+    def failure_reason(self):
+        if self.failure is None:
+            return None
+        return '{} ({}) {}: {}'.format(
+            self.failure['LogicalResourceId'], self.failure.get('ResourceType'),
+            self.failure['ResourceStatus'], self.failure.get('ResourceStatusReason'))
@@ -1,2 +1,46 @@
+from valley.exceptions import ValidationException
+
+
 class DeployFailedError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class StackFailedError(DeployFailedError):
+
+    def __init__(self, message, status=None, failure=None):
+        self.status = status
+        self.failure = failure
+        super(StackFailedError, self).__init__(message)
+
+
+class DuplicateLogicalIdError(Exception):
+    pass
+
+
+class WaitTimeoutError(DeployFailedError):
+    pass
+
+
+class TemplateValidationError(ValidationException):
+
+    def __init__(self, errors):
+        self.errors = errors
+        super(TemplateValidationError, self).__init__(
+            '{} validation error(s):\n{}'.format(len(errors), '\n'.join(errors)))
+
+
+class GlobalsMismatchError(Exception):
+
+    def __init__(self, logical_ids):
+        self.logical_ids = logical_ids
+        super(GlobalsMismatchError, self).__init__(
+            'Hoisting Globals changed resource(s): {}'.format(', '.join(logical_ids)))
+
+
+class DanglingReferenceError(TemplateValidationError):
+
+    def __init__(self, references):
+        self.references = references
+        super(DanglingReferenceError, self).__init__([
+            '{}: {} {} is not declared in the template'.format(i.source, i.kind, i.target)
+            for i in references])
@@ -0,0 +1,886 @@
+"""
+In-memory stand-in for the CloudFormation, STS and S3 APIs sammy uses, so
+deploy flows can be tested and benchmarked offline.
+
+    aws = FakeAWS()
+    sam.build_clients_resources(session=aws)
+    sam.publish('my-stack')
+
+Stacks, changesets, stack events, exports, stack sets with their instances
+and S3 objects live in memory. Operations take simulated time: changesets
+finish changeset_seconds after they are created, stack resources take
+resource_seconds and stack set instances instance_seconds, so waiting code
+sees the same status sequences it sees on AWS. latency is slept on every
+call. With the defaults everything finishes immediately. Errors are
+injected with fail_call, fail_resource and fail_region.
+"""
+import collections
+import datetime
+import io
+import json
+import re
+import threading
+import time
+import uuid
+
+from sammy import clients
+
+
+ACCOUNT_ID = '123456789012'
+
+STACK_TYPE = 'AWS::CloudFormation::Stack'
+
+NO_CHANGES_REASON = ("The submitted information didn't contain changes. "
+                     "Submit different information to create a change set.")
+
+TEMPLATE_URL = re.compile(r'https://([^./]+)\.s3(?:[.-][^/]*)?\.amazonaws\.com/(.+)')
+
+SUB_VARIABLE = re.compile(r'\$\{([^!}][^}]*)\}')
+
+
+def client_error(code, message, operation):
+    return clients.client_error()({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+def find_imports(node):
+    """
+    Yields the export names a template fragment imports with Fn::ImportValue
+    """
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key == 'Fn::ImportValue':
+                yield value
+            else:
+                yield from find_imports(value)
+    elif isinstance(node, list):
+        for i in node:
+            yield from find_imports(i)
+
+
+class StackRecord(object):
+    """
+    A stack and the events scheduled for its running operation
+    """
+
+    def __init__(self, aws, region_name, name):
+        self.name = name
+        self.region_name = region_name
+        self.stack_id = 'arn:aws:cloudformation:{}:{}:stack/{}/{}'.format(
+            region_name, aws.account_id, name, uuid.uuid4())
+        self.status = 'REVIEW_IN_PROGRESS'
+        self.created = aws.timestamp()
+        self.body = None
+        self.template = {}
+        self.parameters = []
+        self.tags = []
+        self.capabilities = []
+        self.events = []
+        self.pending = []
+        self.deleted = False
+
+    def __repr__(self):
+        return '<StackRecord: {} {} >'.format(self.name, self.status)
+
+    @property
+    def resources(self):
+        return self.template.get('Resources') or {}
+
+    def parameter_values(self):
+        return {i['ParameterKey']: i['ParameterValue'] for i in self.parameters}
+
+    def resolve(self, value):
+        """
+        Resolves literals, Ref and Fn::Sub of parameters and pseudo parameters.
+        References to resources resolve to a made-up physical ID.
+        """
+        names = dict(self.parameter_values(), **{
+            'AWS::StackName': self.name, 'AWS::StackId': self.stack_id,
+            'AWS::Region': self.region_name, 'AWS::AccountId': self.stack_id.split(':')[4]})
+        if isinstance(value, dict) and 'Ref' in value:
+            return names.get(value['Ref'], '{}-{}'.format(self.name, value['Ref']))
+        if isinstance(value, dict) and 'Fn::Sub' in value and isinstance(value['Fn::Sub'], str):
+            return SUB_VARIABLE.sub(lambda m: str(names.get(m.group(1), m.group(1))),
+                                    value['Fn::Sub'])
+        if isinstance(value, (dict, list)):
+            return json.dumps(value, sort_keys=True)
+        return str(value)
+
+    def outputs(self):
+        return [dict({'OutputKey': key, 'OutputValue': self.resolve(output.get('Value'))},
+                     **({'ExportName': self.resolve(output['Export']['Name'])}
+                        if output.get('Export') else {}))
+                for key, output in (self.template.get('Outputs') or {}).items()]
+
+    def exports(self):
+        return {i['ExportName']: i['OutputValue'] for i in self.outputs() if 'ExportName' in i}
+
+    def describe(self):
+        description = {
+            'StackName': self.name,
+            'StackId': self.stack_id,
+            'StackStatus': self.status,
+            'CreationTime': self.created,
+            'Parameters': list(self.parameters),
+            'Tags': list(self.tags),
+            'Capabilities': list(self.capabilities),
+        }
+        outputs = self.outputs()
+        if outputs:
+            description['Outputs'] = outputs
+        return description
+
+
+class ChangeSetRecord(object):
+
+    def __init__(self, aws, stack, name, changeset_type, body, template, parameters, tags,
+                 capabilities):
+        self.stack = stack
+        self.name = name
+        self.changeset_id = 'arn:aws:cloudformation:{}:{}:changeSet/{}/{}'.format(
+            stack.region_name, aws.account_id, name, uuid.uuid4())
+        self.changeset_type = changeset_type
+        self.body = body
+        self.template = template
+        self.parameters = parameters
+        self.tags = tags
+        self.capabilities = capabilities
+        self.due = aws.now() + aws.changeset_seconds
+        self.final_status = 'CREATE_COMPLETE'
+        self.status_reason = None
+        self.executed = False
+
+    def status(self, now):
+        if now < self.due:
+            return 'CREATE_IN_PROGRESS'
+        return self.final_status
+
+    def changes(self):
+        old, new = self.stack.resources, self.template.get('Resources') or {}
+        changes = []
+        for logical_id, resource in new.items():
+            if logical_id not in old:
+                action = 'Add'
+            elif old[logical_id] != resource:
+                action = 'Modify'
+            else:
+                continue
+            changes.append((action, logical_id, resource.get('Type')))
+        changes.extend(('Remove', i, old[i].get('Type')) for i in old if i not in new)
+        return [{'Type': 'Resource', 'ResourceChange': {
+            'Action': action, 'LogicalResourceId': logical_id, 'ResourceType': resource_type}}
+            for action, logical_id, resource_type in changes]
+
+
+class StackSetRecord(object):
+
+    def __init__(self, name, body):
+        self.name = name
+        self.stack_set_id = '{}:{}'.format(name, uuid.uuid4())
+        self.body = body
+        self.instances = collections.OrderedDict()
+        self.operations = {}
+
+
+class FakeAWS(object):
+    """
+    Session-like object whose clients and resources share one in-memory
+    account. Pass it to SAM.build_clients_resources.
+    """
+
+    def __init__(self, latency=0, changeset_seconds=0, resource_seconds=0, instance_seconds=0,
+                 region_name='us-east-1', account_id=ACCOUNT_ID, page_size=100,
+                 clock=time.monotonic, sleep=time.sleep):
+        """
+        :param latency: Seconds slept on every API call
+        :param changeset_seconds: Seconds before a changeset finishes
+        :param resource_seconds: Seconds each resource takes to create, update or delete
+        :param instance_seconds: Seconds each region of a stack set operation takes
+        :param region_name: Region of clients created without one
+        :param account_id: Account returned by STS
+        :param page_size: Items per page of paginated calls
+        :param clock: Returns the current time in seconds
+        :param sleep: Called with the latency
+        """
+        self.latency = latency
+        self.changeset_seconds = changeset_seconds
+        self.resource_seconds = resource_seconds
+        self.instance_seconds = instance_seconds
+        self.region_name = region_name
+        self.account_id = account_id
+        self.page_size = page_size
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.RLock()
+        self.started = clock()
+        self.epoch = datetime.datetime.now(datetime.timezone.utc)
+        self.stacks = {}
+        self.changesets = {}
+        self.stack_sets = {}
+        self.objects = {}
+        self.calls = collections.Counter()
+        self.failures = {}
+        self.failing_resources = {}
+        self.failing_regions = {}
+
+    def __repr__(self):
+        return '<FakeAWS: {} stacks, {} objects >'.format(len(self.stacks), len(self.objects))
+
+    def client(self, service_name, region_name=None, **kwargs):
+        region_name = region_name or self.region_name
+        if service_name == 'cloudformation':
+            return FakeCloudFormation(self, region_name)
+        if service_name == 'sts':
+            return FakeSTS(self, region_name)
+        raise ValueError('FakeAWS has no {} client'.format(service_name))
+
+    def resource(self, service_name, region_name=None, **kwargs):
+        region_name = region_name or self.region_name
+        if service_name == 'cloudformation':
+            return FakeCloudFormationResource(self, region_name)
+        if service_name == 's3':
+            return FakeS3(self)
+        raise ValueError('FakeAWS has no {} resource'.format(service_name))
+
+    def now(self):
+        return self.clock()
+
+    def timestamp(self, at=None):
+        at = self.now() if at is None else at
+        return self.epoch + datetime.timedelta(seconds=at - self.started)
+
+    def fail_call(self, operation, code='Throttling', message='Rate exceeded', times=1):
+        """
+        Makes the next calls of an API operation raise a ClientError
+        :param operation: Operation name, e.g. describe_stacks or put_object
+        :param times: Number of calls that fail, None for every call
+        """
+        with self.lock:
+            self.failures[operation] = [code, message, times]
+
+    def fail_resource(self, logical_id, reason='Resource handler returned an error'):
+        """
+        Makes every stack operation that creates or updates the resource fail
+        """
+        with self.lock:
+            self.failing_resources[logical_id] = reason
+
+    def fail_region(self, region_name, reason='Stack instance failed'):
+        """
+        Makes stack set instances in the region fail
+        """
+        with self.lock:
+            self.failing_regions[region_name] = reason
+
+    def request(self, operation):
+        """
+        Simulates the round trip of an API call. Runs before every operation.
+        """
+        if self.latency:
+            self.sleep(self.latency)
+        with self.lock:
+            self.calls[operation] += 1
+            failure = self.failures.get(operation)
+            if failure is None:
+                return
+            code, message, times = failure
+            if times is not None:
+                if times <= 1:
+                    del self.failures[operation]
+                else:
+                    failure[2] -= 1
+            raise client_error(code, message, operation)
+
+    def advance(self, stack):
+        """
+        Makes the scheduled events of a stack that are due visible
+        """
+        now = self.now()
+        while stack.pending and stack.pending[0][0] <= now:
+            _, event, callback = stack.pending.pop(0)
+            stack.events.append(event)
+            if event['LogicalResourceId'] == stack.name and event['ResourceType'] == STACK_TYPE:
+                stack.status = event['ResourceStatus']
+            if callback is not None:
+                callback()
+
+    def get_stack(self, region_name, name, operation):
+        stack = self.stacks.get((region_name, name))
+        if stack is None:
+            stack = next((i for i in self.stacks.values() if i.stack_id == name), None)
+        if stack is None or stack.deleted:
+            raise client_error('ValidationError',
+                               'Stack with id {} does not exist'.format(name), operation)
+        self.advance(stack)
+        if stack.deleted:
+            raise client_error('ValidationError',
+                               'Stack with id {} does not exist'.format(name), operation)
+        return stack
+
+    def exports(self, region_name):
+        """
+        :return: Dict of export name to (exporting stack, value) in a region
+        """
+        exports = {}
+        for (region, _), stack in list(self.stacks.items()):
+            if region != region_name:
+                continue
+            self.advance(stack)
+            if not stack.deleted:
+                for name, value in stack.exports().items():
+                    exports[name] = (stack, value)
+        return exports
+
+    def importers(self, region_name, export_name):
+        return [stack.name for (region, _), stack in self.stacks.items()
+                if region == region_name and not stack.deleted and
+                export_name in find_imports(stack.template)]
+
+    def read_template(self, operation, TemplateBody=None, TemplateURL=None):
+        from sammy.diff import load_template
+
+        if TemplateURL is not None:
+            match = TEMPLATE_URL.match(TemplateURL)
+            body = match and self.objects.get((match.group(1), match.group(2)))
+            if body is None:
+                raise client_error('ValidationError',
+                                   'S3 error: Unable to get template from {}'.format(TemplateURL),
+                                   operation)
+            TemplateBody = body.decode('utf-8')
+        elif TemplateBody is None:
+            raise client_error('ValidationError',
+                               'Either TemplateBody or TemplateURL must be given', operation)
+        elif len(TemplateBody.encode('utf-8')) > 51200:
+            raise client_error('ValidationError', 'Templates passed in TemplateBody must be '
+                                                  'at most 51200 bytes', operation)
+        try:
+            return TemplateBody, load_template(TemplateBody)
+        except ValueError as e:
+            raise client_error('ValidationError', 'Template format error: {}'.format(e),
+                               operation)
+
+    def event(self, stack, logical_id, resource_type, status, at, reason=None):
+        event = {
+            'StackId': stack.stack_id,
+            'EventId': str(uuid.uuid4()),
+            'StackName': stack.name,
+            'LogicalResourceId': logical_id,
+            'PhysicalResourceId': stack.stack_id if resource_type == STACK_TYPE else
+            '{}-{}'.format(stack.name, logical_id),
+            'ResourceType': resource_type,
+            'Timestamp': self.timestamp(at),
+            'ResourceStatus': status,
+        }
+        if reason:
+            event['ResourceStatusReason'] = reason
+        return event
+
+    def schedule(self, stack, action, old, new, on_success, on_failure=None):
+        """
+        Schedules the events of a stack operation. Resources are processed in
+        parallel and each takes resource_seconds. A failing resource rolls the
+        operation back.
+        :param action: CREATE, UPDATE or DELETE
+        :param old: Resources before the operation
+        :param new: Resources after the operation
+        :param on_success: Called when the operation completes
+        :param on_failure: Called when the rollback completes
+        """
+        start = self.now()
+        step = self.resource_seconds
+        events = []
+
+        def add(at, logical_id, resource_type, status, reason=None, callback=None):
+            events.append((at, self.event(stack, logical_id, resource_type, status, at, reason),
+                           callback))
+
+        def stack_event(at, status, reason=None, callback=None):
+            add(at, stack.name, STACK_TYPE, status, reason, callback)
+
+        if action == 'DELETE':
+            stack_event(start, 'DELETE_IN_PROGRESS', 'User Initiated')
+            for logical_id, resource in old.items():
+                add(start, logical_id, resource.get('Type'), 'DELETE_IN_PROGRESS')
+                add(start + step, logical_id, resource.get('Type'), 'DELETE_COMPLETE')
+            stack_event(start + step, 'DELETE_COMPLETE', callback=on_success)
+            stack.pending.extend(events)
+            return
+
+        stack_event(start, '{}_IN_PROGRESS'.format(action), 'User Initiated')
+        changed = [(i, r, 'CREATE' if i not in old else 'UPDATE') for i, r in new.items()
+                   if old.get(i) != r]
+        failed = [(i, r, a) for i, r, a in changed if i in self.failing_resources]
+        for logical_id, resource, verb in changed:
+            add(start, logical_id, resource.get('Type'), '{}_IN_PROGRESS'.format(verb))
+        for logical_id, resource, verb in changed:
+            if (logical_id, resource, verb) in failed:
+                add(start + step, logical_id, resource.get('Type'), '{}_FAILED'.format(verb),
+                    self.failing_resources[logical_id])
+            elif not failed:
+                add(start + step, logical_id, resource.get('Type'), '{}_COMPLETE'.format(verb))
+            else:
+                add(start + step, logical_id, resource.get('Type'), '{}_FAILED'.format(verb),
+                    'Resource {} cancelled'.format(verb.lower()))
+
+        if failed:
+            rollback = 'ROLLBACK' if action == 'CREATE' else 'UPDATE_ROLLBACK'
+            reason = 'The following resource(s) failed to {}: [{}].'.format(
+                action.lower(), ', '.join(i for i, _, _ in failed))
+            stack_event(start + step, '{}_IN_PROGRESS'.format(rollback), reason)
+            for logical_id, resource, verb in changed:
+                if verb == 'CREATE':
+                    add(start + 2 * step, logical_id, resource.get('Type'), 'DELETE_COMPLETE')
+                else:
+                    add(start + 2 * step, logical_id, resource.get('Type'), 'UPDATE_COMPLETE')
+            stack_event(start + 2 * step, '{}_COMPLETE'.format(rollback), callback=on_failure)
+        elif action == 'CREATE':
+            stack_event(start + step, 'CREATE_COMPLETE', callback=on_success)
+        else:
+            stack_event(start + step, 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS')
+            for logical_id, resource in old.items():
+                if logical_id not in new:
+                    add(start + step, logical_id, resource.get('Type'), 'DELETE_IN_PROGRESS')
+                    add(start + 2 * step, logical_id, resource.get('Type'), 'DELETE_COMPLETE')
+            stack_event(start + 2 * step, 'UPDATE_COMPLETE', callback=on_success)
+        stack.pending.extend(events)
+
+
+class FakeService(object):
+
+    def __init__(self, aws, region_name):
+        self.aws = aws
+        self.region_name = region_name
+
+    def __repr__(self):
+        return '<{}: {} >'.format(self.__class__.__name__, self.region_name)
+
+    def page(self, items, key, NextToken=None):
+        start = int(NextToken or 0)
+        end = start + self.aws.page_size
+        response = {key: items[start:end]}
+        if end < len(items):
+            response['NextToken'] = str(end)
+        return response
+
+
+class FakeCloudFormation(FakeService):
+    """
+    CloudFormation client
+    """
+
+    def describe_stacks(self, StackName=None, NextToken=None):
+        self.aws.request('describe_stacks')
+        with self.aws.lock:
+            if StackName is not None:
+                stack = self.aws.get_stack(self.region_name, StackName, 'DescribeStacks')
+                return {'Stacks': [stack.describe()]}
+            stacks = []
+            for (region, _), stack in self.aws.stacks.items():
+                if region == self.region_name:
+                    self.aws.advance(stack)
+                    if not stack.deleted:
+                        stacks.append(stack.describe())
+            return self.page(stacks, 'Stacks', NextToken)
+
+    def describe_stack_events(self, StackName, NextToken=None):
+        self.aws.request('describe_stack_events')
+        with self.aws.lock:
+            stack = self.aws.get_stack(self.region_name, StackName, 'DescribeStackEvents')
+            return self.page(stack.events[::-1], 'StackEvents', NextToken)
+
+    def get_template(self, StackName, TemplateStage='Original', ChangeSetName=None):
+        self.aws.request('get_template')
+        with self.aws.lock:
+            stack = self.aws.get_stack(self.region_name, StackName, 'GetTemplate')
+            return {'TemplateBody': stack.body, 'StagesAvailable': ['Original', 'Processed']}
+
+    def list_exports(self, NextToken=None):
+        self.aws.request('list_exports')
+        with self.aws.lock:
+            exports = [{'ExportingStackId': stack.stack_id, 'Name': name, 'Value': value}
+                       for name, (stack, value) in self.aws.exports(self.region_name).items()]
+            return self.page(exports, 'Exports', NextToken)
+
+    def create_change_set(self, StackName, ChangeSetName, ChangeSetType='UPDATE',
+                          TemplateBody=None, TemplateURL=None, Parameters=None,
+                          Capabilities=None, Tags=None, **kwargs):
+        operation = 'CreateChangeSet'
+        self.aws.request('create_change_set')
+        aws = self.aws
+        with aws.lock:
+            key = (self.region_name, StackName)
+            stack = aws.stacks.get(key)
+            if stack is not None:
+                aws.advance(stack)
+                if stack.deleted:
+                    stack = None
+            if ChangeSetType == 'CREATE':
+                if stack is not None and stack.status != 'REVIEW_IN_PROGRESS':
+                    raise client_error('AlreadyExistsException', 'Stack [{}] already exists and '
+                                       'cannot be created again with the changeSet [{}].'.format(
+                                           StackName, ChangeSetName), operation)
+            elif stack is None or stack.status == 'REVIEW_IN_PROGRESS':
+                raise client_error('ValidationError',
+                                   'Stack [{}] does not exist'.format(StackName), operation)
+            elif stack.status.endswith('_IN_PROGRESS') or stack.status == 'ROLLBACK_COMPLETE':
+                raise client_error('ValidationError', 'Stack:{} is in {} state and can not be '
+                                   'updated.'.format(stack.stack_id, stack.status), operation)
+            body, template = aws.read_template(operation, TemplateBody, TemplateURL)
+            if stack is None:
+                stack = aws.stacks[key] = StackRecord(aws, self.region_name, StackName)
+                stack.events.append(aws.event(stack, StackName, STACK_TYPE,
+                                              'REVIEW_IN_PROGRESS', aws.now(), 'User Initiated'))
+
+            changeset = ChangeSetRecord(aws, stack, ChangeSetName, ChangeSetType, body,
+                                        template, list(Parameters or []),
+                                        list(Tags or stack.tags), list(Capabilities or []))
+            exports = aws.exports(self.region_name)
+            missing = [i for i in find_imports(template) if isinstance(i, str) and
+                       i not in exports]
+            if missing:
+                changeset.final_status = 'FAILED'
+                changeset.status_reason = 'No export named {} found.'.format(missing[0])
+            elif (ChangeSetType == 'UPDATE' and template == stack.template and
+                  changeset.parameters == stack.parameters and changeset.tags == stack.tags):
+                changeset.final_status = 'FAILED'
+                changeset.status_reason = NO_CHANGES_REASON
+            aws.changesets[changeset.changeset_id] = changeset
+            return {'Id': changeset.changeset_id, 'StackId': stack.stack_id}
+
+    def find_changeset(self, ChangeSetName, StackName, operation):
+        changeset = self.aws.changesets.get(ChangeSetName)
+        if changeset is None:
+            changeset = next((i for i in self.aws.changesets.values()
+                              if i.name == ChangeSetName and StackName in
+                              (i.stack.name, i.stack.stack_id)), None)
+        if changeset is None:
+            raise client_error('ChangeSetNotFound',
+                               'ChangeSet [{}] does not exist'.format(ChangeSetName), operation)
+        return changeset
+
+    def describe_change_set(self, ChangeSetName, StackName=None, NextToken=None):
+        self.aws.request('describe_change_set')
+        with self.aws.lock:
+            changeset = self.find_changeset(ChangeSetName, StackName, 'DescribeChangeSet')
+            status = changeset.status(self.aws.now())
+            if changeset.executed:
+                execution_status = 'EXECUTE_COMPLETE'
+            elif status == 'CREATE_COMPLETE':
+                execution_status = 'AVAILABLE'
+            else:
+                execution_status = 'UNAVAILABLE'
+            response = {
+                'ChangeSetId': changeset.changeset_id,
+                'ChangeSetName': changeset.name,
+                'StackId': changeset.stack.stack_id,
+                'StackName': changeset.stack.name,
+                'Status': status,
+                'ExecutionStatus': execution_status,
+                'Parameters': changeset.parameters,
+                'Capabilities': changeset.capabilities,
+                'Tags': changeset.tags,
+                'Changes': changeset.changes() if status == 'CREATE_COMPLETE' else [],
+            }
+            if status == 'FAILED':
+                response['StatusReason'] = changeset.status_reason
+            return response
+
+    def execute_change_set(self, ChangeSetName, StackName=None, **kwargs):
+        operation = 'ExecuteChangeSet'
+        self.aws.request('execute_change_set')
+        aws = self.aws
+        with aws.lock:
+            changeset = self.find_changeset(ChangeSetName, StackName, operation)
+            if changeset.executed or changeset.status(aws.now()) != 'CREATE_COMPLETE':
+                raise client_error('InvalidChangeSetStatus', 'ChangeSet [{}] cannot be executed '
+                                   'in its current status'.format(changeset.changeset_id),
+                                   operation)
+            changeset.executed = True
+            stack = changeset.stack
+
+            def commit():
+                stack.body = changeset.body
+                stack.template = changeset.template
+                stack.parameters = changeset.parameters
+                stack.tags = changeset.tags
+                stack.capabilities = changeset.capabilities
+
+            action = 'CREATE' if changeset.changeset_type == 'CREATE' else 'UPDATE'
+            # A stack whose creation rolled back keeps the template it failed with
+            aws.schedule(stack, action, stack.resources,
+                         changeset.template.get('Resources') or {}, commit,
+                         commit if action == 'CREATE' else None)
+            aws.advance(stack)
+            return {}
+
+    def delete_stack(self, StackName, **kwargs):
+        self.aws.request('delete_stack')
+        aws = self.aws
+        with aws.lock:
+            try:
+                stack = aws.get_stack(self.region_name, StackName, 'DeleteStack')
+            except clients.client_error():
+                return {}
+            if stack.status == 'DELETE_IN_PROGRESS':
+                return {}
+            in_use = [(name, importers) for name, importers in (
+                (i, aws.importers(self.region_name, i)) for i in stack.exports()) if importers]
+            if in_use:
+                start = aws.now()
+                stack.pending.append((start, aws.event(
+                    stack, stack.name, STACK_TYPE, 'DELETE_FAILED', start,
+                    'Export {} cannot be deleted as it is in use by {}'.format(
+                        in_use[0][0], ', '.join(in_use[0][1]))), None))
+            else:
+                def remove():
+                    stack.deleted = True
+
+                aws.schedule(stack, 'DELETE', stack.resources, {}, remove)
+            aws.advance(stack)
+            return {}
+
+    def create_stack_set(self, StackSetName, TemplateBody=None, TemplateURL=None, **kwargs):
+        operation = 'CreateStackSet'
+        self.aws.request('create_stack_set')
+        with self.aws.lock:
+            if StackSetName in self.aws.stack_sets:
+                raise client_error('NameAlreadyExistsException',
+                                   'StackSet {} already exists'.format(StackSetName), operation)
+            body, _ = self.aws.read_template(operation, TemplateBody, TemplateURL)
+            stack_set = StackSetRecord(StackSetName, body)
+            self.aws.stack_sets[StackSetName] = stack_set
+            return {'StackSetId': stack_set.stack_set_id}
+
+    def get_stack_set(self, StackSetName, operation):
+        stack_set = self.aws.stack_sets.get(StackSetName)
+        if stack_set is None:
+            raise client_error('StackSetNotFoundException',
+                               'StackSet {} not found'.format(StackSetName), operation)
+        return stack_set
+
+    def create_stack_instances(self, StackSetName, Accounts, Regions,
+                               OperationPreferences=None, **kwargs):
+        """
+        Regions are deployed in parallel, or one after the other when the
+        RegionConcurrencyType preference is SEQUENTIAL
+        """
+        self.aws.request('create_stack_instances')
+        aws = self.aws
+        with aws.lock:
+            stack_set = self.get_stack_set(StackSetName, 'CreateStackInstances')
+            preferences = OperationPreferences or {}
+            sequential = preferences.get('RegionConcurrencyType') == 'SEQUENTIAL'
+            start = aws.now()
+            operation_id = str(uuid.uuid4())
+            for i, region in enumerate(Regions):
+                due = start + aws.instance_seconds * ((i + 1) if sequential else 1)
+                for account in Accounts:
+                    stack_set.instances[(account, region)] = {
+                        'due': due, 'reason': aws.failing_regions.get(region)}
+            if 'FailureTolerancePercentage' in preferences:
+                tolerance = len(Regions) * preferences['FailureTolerancePercentage'] // 100
+            else:
+                tolerance = preferences.get('FailureToleranceCount', 0)
+            failures = sum(len(Accounts) for i in Regions if i in aws.failing_regions)
+            stack_set.operations[operation_id] = {
+                'due': max(i['due'] for i in stack_set.instances.values()),
+                'status': 'FAILED' if failures > tolerance else 'SUCCEEDED'}
+            return {'OperationId': operation_id}
+
+    def describe_stack_set_operation(self, StackSetName, OperationId, **kwargs):
+        operation = 'DescribeStackSetOperation'
+        self.aws.request('describe_stack_set_operation')
+        with self.aws.lock:
+            stack_set = self.get_stack_set(StackSetName, operation)
+            record = stack_set.operations.get(OperationId)
+            if record is None:
+                raise client_error('OperationNotFoundException',
+                                   'Operation {} not found'.format(OperationId), operation)
+            status = 'RUNNING' if self.aws.now() < record['due'] else record['status']
+            return {'StackSetOperation': {
+                'OperationId': OperationId, 'StackSetId': stack_set.stack_set_id,
+                'Action': 'CREATE', 'Status': status}}
+
+    def list_stack_instances(self, StackSetName, NextToken=None, **kwargs):
+        self.aws.request('list_stack_instances')
+        with self.aws.lock:
+            stack_set = self.get_stack_set(StackSetName, 'ListStackInstances')
+            now = self.aws.now()
+            summaries = []
+            for (account, region), instance in stack_set.instances.items():
+                summary = {'StackSetId': stack_set.stack_set_id, 'Region': region,
+                           'Account': account}
+                if now < instance['due']:
+                    summary.update(Status='OUTDATED', StatusReason='User Initiated',
+                                   StackInstanceStatus={'DetailedStatus': 'RUNNING'})
+                elif instance['reason']:
+                    summary.update(Status='OUTDATED', StatusReason=instance['reason'],
+                                   StackInstanceStatus={'DetailedStatus': 'FAILED'})
+                else:
+                    summary.update(Status='CURRENT',
+                                   StackInstanceStatus={'DetailedStatus': 'SUCCEEDED'})
+                summaries.append(summary)
+            return self.page(summaries, 'Summaries', NextToken)
+
+
+class FakeStack(object):
+    """
+    CloudFormation Stack resource. Attributes are read from the fake on access.
+    """
+
+    def __init__(self, aws, region_name, name):
+        self.aws = aws
+        self.region_name = region_name
+        self.name = name
+
+    def __repr__(self):
+        return '<FakeStack: {} >'.format(self.name)
+
+    def describe(self):
+        return FakeCloudFormation(self.aws, self.region_name).describe_stacks(
+            StackName=self.name)['Stacks'][0]
+
+    @property
+    def stack_id(self):
+        return self.describe()['StackId']
+
+    @property
+    def stack_status(self):
+        return self.describe()['StackStatus']
+
+    @property
+    def outputs(self):
+        return self.describe().get('Outputs')
+
+    @property
+    def tags(self):
+        return self.describe()['Tags']
+
+
+class FakeCloudFormationResource(FakeService):
+
+    def Stack(self, name):
+        return FakeStack(self.aws, self.region_name, name)
+
+
+class FakeSTS(FakeService):
+
+    def get_caller_identity(self):
+        self.aws.request('get_caller_identity')
+        return {'UserId': 'AIDAFAKEUSER', 'Account': self.aws.account_id,
+                'Arn': 'arn:aws:iam::{}:user/fake'.format(self.aws.account_id)}
+
+
+class FakeMultipartUploadPart(object):
+
+    def __init__(self, multipart, part_number):
+        self.multipart = multipart
+        self.part_number = part_number
+
+    def upload(self, Body):
+        self.multipart.aws.request('upload_part')
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        with self.multipart.aws.lock:
+            self.multipart.parts[self.part_number] = Body
+        return {'ETag': '"{}"'.format(uuid.uuid4().hex)}
+
+
+class FakeMultipartUpload(object):
+
+    def __init__(self, s3_object):
+        self.aws = s3_object.aws
+        self.s3_object = s3_object
+        self.id = uuid.uuid4().hex
+        self.parts = {}
+
+    def Part(self, part_number):
+        return FakeMultipartUploadPart(self, part_number)
+
+    def complete(self, MultipartUpload):
+        self.aws.request('complete_multipart_upload')
+        numbers = [i['PartNumber'] for i in MultipartUpload['Parts']]
+        with self.aws.lock:
+            if any(i not in self.parts for i in numbers):
+                raise client_error('InvalidPart', 'One or more of the specified parts could '
+                                   'not be found', 'CompleteMultipartUpload')
+            self.aws.objects[self.s3_object.path] = b''.join(self.parts[i] for i in numbers)
+        return {}
+
+    def abort(self):
+        self.aws.request('abort_multipart_upload')
+        self.parts.clear()
+        return {}
+
+
+class FakeS3Object(object):
+
+    def __init__(self, aws, bucket_name, key):
+        self.aws = aws
+        self.bucket_name = bucket_name
+        self.key = key
+        self.content_length = None
+
+    def __repr__(self):
+        return '<FakeS3Object: {}/{} >'.format(self.bucket_name, self.key)
+
+    @property
+    def path(self):
+        return (self.bucket_name, self.key)
+
+    def body(self, operation, code):
+        body = self.aws.objects.get(self.path)
+        if body is None:
+            raise client_error(code, 'Not Found', operation)
+        return body
+
+    def load(self):
+        self.aws.request('head_object')
+        with self.aws.lock:
+            self.content_length = len(self.body('HeadObject', '404'))
+
+    def get(self, **kwargs):
+        self.aws.request('get_object')
+        with self.aws.lock:
+            body = self.body('GetObject', 'NoSuchKey')
+        return {'Body': io.BytesIO(body), 'ContentLength': len(body)}
+
+    def put(self, Body, **kwargs):
+        self.aws.request('put_object')
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        elif not isinstance(Body, bytes):
+            Body = Body.read()
+        with self.aws.lock:
+            self.aws.objects[self.path] = Body
+        return {'ETag': '"{}"'.format(uuid.uuid4().hex)}
+
+    def upload_file(self, Filename, ExtraArgs=None, Callback=None, Config=None):
+        self.aws.request('upload_file')
+        with open(Filename, 'rb') as f:
+            body = f.read()
+        with self.aws.lock:
+            self.aws.objects[self.path] = body
+        if Callback is not None:
+            Callback(len(body))
+
+    def delete(self):
+        self.aws.request('delete_object')
+        with self.aws.lock:
+            self.aws.objects.pop(self.path, None)
+        return {}
+
+    def initiate_multipart_upload(self, **kwargs):
+        self.aws.request('create_multipart_upload')
+        return FakeMultipartUpload(self)
+
+
+class FakeS3(object):
+    """
+    S3 service resource
+    """
+
+    def __init__(self, aws):
+        self.aws = aws
+
+    def Object(self, bucket_name, key):
+        return FakeS3Object(self.aws, bucket_name, key)
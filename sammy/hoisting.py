@@ -0,0 +1,223 @@
+"""
+Moves property values that serverless functions and APIs share into the
+Globals section of a template, and expands Globals back into the resources
+the way the SAM transform does. Expanding a hoisted template gives the same
+resources as expanding the original one.
+"""
+import collections
+import json
+
+from valley.utils.json_utils import ValleyEncoderNoType
+
+from sammy.exceptions import GlobalsMismatchError
+
+
+# Globals section, the resource type it applies to and the properties it may hold
+GLOBAL_SECTIONS = collections.OrderedDict([
+    ('Function', ('AWS::Serverless::Function', (
+        'Handler', 'Runtime', 'CodeUri', 'DeadLetterQueue', 'Description', 'MemorySize',
+        'Timeout', 'VpcConfig', 'Environment', 'Tags', 'Tracing', 'KmsKeyArn', 'Layers',
+        'AutoPublishAlias', 'DeploymentPreference', 'PermissionsBoundary',
+        'ReservedConcurrentExecutions', 'ProvisionedConcurrencyConfig', 'EventInvokeConfig',
+        'Architectures', 'EphemeralStorage'))),
+    ('Api', ('AWS::Serverless::Api', (
+        'Auth', 'Name', 'DefinitionUri', 'CacheClusterEnabled', 'CacheClusterSize',
+        'Variables', 'EndpointConfiguration', 'MethodSettings', 'BinaryMediaTypes',
+        'MinimumCompressionSize', 'Cors', 'GatewayResponses', 'AccessLogSetting',
+        'CanarySetting', 'TracingEnabled', 'OpenApiVersion', 'Domain'))),
+])
+
+# Residual of a resource value that the global value fully covers
+MISSING = object()
+
+
+def plain(value):
+    """
+    Copies a rendered value, turning schema objects and intrinsics into
+    dicts so values can be compared, merged and modified
+    """
+    if hasattr(value, 'render'):
+        return plain(value.render())
+    if hasattr(value, 'to_dict'):
+        return plain(value.to_dict())
+    if isinstance(value, dict):
+        return {k: plain(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [plain(i) for i in value]
+    return value
+
+
+def is_intrinsic(value):
+    if not isinstance(value, dict) or len(value) != 1:
+        return False
+    name = next(iter(value))
+    return name in ('Ref', 'Condition') or name.startswith('Fn::')
+
+
+def is_map(value):
+    return isinstance(value, dict) and not is_intrinsic(value)
+
+
+def merge(global_value, local_value):
+    """
+    Merges a global and a resource value like the SAM transform. Maps are
+    merged key by key, lists are concatenated, and otherwise the resource
+    value wins. Intrinsic functions count as single values.
+    """
+    if is_map(global_value) and is_map(local_value):
+        merged = dict(global_value)
+        for key, value in local_value.items():
+            merged[key] = merge(global_value[key], value) if key in global_value else value
+        return merged
+    if isinstance(global_value, list) and isinstance(local_value, list):
+        return global_value + local_value
+    return local_value
+
+
+def expand(template):
+    """
+    Applies the Globals section to the resources it covers, like the SAM
+    transform
+    :param template: Template dict, not modified
+    :return: Template dict without Globals
+    """
+    template = plain(template)
+    globals_ = template.pop('Globals', None) or {}
+    resources = template.get('Resources') or {}
+    for section, (resource_type, _) in GLOBAL_SECTIONS.items():
+        values = globals_.get(section)
+        if not values:
+            continue
+        for resource in resources.values():
+            if resource.get('Type') != resource_type:
+                continue
+            properties = resource.get('Properties') or {}
+            for key, value in values.items():
+                properties[key] = merge(value, properties[key]) if key in properties else value
+            resource['Properties'] = properties
+    return template
+
+
+def split(values, min_count):
+    """
+    Finds the global value that covers the most of the given values
+    :param values: Value of one property on every resource
+    :param min_count: Resources that must share a value before it is hoisted
+    :return: (global value, list of residual values or MISSING) or None
+    """
+    if all(is_map(i) for i in values):
+        shared, residuals = {}, [dict(i) for i in values]
+        for name in values[0]:
+            if not all(name in i for i in values[1:]):
+                continue
+            result = split([i[name] for i in values], min_count)
+            if result is None:
+                continue
+            shared[name] = result[0]
+            for residual, value in zip(residuals, result[1]):
+                if value is MISSING:
+                    del residual[name]
+                else:
+                    residual[name] = value
+        if not shared:
+            return None
+        return shared, [i or MISSING for i in residuals]
+    if any(is_map(i) for i in values):
+        return None
+    if all(isinstance(i, list) for i in values):
+        # Lists are concatenated, so only identical lists can be hoisted
+        if any(i != values[0] for i in values[1:]):
+            return None
+        return values[0], [MISSING] * len(values)
+    if any(isinstance(i, list) for i in values):
+        return None
+
+    # Single values and intrinsics: the most common one becomes global and
+    # the others stay as overrides
+    keys = [json.dumps(i, sort_keys=True, cls=ValleyEncoderNoType) for i in values]
+    common, count = collections.Counter(keys).most_common(1)[0]
+    if count < min_count:
+        return None
+    return values[keys.index(common)], [MISSING if k == common else v
+                                        for k, v in zip(keys, values)]
+
+
+def hoist_section(resources, names, min_count):
+    """
+    Hoists the properties that every resource sets, removing the hoisted
+    values from the resources
+    :param resources: Resource dicts of one type, modified in place
+    :param names: Properties allowed in the Globals section
+    :return: Dict of global values
+    """
+    shared = {}
+    if len(resources) < max(min_count, 2):
+        return shared
+    for name in names:
+        if not all(name in i['Properties'] for i in resources):
+            continue
+        result = split([i['Properties'][name] for i in resources], min_count)
+        if result is None:
+            continue
+        shared[name] = result[0]
+        for resource, value in zip(resources, result[1]):
+            if value is MISSING:
+                del resource['Properties'][name]
+            else:
+                resource['Properties'][name] = value
+    return shared
+
+
+def hoist(template, min_count=2, verify=False):
+    """
+    Moves property values shared by the serverless functions and APIs of a
+    template into its Globals section. Values that differ from the hoisted
+    one stay on their resources as overrides. Existing Globals are expanded
+    and hoisted again. Api properties are left alone when functions use the
+    implicit API, which Api globals would also change.
+    :param template: Template dict, not modified
+    :param min_count: Resources that must share a value before it is hoisted
+    :param verify: Expand both templates and raise GlobalsMismatchError if
+        their resources differ
+    :return: Template dict
+    """
+    from sammy.partition import implicit_api_functions
+
+    globals_ = plain(template.get('Globals')) or {}
+    implicit = any(implicit_api_functions(template.get('Resources') or {}).values())
+    sections = [i for i in GLOBAL_SECTIONS if not (i == 'Api' and implicit)]
+    # Sections hoisted again are expanded first, the others are kept as they are
+    hoisted = {k: v for k, v in globals_.items() if k not in sections}
+    expanded = expand(dict(template, Globals={k: v for k, v in globals_.items()
+                                              if k in sections}))
+
+    resources = expanded.get('Resources') or {}
+    for section in sections:
+        resource_type, names = GLOBAL_SECTIONS[section]
+        members = [i for i in resources.values() if i.get('Type') == resource_type]
+        for resource in members:
+            resource['Properties'] = resource.get('Properties') or {}
+        shared = hoist_section(members, names, min_count)
+        if shared:
+            hoisted[section] = shared
+
+    result = {}
+    for name, value in expanded.items():
+        if name == 'Resources' and hoisted:
+            result['Globals'] = hoisted
+        result[name] = value
+    if verify:
+        mismatched = compare(template, result)
+        if mismatched:
+            raise GlobalsMismatchError(mismatched)
+    return result
+
+
+def compare(original, optimized):
+    """
+    Expands the Globals of both templates and compares their resources
+    :return: Sorted logical IDs of the resources that differ
+    """
+    old = expand(original).get('Resources') or {}
+    new = expand(optimized).get('Resources') or {}
+    return sorted(i for i in set(old) | set(new) if old.get(i) != new.get(i))
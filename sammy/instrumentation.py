@@ -0,0 +1,142 @@
+import collections
+import contextlib
+import logging
+import threading
+import time
+
+
+LOG = logging.getLogger(__name__)
+
+_hooks = []
+_local = threading.local()
+
+
+class Span(object):
+    """
+    Timed section of work such as rendering a template, an AWS call or a
+    polling loop. attrs holds what the span processed, like the number of
+    resources rendered, bytes emitted or polls made.
+    """
+
+    def __init__(self, name, parent=None, **attrs):
+        self.name = name
+        self.parent = parent
+        self.attrs = attrs
+        self.thread = threading.get_ident()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.error = None
+
+    def __repr__(self):
+        return '<Span: {} {} >'.format(self.name, self.duration)
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def incr(self, key, value=1):
+        self.attrs[key] = self.attrs.get(key, 0) + value
+
+
+def add_hook(hook):
+    """
+    Registers a callable that receives every finished Span
+    :param hook: Callable taking a Span
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+def current_span():
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """
+    Times the block and hands the finished Span to every hook and to the
+    sammy.instrumentation logger at DEBUG level
+    :param name: Span name, e.g. to_dict or cloudformation.create_change_set
+    :param attrs: Initial attributes, more can be set on the yielded Span
+    """
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    s = Span(name, stack[-1] if stack else None, **attrs)
+    stack.append(s)
+    try:
+        yield s
+    except Exception as e:
+        s.error = e
+        raise
+    finally:
+        s.duration = time.perf_counter() - s.start
+        stack.pop()
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug('%s took %.3fs %s', s.name, s.duration, s.attrs)
+        for hook in list(_hooks):
+            try:
+                hook(s)
+            except Exception:
+                LOG.exception('Instrumentation hook %r failed', hook)
+
+
+def call(name, method, **kwargs):
+    """
+    Calls an AWS API method inside a span
+    :param name: Span name, e.g. cloudformation.describe_stacks
+    :param method: Bound client or resource method
+    :return: Return value of the method
+    """
+    with span(name):
+        return method(**kwargs)
+
+
+class SpanCollector(object):
+    """
+    Hook that keeps the spans finished by the thread that created it, so
+    concurrent publishes do not mix. Use it as a context manager to register
+    it for the duration of a block.
+    """
+
+    def __init__(self):
+        self.thread = threading.get_ident()
+        self.spans = []
+
+    def __call__(self, span):
+        if span.thread == self.thread:
+            self.spans.append(span)
+
+    def __enter__(self):
+        add_hook(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        remove_hook(self)
+
+    def totals(self):
+        """
+        Aggregates the spans by name in the order they first started
+        :return: OrderedDict of name to a dict with calls, seconds and summed numeric attrs
+        """
+        totals = collections.OrderedDict()
+        for s in sorted(self.spans, key=lambda i: i.start):
+            total = totals.setdefault(s.name, {'calls': 0, 'seconds': 0.0})
+            total['calls'] += 1
+            total['seconds'] += s.duration
+            for k, v in s.attrs.items():
+                if isinstance(v, (int, float)) and not isinstance(v, bool):
+                    total[k] = total.get(k, 0) + v
+        return totals
+
+    def breakdown(self):
+        lines = ['Timing breakdown:']
+        for name, total in self.totals().items():
+            counts = ' '.join('{}={}'.format(k, v) for k, v in sorted(total.items())
+                              if k not in ('calls', 'seconds'))
+            lines.append('  {:<40} {:>4}x {:>9.3f}s  {}'.format(
+                name, total['calls'], total['seconds'], counts).rstrip())
+        return '\n'.join(lines)
@@ -0,0 +1,186 @@
+"""
+Packages Lambda code given as local paths. Directories and files are zipped
+deterministically in a process pool, keyed by the SHA-256 of the archive and
+uploaded concurrently, skipping archives the bucket already has. The
+function properties are then pointed at the uploaded objects.
+"""
+import collections
+import hashlib
+import os
+import shutil
+import stat
+import tempfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from sammy import S3_MISSING_CODES, LambdaCode, S3URI, clients, instrumentation
+
+
+# Fixed timestamp so unchanged code gives an identical archive. Zip files
+# cannot store dates before 1980.
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+# Directories whose contents change without the code changing
+EXCLUDED_DIRS = ('__pycache__', '.git')
+
+# Files uploaded as they are instead of being zipped again
+ARCHIVE_EXTENSIONS = ('.zip', '.jar')
+
+UPLOAD_WORKERS = 8
+
+# Property holding the code of each function type, and how an S3 location is built for it
+CODE_PROPERTIES = {
+    'AWS::Serverless::Function': ('CodeUri', lambda bucket, key: S3URI(Bucket=bucket, Key=key)),
+    'AWS::Lambda::Function': ('Code', lambda bucket, key: LambdaCode(S3Bucket=bucket, S3Key=key)),
+}
+
+Archive = collections.namedtuple('Archive', ['source', 'path', 'digest', 'size'])
+
+PackagedCode = collections.namedtuple('PackagedCode', [
+    'source', 'bucket', 'key', 'size', 'uploaded', 'resources'])
+
+
+def is_local(location):
+    """
+    :param location: Value of a code property
+    :return: True for a local path, False for S3 locations and inline code
+    """
+    return isinstance(location, str) and not location.startswith('s3://')
+
+
+def iter_files(source):
+    """
+    Yields (path, archive name) for every file under a directory, sorted by
+    archive name so the archive does not depend on directory listing order
+    """
+    for root, dirs, files in os.walk(source):
+        dirs[:] = sorted(i for i in dirs if i not in EXCLUDED_DIRS)
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            yield path, os.path.relpath(path, source).replace(os.sep, '/')
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def build_archive(source, output_dir):
+    """
+    Zips a directory or a single file. Entries are sorted and carry a fixed
+    timestamp and permissions, so the same code always gives the same bytes.
+    Zip and jar files are used as they are. Runs in a worker process.
+    :param source: Path of a directory or file
+    :param output_dir: Directory the archive is written to
+    :return: Archive
+    """
+    if os.path.isfile(source) and source.lower().endswith(ARCHIVE_EXTENSIONS):
+        return Archive(source, source, file_digest(source), os.path.getsize(source))
+    if os.path.isdir(source):
+        files = iter_files(source)
+    elif os.path.isfile(source):
+        files = [(source, os.path.basename(source))]
+    else:
+        raise ValueError('Code path {} does not exist'.format(source))
+
+    fd, path = tempfile.mkstemp(suffix='.zip', dir=output_dir)
+    with os.fdopen(fd, 'wb') as f:
+        with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for file_path, name in files:
+                info = zipfile.ZipInfo(name, ZIP_DATE_TIME)
+                info.compress_type = zipfile.ZIP_DEFLATED
+                executable = os.stat(file_path).st_mode & stat.S_IXUSR
+                info.external_attr = (0o755 if executable else 0o644) << 16
+                with open(file_path, 'rb') as src, archive.open(info, 'w', force_zip64=True) as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+    return Archive(source, path, file_digest(path), os.path.getsize(path))
+
+
+def local_code(sam):
+    """
+    Finds the functions whose code property is a local path
+    :param sam: SAM or CFT object
+    :return: OrderedDict of absolute path to the list of resources using it
+    """
+    sources = collections.OrderedDict()
+    for resource in sam.resources:
+        prop = CODE_PROPERTIES.get(resource._resource_type)
+        if prop is None:
+            continue
+        location = resource._data.get(prop[0])
+        if is_local(location):
+            sources.setdefault(os.path.abspath(location), []).append(resource)
+    return sources
+
+
+def build_archives(sources, output_dir, jobs=None):
+    """
+    Builds the archives in a process pool, or in this process for a single source
+    :return: List of Archive in the order of sources
+    """
+    if len(sources) == 1 or jobs == 1:
+        return [build_archive(i, output_dir) for i in sources]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(build_archive, sources, [output_dir] * len(sources)))
+
+
+def upload_archive(sam, archive, bucket, key):
+    """
+    Uploads an archive unless the key already exists. boto3's upload_file
+    switches to a multipart transfer for large archives.
+    :return: True if the archive was uploaded
+    """
+    obj = sam.s3.Object(bucket, key)
+    with instrumentation.span('package.upload', bytes=archive.size, uploaded=False) as s:
+        try:
+            instrumentation.call('s3.head_object', obj.load)
+            return False
+        except clients.client_error() as e:
+            if e.response['Error']['Code'] not in S3_MISSING_CODES:
+                raise e
+        instrumentation.call('s3.upload_file', obj.upload_file, Filename=archive.path)
+        s.set(uploaded=True)
+        return True
+
+
+def package(sam, bucket, prefix='', jobs=None, upload_workers=UPLOAD_WORKERS):
+    """
+    Zips and uploads every local code path of the template, then points the
+    function properties at the uploaded objects
+    :param sam: SAM or CFT object
+    :param bucket: Name of the S3 bucket
+    :param prefix: Prefix of the object keys
+    :param jobs: Number of zip worker processes, defaults to the number of CPUs
+    :param upload_workers: Number of concurrent uploads
+    :return: List of PackagedCode
+    """
+    sources = local_code(sam)
+    if not sources:
+        return []
+    output_dir = tempfile.mkdtemp(prefix='sammy-package-')
+    with instrumentation.span('package', sources=len(sources)) as s:
+        try:
+            with instrumentation.span('package.zip'):
+                archives = build_archives(list(sources), output_dir, jobs)
+            # Zip and jar files uploaded as they are keep their extension
+            keys = ['{}{}{}'.format(prefix, i.digest, os.path.splitext(i.path)[1].lower())
+                    for i in archives]
+            with ThreadPoolExecutor(max_workers=upload_workers) as pool:
+                uploaded = list(pool.map(upload_archive, [sam] * len(archives),
+                                         archives, [bucket] * len(archives), keys))
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+        s.set(uploaded=sum(uploaded))
+
+    results = []
+    for archive, key, was_uploaded in zip(archives, keys, uploaded):
+        resources = sources[archive.source]
+        for resource in resources:
+            name, location = CODE_PROPERTIES[resource._resource_type]
+            setattr(resource, name, location(bucket, key))
+        results.append(PackagedCode(archive.source, bucket, key, archive.size, was_uploaded,
+                                    [i._data['name'] for i in resources]))
+    return results
@@ -0,0 +1,683 @@
+"""
+Splits a rendered template whose resources exceed CloudFormation's limits
+into child templates deployed as nested stacks of a parent template.
+"""
+import collections
+import heapq
+import json
+import re
+
+from sammy import CFT
+
+
+STACK_TYPE = 'AWS::CloudFormation::Stack'
+
+# CloudFormation limits per template
+MAX_RESOURCES = 500
+MAX_PARAMETERS = 200
+MAX_OUTPUTS = 200
+
+# Nested stack templates are passed by URL, which allows 1 MB. The default
+# leaves room for the parameter and output plumbing added to each child.
+MAX_BYTES = 900000
+
+# SAM attributes the parent stack is published with
+PUBLISH_SETTINGS = ('changeset_prefix', 'changeset_wait', 'stack_wait', 'skip_unchanged',
+                    'digest_store', 'state_file', 'template_bucket', 'template_prefix',
+                    'upload_all_templates', 'print_timings')
+
+# APIs the SAM transform creates for Api and HttpApi events without an explicit API
+IMPLICIT_APIS = collections.OrderedDict([('Api', 'ServerlessRestApi'),
+                                         ('HttpApi', 'ServerlessHttpApi')])
+
+SUB_VARIABLE = re.compile(r'\$\{([^!}][^}]*)\}')
+
+Reference = collections.namedtuple("Reference", ["logical_id", "attribute"])
+
+
+def sub_references(text):
+    for name in SUB_VARIABLE.findall(text):
+        name = name.strip()
+        if '.' in name:
+            yield Reference(*name.split('.', 1))
+        else:
+            yield Reference(name, None)
+
+
+def iter_references(node):
+    """
+    Yields (intrinsic, Reference) for every logical ID a template fragment
+    refers to through Ref, Fn::GetAtt or a Fn::Sub variable
+    :param node: Template fragment
+    """
+    if isinstance(node, dict):
+        if len(node) == 1:
+            key, value = next(iter(node.items()))
+            if key == 'Ref' and isinstance(value, str):
+                yield key, Reference(value, None)
+                return
+            if key == 'Fn::GetAtt':
+                if isinstance(value, str):
+                    value = value.split('.', 1)
+                if isinstance(value[0], str):
+                    yield key, Reference(value[0], value[1] if len(value) > 1 else None)
+                    return
+            if key == 'Fn::Sub':
+                if isinstance(value, str):
+                    value = [value, {}]
+                variables = value[1] if len(value) > 1 else {}
+                for i in sub_references(value[0]):
+                    if i.logical_id not in variables:
+                        yield key, i
+                for i in iter_references(variables):
+                    yield i
+                return
+        for v in node.values():
+            for i in iter_references(v):
+                yield i
+    elif isinstance(node, list):
+        for v in node:
+            for i in iter_references(v):
+                yield i
+
+
+def find_references(node):
+    """
+    Yields every logical ID a template fragment refers to through Ref,
+    Fn::GetAtt or a Fn::Sub variable
+    :param node: Template fragment
+    """
+    for _, reference in iter_references(node):
+        yield reference
+
+
+def find_conditions(node):
+    """
+    Yields the condition names used by a template fragment
+    """
+    if isinstance(node, dict):
+        for k, v in node.items():
+            if k == 'Condition' and isinstance(v, str):
+                yield v
+            elif k == 'Fn::If' and isinstance(v, list) and v:
+                yield v[0]
+            for i in find_conditions(v):
+                yield i
+    elif isinstance(node, list):
+        for v in node:
+            for i in find_conditions(v):
+                yield i
+
+
+def rewrite(node, resolve):
+    """
+    Returns a copy of a template fragment with references replaced
+    :param node: Template fragment
+    :param resolve: Called with a Reference, returns the replacement expression or None to keep it
+    """
+    if isinstance(node, dict):
+        if len(node) == 1:
+            key, value = next(iter(node.items()))
+            if key == 'Ref' and isinstance(value, str):
+                return resolve(Reference(value, None)) or node
+            if key == 'Fn::GetAtt':
+                parts = value.split('.', 1) if isinstance(value, str) else value
+                if isinstance(parts[0], str):
+                    return resolve(Reference(parts[0], parts[1])) or node
+            if key == 'Fn::Sub':
+                return rewrite_sub(value, resolve)
+        return {k: rewrite(v, resolve) for k, v in node.items()}
+    if isinstance(node, list):
+        return [rewrite(v, resolve) for v in node]
+    return node
+
+
+def rewrite_sub(value, resolve):
+    if isinstance(value, str):
+        value = [value, {}]
+    text, variables = value[0], dict(value[1]) if len(value) > 1 else {}
+    variables = {k: rewrite(v, resolve) for k, v in variables.items()}
+    local = set(variables)
+
+    def replace(match):
+        name = match.group(1).strip()
+        reference = Reference(*name.split('.', 1)) if '.' in name else Reference(name, None)
+        if reference.logical_id in local:
+            return match.group(0)
+        replacement = resolve(reference)
+        if replacement is None:
+            return match.group(0)
+        if set(replacement) == {'Ref'}:
+            return '${%s}' % replacement['Ref']
+        variable = reference_name(reference, local)
+        variables[variable] = replacement
+        return '${%s}' % variable
+
+    text = SUB_VARIABLE.sub(replace, text)
+    return {'Fn::Sub': [text, variables] if variables else text}
+
+
+def reference_name(reference, taken=()):
+    """
+    Name of the output and parameter that carry a reference between stacks
+    """
+    name = reference.logical_id
+    if reference.attribute is not None:
+        name += re.sub('[^A-Za-z0-9]', '', reference.attribute)
+    while reference.attribute is not None and name in taken:
+        name += 'Attr'
+    return name
+
+
+def resource_dependencies(logical_id, resource, resources, implicit=None):
+    """
+    :param implicit: Dict of implicit API name to the functions that create it.
+        References to the API count as references to one of them.
+    :return: Set of logical IDs the resource depends on
+    """
+    depends_on = resource.get('DependsOn') or []
+    if isinstance(depends_on, str):
+        depends_on = [depends_on]
+    found = set(depends_on)
+    found.update(i.logical_id for i in find_references(
+        {k: v for k, v in resource.items() if k != 'DependsOn'}))
+    found = {implicit[i][0] if i in (implicit or {}) else i for i in found}
+    return {i for i in found if i in resources and i != logical_id}
+
+
+def implicit_api_functions(resources):
+    """
+    Functions whose Api events share the implicit ServerlessRestApi or
+    ServerlessHttpApi. They have to stay in one template or each child would
+    get its own API.
+    :return: Dict of event type to the logical IDs of its functions
+    """
+    groups = collections.OrderedDict((i, []) for i in IMPLICIT_APIS)
+    for logical_id, resource in resources.items():
+        if resource.get('Type') != 'AWS::Serverless::Function':
+            continue
+        events = (resource.get('Properties') or {}).get('Events') or {}
+        for event in events.values():
+            kind = event.get('Type')
+            if kind in ('Api', 'HttpApi') and 'ApiId' not in (event.get('Properties') or {}) \
+                    and 'RestApiId' not in (event.get('Properties') or {}):
+                groups[kind].append(logical_id)
+    return groups
+
+
+def strongly_connected(nodes, edges):
+    """
+    Tarjan's algorithm without recursion
+    :param nodes: Iterable of nodes
+    :param edges: Dict of node to the nodes it points at
+    :return: List of sets
+    """
+    index, lowlink, on_stack = {}, {}, set()
+    stack, components = [], []
+    counter = 0
+    for root in nodes:
+        if root in index:
+            continue
+        work = [(root, iter(sorted(edges.get(root, ()))))]
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in index:
+                    index[child] = lowlink[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(sorted(edges.get(child, ())))))
+                    break
+                if child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = set()
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.add(member)
+                        if member == node:
+                            break
+                    components.append(component)
+    return components
+
+
+class Unit(object):
+    """
+    Resources that have to share a template: a dependency cycle or
+    functions on the implicit API
+    """
+
+    def __init__(self, order, members, sizes):
+        self.order = order
+        self.members = sorted(members)
+        self.count = len(members)
+        self.bytes = sum(sizes[i] for i in members)
+        self.depends_on = set()
+        self.neighbours = set()
+
+    def __repr__(self):
+        return '<Unit: {} >'.format(', '.join(self.members))
+
+    def __lt__(self, other):
+        return self.order < other.order
+
+
+class Bin(object):
+
+    def __init__(self):
+        self.units = []
+        self.count = 0
+        self.bytes = 0
+
+    def fits(self, unit, max_resources, max_bytes):
+        return self.count + unit.count <= max_resources and self.bytes + unit.bytes <= max_bytes
+
+    def add(self, unit):
+        self.units.append(unit)
+        self.count += unit.count
+        self.bytes += unit.bytes
+
+
+def build_units(resources, dependencies, sizes):
+    owner = {}
+    groups = [set(i) for i in implicit_api_functions(resources).values() if i]
+    for group in groups:
+        for i in group:
+            owner[i] = group
+    for logical_id in resources:
+        owner.setdefault(logical_id, {logical_id})
+    merged = {}
+    for group in owner.values():
+        merged[min(group)] = group
+    group_of = {m: k for k, group in merged.items() for m in group}
+    edges = collections.defaultdict(set)
+    for logical_id, deps in dependencies.items():
+        for dep in deps:
+            if group_of[dep] != group_of[logical_id]:
+                edges[group_of[logical_id]].add(group_of[dep])
+
+    units, unit_of = [], {}
+    for members in strongly_connected(list(merged), edges):
+        resource_ids = set()
+        for group in members:
+            resource_ids.update(merged[group])
+        unit = Unit(len(units), resource_ids, sizes)
+        units.append(unit)
+        for i in resource_ids:
+            unit_of[i] = unit
+    units.sort(key=lambda i: i.members[0])
+    for order, unit in enumerate(units):
+        unit.order = order
+    for logical_id, deps in dependencies.items():
+        for dep in deps:
+            a, b = unit_of[logical_id], unit_of[dep]
+            if a is not b:
+                a.depends_on.add(b)
+                a.neighbours.add(b)
+                b.neighbours.add(a)
+    return units
+
+
+def connected_components(units):
+    seen, components = set(), []
+    for unit in units:
+        if unit in seen:
+            continue
+        component, todo = [], [unit]
+        seen.add(unit)
+        while todo:
+            current = todo.pop()
+            component.append(current)
+            for i in current.neighbours:
+                if i not in seen:
+                    seen.add(i)
+                    todo.append(i)
+        components.append(sorted(component))
+    return components
+
+
+def grow_chunks(units, max_resources, max_bytes, reverse=False):
+    """
+    Grows chunks along the dependency order, always adding the ready unit
+    with the most edges into the current chunk. A unit is ready once its
+    dependencies are placed, or its dependents when reverse is set, so
+    chunks never depend on each other in a cycle.
+    """
+    members = set(units)
+    before = {u: u.depends_on & members for u in units}
+    if reverse:
+        dependents = {u: set() for u in units}
+        for u, deps in before.items():
+            for d in deps:
+                dependents[d].add(u)
+        before = dependents
+    pending = {u: len(before[u]) for u in units}
+    after = collections.defaultdict(list)
+    for u in units:
+        for d in before[u]:
+            after[d].append(u)
+    ready = {u for u in units if pending[u] == 0}
+    score = collections.Counter()
+    heap = [(0, u) for u in ready]
+    heapq.heapify(heap)
+    chunks, current, chosen = [], Bin(), set()
+
+    while heap:
+        negative_score, unit = heapq.heappop(heap)
+        if unit not in ready or -negative_score != score[unit]:
+            continue
+        if not current.fits(unit, max_resources, max_bytes):
+            chunks.append(current)
+            current, chosen = Bin(), set()
+            score.clear()
+            heap = [(0, u) for u in ready]
+            heapq.heapify(heap)
+            continue
+        ready.discard(unit)
+        current.add(unit)
+        chosen.add(unit)
+        for n in unit.neighbours:
+            if n in members and n not in chosen:
+                score[n] += 1
+                if n in ready:
+                    heapq.heappush(heap, (-score[n], n))
+        for d in after[unit]:
+            pending[d] -= 1
+            if pending[d] == 0:
+                ready.add(d)
+                heapq.heappush(heap, (-score[d], d))
+    if current.units:
+        chunks.append(current)
+    return chunks[::-1] if reverse else chunks
+
+
+def cut_size(chunks):
+    chunk_of = {u: i for i, chunk in enumerate(chunks) for u in chunk.units}
+    return sum(1 for u, i in chunk_of.items() for d in u.depends_on
+               if chunk_of.get(d, i) != i)
+
+
+def split_component(units, max_resources, max_bytes):
+    """
+    Splits a component that exceeds the limits, growing chunks from its
+    roots and from its leaves and keeping the split with fewer edges
+    between chunks
+    """
+    forward = grow_chunks(units, max_resources, max_bytes)
+    backward = grow_chunks(units, max_resources, max_bytes, reverse=True)
+    return min(forward, backward, key=cut_size)
+
+
+def assign(resources, max_resources=MAX_RESOURCES, max_bytes=MAX_BYTES):
+    """
+    Groups resources into partitions within the limits, keeping connected
+    resources together where possible
+    :param resources: Dict of logical ID to resource
+    :return: List of sorted lists of logical IDs
+    """
+    sizes = {k: len(json.dumps(v, separators=(',', ':'))) for k, v in resources.items()}
+    implicit = {IMPLICIT_APIS[k]: v for k, v in implicit_api_functions(resources).items() if v}
+    dependencies = {k: resource_dependencies(k, v, resources, implicit)
+                    for k, v in resources.items()}
+    units = build_units(resources, dependencies, sizes)
+    for unit in units:
+        if unit.count > max_resources or unit.bytes > max_bytes:
+            raise ValueError('Resources {} have to share a template but exceed the '
+                             'partition limits'.format(', '.join(unit.members)))
+
+    bins, whole = [], []
+    for component in connected_components(units):
+        count = sum(i.count for i in component)
+        size = sum(i.bytes for i in component)
+        if count <= max_resources and size <= max_bytes:
+            whole.append(component)
+        else:
+            bins.extend(split_component(component, max_resources, max_bytes))
+
+    # Components without edges between them can share any template
+    whole.sort(key=lambda c: (-sum(i.count for i in c), c[0].order))
+    for component in whole:
+        unit = Unit(component[0].order, [m for u in component for m in u.members], sizes)
+        target = next((b for b in bins if b.fits(unit, max_resources, max_bytes)), None)
+        if target is None:
+            target = Bin()
+            bins.append(target)
+        target.add(unit)
+    return [sorted(m for u in b.units for m in u.members) for b in bins]
+
+
+class NestedStacks(object):
+    """
+    Child templates and the plumbing a parent template needs to deploy them
+    as nested stacks. Children only depend on the children whose outputs
+    they consume, so CloudFormation creates the others in parallel.
+    """
+
+    def __init__(self, template, partitions, prefix='Stack'):
+        """
+        :param template: Rendered template dict
+        :param partitions: Lists of logical IDs, see assign
+        :param prefix: Prefix of the nested stack logical IDs
+        """
+        self.template = template
+        self.names = ['{}{}'.format(prefix, i + 1) for i in range(len(partitions))]
+        resources = template.get('Resources') or {}
+        self.partition_of = {r: name for name, members in zip(self.names, partitions)
+                             for r in members}
+        self.members = collections.OrderedDict(zip(self.names, partitions))
+        for kind, functions in implicit_api_functions(resources).items():
+            if functions:
+                self.partition_of[IMPLICIT_APIS[kind]] = self.partition_of[functions[0]]
+        self.taken = set(resources) | set(template.get('Parameters') or {})
+        clash = self.taken & set(self.names)
+        if clash:
+            raise ValueError('Nested stack names clash with {}'.format(', '.join(sorted(clash))))
+        self.exports = {name: collections.OrderedDict() for name in self.names}
+        self.imports = {name: collections.OrderedDict() for name in self.names}
+        self.dependencies = {name: set() for name in self.names}
+        self.resources = {name: self.child_resources(name) for name in self.names}
+        self.outputs = self.parent_outputs()
+        self.children = collections.OrderedDict(
+            (name, self.child_template(name)) for name in self.names)
+
+    def __repr__(self):
+        return '<NestedStacks: {} >'.format(', '.join(self.names))
+
+    @property
+    def cross_references(self):
+        return sum(len(i) for i in self.exports.values())
+
+    def export(self, partition, reference):
+        name = reference_name(reference, self.taken)
+        if reference.attribute is None:
+            value = {'Ref': reference.logical_id}
+        else:
+            value = {'Fn::GetAtt': [reference.logical_id, reference.attribute]}
+        self.exports[partition][name] = value
+        return name
+
+    def child_resources(self, partition):
+        members = set(self.members[partition])
+        resources = self.template['Resources']
+
+        def resolve(reference):
+            owner = self.partition_of.get(reference.logical_id)
+            if owner is None or owner == partition:
+                return None
+            name = self.export(owner, reference)
+            self.imports[partition][name] = {'Fn::GetAtt': [owner, 'Outputs.{}'.format(name)]}
+            self.dependencies[partition].add(owner)
+            return {'Ref': name}
+
+        child = collections.OrderedDict()
+        for logical_id in self.members[partition]:
+            resource = dict(resources[logical_id])
+            depends_on = resource.pop('DependsOn', None)
+            resource = rewrite(resource, resolve)
+            if depends_on:
+                depends_on = [depends_on] if isinstance(depends_on, str) else depends_on
+                undeclared = [i for i in depends_on if i not in self.partition_of]
+                if undeclared:
+                    raise ValueError('{} depends on undeclared resource(s) {}'.format(
+                        logical_id, ', '.join(undeclared)))
+                local = [i for i in depends_on if i in members]
+                self.dependencies[partition].update(
+                    self.partition_of[i] for i in depends_on if i not in members)
+                if local:
+                    resource['DependsOn'] = local
+            child[logical_id] = resource
+        return child
+
+    def parent_outputs(self):
+        def resolve(reference):
+            owner = self.partition_of.get(reference.logical_id)
+            if owner is None:
+                return None
+            name = self.export(owner, reference)
+            return {'Fn::GetAtt': [owner, 'Outputs.{}'.format(name)]}
+
+        return rewrite(self.template.get('Outputs') or {}, resolve)
+
+    def used_conditions(self, node):
+        conditions = self.template.get('Conditions') or {}
+        used, todo = set(), list(find_conditions(node))
+        while todo:
+            name = todo.pop()
+            if name in conditions and name not in used:
+                used.add(name)
+                todo.extend(find_conditions(conditions[name]))
+        return collections.OrderedDict((k, v) for k, v in conditions.items() if k in used)
+
+    def used_parameters(self, *nodes, **kwargs):
+        parameters = self.template.get('Parameters') or {}
+        used = set(kwargs.get('names', ()))
+        used.update(i.logical_id for node in nodes for i in find_references(node))
+        return collections.OrderedDict((k, v) for k, v in parameters.items() if k in used)
+
+    def child_template(self, partition):
+        resources = self.resources[partition]
+        conditions = self.used_conditions(resources)
+        template = collections.OrderedDict()
+        template['AWSTemplateFormatVersion'] = self.template.get(
+            'AWSTemplateFormatVersion', '2010-09-09')
+        serverless = any(str(i.get('Type', '')).startswith('AWS::Serverless::')
+                         for i in resources.values())
+        if serverless and self.template.get('Transform'):
+            template['Transform'] = self.template['Transform']
+            if self.template.get('Globals'):
+                template['Globals'] = self.template['Globals']
+        parameters = self.used_parameters(resources, conditions, template.get('Globals'))
+        for name in self.imports[partition]:
+            parameters[name] = {'Type': 'String'}
+        if parameters:
+            template['Parameters'] = parameters
+        if self.template.get('Mappings'):
+            template['Mappings'] = self.template['Mappings']
+        if conditions:
+            template['Conditions'] = conditions
+        template['Resources'] = resources
+        if self.exports[partition]:
+            template['Outputs'] = collections.OrderedDict(
+                (k, {'Value': v}) for k, v in self.exports[partition].items())
+        if len(parameters) > MAX_PARAMETERS or len(self.exports[partition]) > MAX_OUTPUTS:
+            raise ValueError('{} needs more than {} parameters or outputs; allow larger '
+                             'partitions'.format(partition, MAX_PARAMETERS))
+        return template
+
+    def levels(self):
+        """
+        Groups the children into waves that can be deployed at the same time
+        :return: List of lists of nested stack names
+        """
+        done, levels = set(), []
+        while len(done) < len(self.names):
+            level = [i for i in self.names if i not in done and self.dependencies[i] <= done]
+            if not level:
+                raise ValueError('Nested stacks {} depend on each other in a cycle'.format(
+                    ', '.join(i for i in self.names if i not in done)))
+            levels.append(level)
+            done.update(level)
+        return levels
+
+    def parent_template(self, template_urls):
+        """
+        Builds the parent template
+        :param template_urls: Dict of nested stack name to the URL of its uploaded template
+        :return: Template dict
+        """
+        template = collections.OrderedDict()
+        template['AWSTemplateFormatVersion'] = self.template.get(
+            'AWSTemplateFormatVersion', '2010-09-09')
+        if self.template.get('Description'):
+            template['Description'] = self.template['Description']
+        conditions = self.used_conditions(self.outputs)
+        parameters = self.used_parameters(self.outputs, conditions, names=[
+            k for child in self.children.values() for k in child.get('Parameters', {})])
+        if parameters:
+            template['Parameters'] = parameters
+        if self.template.get('Mappings') and conditions:
+            template['Mappings'] = self.template['Mappings']
+        if conditions:
+            template['Conditions'] = conditions
+        resources = collections.OrderedDict()
+        for name, child in self.children.items():
+            stack_parameters = collections.OrderedDict(
+                (k, {'Ref': k}) for k in child.get('Parameters', {}) if k in parameters)
+            stack_parameters.update(self.imports[name])
+            properties = collections.OrderedDict([('TemplateURL', template_urls[name])])
+            if stack_parameters:
+                properties['Parameters'] = stack_parameters
+            resources[name] = collections.OrderedDict([('Type', STACK_TYPE),
+                                                       ('Properties', properties)])
+            if self.dependencies[name]:
+                resources[name]['DependsOn'] = sorted(self.dependencies[name])
+        template['Resources'] = resources
+        if self.outputs:
+            template['Outputs'] = self.outputs
+        return template
+
+
+def partition(template, max_resources=MAX_RESOURCES, max_bytes=MAX_BYTES, prefix='Stack'):
+    """
+    Splits a rendered template into nested stack templates
+    :param template: Rendered template dict
+    :param max_resources: Most resources per child template. SAM resources count once although the transform expands them.
+    :param max_bytes: Most bytes of resources per child template
+    :param prefix: Prefix of the nested stack logical IDs
+    :return: NestedStacks
+    """
+    partitions = assign(template.get('Resources') or {}, max_resources, max_bytes)
+    return NestedStacks(template, partitions, prefix)
+
+
+class ParentStack(CFT):
+    """
+    Publishes the parent template of nested stacks with the settings and
+    AWS clients of the SAM object it was split from
+    """
+
+    def __init__(self, sam, template):
+        super(ParentStack, self).__init__(region_name=sam.region_name,
+                                          profile_name=sam.profile_name)
+        for name in PUBLISH_SETTINGS:
+            setattr(self, name, getattr(sam, name))
+        self._aws_config = sam._aws_config
+        self._aws_pool = sam._aws_pool
+        self._aws_overrides = dict(sam._aws_overrides)
+        self.capabilities = list(sam.capabilities) + ['CAPABILITY_AUTO_EXPAND']
+        self.render_type = 'json'
+        self.template = template
+
+    def to_dict(self, resources=None):
+        return self.template
@@ -0,0 +1,230 @@
+"""
+Indexes the Ref, Fn::GetAtt, Fn::Sub and DependsOn edges of a rendered
+template, and optionally rewrites it before publishing: parameters whose
+values are known are folded into literals and resources marked prunable
+that nothing refers to are dropped. References to logical IDs the template
+does not declare are found without a changeset.
+"""
+import collections
+
+from sammy.hoisting import plain
+from sammy.partition import IMPLICIT_APIS, SUB_VARIABLE, find_conditions, \
+    implicit_api_functions, iter_references
+
+
+PSEUDO_PARAMETERS = ('AWS::AccountId', 'AWS::NotificationARNs', 'AWS::NoValue',
+                     'AWS::Partition', 'AWS::Region', 'AWS::StackId', 'AWS::StackName',
+                     'AWS::URLSuffix')
+
+# Parameter types whose Ref gives the value passed at publish time. SSM
+# parameter types give the stored value instead, so they are never folded.
+FOLDABLE_TYPES = ('String', 'Number', 'CommaDelimitedList')
+
+# Start of the logical IDs the SAM transform derives from a resource's, such as FunctionRole
+GENERATED_PREFIXES = ('Role', 'Alias', 'Version', 'Deployment')
+
+Edge = collections.namedtuple('Edge', ['source', 'target', 'attribute', 'kind'])
+
+Optimized = collections.namedtuple('Optimized', ['template', 'folded', 'pruned', 'dangling'])
+
+
+def is_list_type(parameter_type):
+    return parameter_type == 'CommaDelimitedList' or parameter_type.startswith('List<')
+
+
+class ReferenceIndex(object):
+    """
+    Edges from the resources, outputs, Globals sections and conditions of a
+    template to the logical IDs and conditions they refer to. Sources other
+    than resources are named like Outputs.Name.
+    """
+
+    def __init__(self, template):
+        """
+        :param template: Template dict with intrinsics as dicts
+        """
+        self.resources = template.get('Resources') or {}
+        self.parameters = template.get('Parameters') or {}
+        self.conditions = template.get('Conditions') or {}
+        self.edges = []
+        for logical_id, resource in self.resources.items():
+            self.add(logical_id, {k: v for k, v in resource.items() if k != 'DependsOn'})
+            depends_on = resource.get('DependsOn') or []
+            if isinstance(depends_on, str):
+                depends_on = [depends_on]
+            for i in depends_on:
+                self.edges.append(Edge(logical_id, i, None, 'DependsOn'))
+        for section in ('Outputs', 'Globals', 'Conditions'):
+            for name, value in (template.get(section) or {}).items():
+                self.add('{}.{}'.format(section, name), value)
+
+        self.referrers = collections.defaultdict(list)
+        for edge in self.edges:
+            self.referrers[edge.target].append(edge)
+
+        # Resources the SAM transform adds, which templates may refer to
+        self.generated = [IMPLICIT_APIS[k] for k, v in
+                          implicit_api_functions(self.resources).items() if v]
+        self.serverless = [k for k, v in self.resources.items()
+                           if (v.get('Type') or '').startswith('AWS::Serverless::')]
+
+    def add(self, source, node):
+        for kind, reference in iter_references(node):
+            self.edges.append(Edge(source, reference.logical_id, reference.attribute, kind))
+        for name in find_conditions(node):
+            self.edges.append(Edge(source, name, None, 'Condition'))
+
+    def is_declared(self, edge):
+        if edge.kind == 'Condition':
+            return edge.target in self.conditions
+        # Ref: Function.Alias and Api.Stage refer to resources SAM generates
+        target = edge.target.split('.', 1)[0] if edge.kind == 'Ref' else edge.target
+        if target in self.resources or target in self.parameters or \
+                target in PSEUDO_PARAMETERS or target in self.generated:
+            return True
+        # Roles, versions, deployments and stages generated for SAM resources
+        return any(target.startswith(i) and (target[len(i):].startswith(GENERATED_PREFIXES) or
+                                             target.endswith('Stage'))
+                   for i in self.serverless)
+
+    def dangling(self):
+        """
+        :return: List of Edge to logical IDs or conditions the template does not declare
+        """
+        return [i for i in self.edges if not self.is_declared(i)]
+
+    def unreferenced(self):
+        """
+        :return: Logical IDs of the resources nothing else refers to
+        """
+        return [i for i in self.resources
+                if not any(e.source != i for e in self.referrers.get(i, ()))]
+
+
+def fold(node, values, folded):
+    """
+    Returns a copy of a template fragment with Refs to the given parameters
+    replaced by their values. Fn::Sub and Fn::Join expressions left with
+    only literals become strings.
+    :param values: Dict of parameter name to its value, a list for list types
+    :param folded: Set the folded parameter names are added to
+    """
+    if isinstance(node, dict):
+        if len(node) == 1:
+            key, value = next(iter(node.items()))
+            if key == 'Ref' and isinstance(value, str) and value in values:
+                folded.add(value)
+                return values[value]
+            if key == 'Fn::Sub':
+                return fold_sub(value, values, folded)
+            if key == 'Fn::Join' and isinstance(value, list) and len(value) == 2:
+                delimiter, parts = fold(value, values, folded)
+                if isinstance(parts, list) and all(isinstance(i, str) for i in parts + [delimiter]):
+                    return delimiter.join(parts)
+                return {key: [delimiter, parts]}
+        return {k: fold(v, values, folded) for k, v in node.items()}
+    if isinstance(node, list):
+        return [fold(v, values, folded) for v in node]
+    return node
+
+
+def fold_sub(value, values, folded):
+    text, variables = (value, {}) if isinstance(value, str) else \
+        (value[0], value[1] if len(value) > 1 else {})
+    if not isinstance(text, str):
+        return {'Fn::Sub': fold(value, values, folded)}
+    variables = {k: fold(v, values, folded) for k, v in variables.items()}
+
+    def replace(match):
+        name = match.group(1).strip()
+        if name in variables:
+            literal = variables[name]
+        else:
+            literal = values.get(name)
+            if isinstance(literal, str):
+                folded.add(name)
+        if not isinstance(literal, str):
+            return match.group(0)
+        # Keep ${ in the value literal
+        return literal.replace('${', '${!')
+
+    text = SUB_VARIABLE.sub(replace, text)
+    variables = {k: v for k, v in variables.items() if not isinstance(v, str)}
+    if variables:
+        return {'Fn::Sub': [text, variables]}
+    if SUB_VARIABLE.search(text):
+        return {'Fn::Sub': text}
+    return text.replace('${!', '${')
+
+
+def fold_parameters(template, parameters):
+    """
+    Folds the parameters given at publish time into the template. Parameters
+    keep their declarations, as their values are still passed.
+    :param template: Template dict with intrinsics as dicts, not modified
+    :param parameters: Dict of parameter values
+    :return: (template, sorted names of the folded parameters)
+    """
+    declared = template.get('Parameters') or {}
+    values = {}
+    for name, value in parameters.items():
+        parameter = declared.get(name) or {}
+        parameter_type = parameter.get('Type') or ''
+        if parameter.get('NoEcho') or not (parameter_type in FOLDABLE_TYPES or
+                                           parameter_type.startswith('List<')):
+            continue
+        value = str(value)
+        values[name] = value.split(',') if is_list_type(parameter_type) else value
+    if not values:
+        return template, []
+    folded = set()
+    template = {k: v if k == 'Parameters' else fold(v, values, folded)
+                for k, v in template.items()}
+    return template, sorted(folded)
+
+
+def prune(template, prunable):
+    """
+    Removes the prunable resources that no other resource, output or Globals
+    section refers to. Resources only referred to by pruned resources are
+    pruned too.
+    :param template: Template dict with intrinsics as dicts, not modified
+    :param prunable: Logical IDs that may be removed
+    :return: (template, list of the pruned logical IDs)
+    """
+    index = ReferenceIndex(template)
+    candidates = [i for i in prunable if i in index.resources]
+    pruned = []
+    changed = True
+    while changed:
+        changed = False
+        for logical_id in candidates:
+            if logical_id in pruned:
+                continue
+            if any(e.source != logical_id and e.source not in pruned
+                   for e in index.referrers.get(logical_id, ())):
+                continue
+            pruned.append(logical_id)
+            changed = True
+    if not pruned:
+        return template, pruned
+    resources = {k: v for k, v in index.resources.items() if k not in pruned}
+    return dict(template, Resources=resources), pruned
+
+
+def optimize(template, parameters=None, prunable=()):
+    """
+    Folds known parameters, prunes unreferenced prunable resources and finds
+    dangling references
+    :param template: Rendered template dict, not modified
+    :param parameters: Dict of parameter values to fold
+    :param prunable: Logical IDs of resources that may be removed
+    :return: Optimized
+    """
+    template = plain(template)
+    folded, pruned = [], []
+    if parameters:
+        template, folded = fold_parameters(template, parameters)
+    if prunable:
+        template, pruned = prune(template, prunable)
+    return Optimized(template, folded, pruned, ReferenceIndex(template).dangling())
@@ -0,0 +1,113 @@
+from sammy import instrumentation
+from sammy.exceptions import DeployFailedError
+
+
+OPERATION_DONE_STATUSES = ('SUCCEEDED', 'FAILED', 'STOPPED')
+
+DEFAULT_OPERATION_PREFERENCES = {
+    'RegionConcurrencyType': 'PARALLEL',
+    'MaxConcurrentPercentage': 100,
+    'FailureToleranceCount': 0,
+}
+
+
+def list_stack_instances(cf_client, stackset_name):
+    """
+    Lists every stack instance of a stack set, following NextToken
+    :param cf_client: CloudFormation client
+    :param stackset_name: Name of the stack set
+    :return: List of stack instance summaries
+    """
+    summaries = []
+    kwargs = {'StackSetName': stackset_name}
+    while True:
+        response = instrumentation.call('cloudformation.list_stack_instances',
+                                        cf_client.list_stack_instances, **kwargs)
+        summaries.extend(response['Summaries'])
+        if not response.get('NextToken'):
+            return summaries
+        kwargs['NextToken'] = response['NextToken']
+
+
+def is_failed_instance(summary):
+    detailed_status = summary.get('StackInstanceStatus', {}).get('DetailedStatus')
+    return summary.get('Status') == 'INOPERABLE' or detailed_status in ('FAILED', 'CANCELLED')
+
+
+class StackSetOperation(object):
+    """
+    Handle on a running stack set operation. SAM.publish_global returns it
+    when called with wait=False so the rollout can be awaited later.
+    """
+
+    def __init__(self, cf_client, stackset_name, operation_id, regions,
+                 wait_strategy, operation_preferences=None):
+        self.cf_client = cf_client
+        self.stackset_name = stackset_name
+        self.operation_id = operation_id
+        self.regions = list(regions)
+        self.wait_strategy = wait_strategy
+        self.operation_preferences = operation_preferences or {}
+        self.status = None
+        self.instances = []
+
+    def __repr__(self):
+        return '<StackSetOperation: {} {} {} >'.format(
+            self.stackset_name, self.operation_id, self.status)
+
+    @property
+    def failure_tolerance(self):
+        prefs = self.operation_preferences
+        if 'FailureTolerancePercentage' in prefs:
+            return len(self.regions) * prefs['FailureTolerancePercentage'] // 100
+        return prefs.get('FailureToleranceCount', 0)
+
+    @property
+    def failed_instances(self):
+        return [i for i in self.instances if is_failed_instance(i)]
+
+    def refresh(self):
+        """
+        Fetches the operation status and the stack instances
+        :return: Operation status
+        """
+        self.status = instrumentation.call(
+            'cloudformation.describe_stack_set_operation',
+            self.cf_client.describe_stack_set_operation,
+            StackSetName=self.stackset_name,
+            OperationId=self.operation_id)['StackSetOperation']['Status']
+        self.instances = list_stack_instances(self.cf_client, self.stackset_name)
+        return self.status
+
+    def done(self):
+        """
+        Refreshes the operation and checks whether it finished. Raises
+        DeployFailedError as soon as more instances failed than the
+        operation preferences tolerate, or the operation failed.
+        :return: bool
+        """
+        status = self.refresh()
+        failed = self.failed_instances
+        if status in ('FAILED', 'STOPPED') or len(failed) > self.failure_tolerance:
+            reasons = '; '.join('{}: {}'.format(i.get('Region'), i.get('StatusReason'))
+                                for i in failed)
+            raise DeployFailedError('Stack set {} operation {} {}. {}'.format(
+                self.stackset_name, self.operation_id, status.lower(), reasons).strip())
+        if status == 'SUCCEEDED':
+            return True
+        current = len([i for i in self.instances if i.get('Status') == 'CURRENT'])
+        print('{} of the {} stack instances of {} are current. Operation {} is {}.'.format(
+            current, len(self.regions), self.stackset_name, self.operation_id, status))
+        return False
+
+    def wait(self):
+        """
+        Blocks until the operation succeeds
+        :return: self
+        """
+        with instrumentation.span('stackset_wait') as s:
+            result = self.wait_strategy.wait(lambda: True if self.done() else None,
+                                             'stack set operation {}'.format(self.operation_id))
+            s.set(polls=result.polls, regions=len(self.regions))
+        print('Stack Set Creation Completed')
+        return self
@@ -0,0 +1,41 @@
+import json
+import os
+import threading
+
+
+_lock = threading.Lock()
+
+
+def read_digest(path, key):
+    """
+    Reads the digest recorded for a stack from a local state file
+    :param path: Path of the JSON state file
+    :param key: Stack key, see SAM.state_key
+    :return: str or None
+    """
+    with _lock:
+        try:
+            with open(path, 'r') as f:
+                return json.load(f).get(key)
+        except (IOError, ValueError):
+            return None
+
+
+def write_digest(path, key, digest):
+    """
+    Records the digest deployed to a stack in a local state file
+    :param path: Path of the JSON state file
+    :param key: Stack key, see SAM.state_key
+    :param digest: Template and parameter digest
+    """
+    with _lock:
+        try:
+            with open(path, 'r') as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            state = {}
+        state[key] = digest
+        tmp_path = '{}.tmp'.format(path)
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
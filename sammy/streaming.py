@@ -0,0 +1,184 @@
+"""
+Renders templates as a stream of fragments, one resource at a time, so
+large templates never exist as a single string.
+"""
+import collections.abc
+import io
+import json
+
+from valley.utils.json_utils import ValleyEncoderNoType
+
+from sammy import instrumentation
+
+
+# Smallest part size S3 accepts for every part but the last
+MIN_PART_SIZE = 5 * 2 ** 20
+
+
+class ResourceStream(collections.abc.Mapping):
+    """
+    Resources section that renders each resource when it is read. Fragments
+    that are not cached already are not kept, so a template is written
+    holding one rendered resource at a time.
+    """
+
+    def __init__(self, resources, minify=False):
+        """
+        :param resources: Dict of logical ID to Resource
+        :param minify: Leave out empty Properties maps
+        """
+        self.resources = resources
+        self.minify = minify
+
+    def __getitem__(self, name):
+        from sammy import strip_empty_properties
+
+        resource = self.resources[name]
+        fragment = (resource._render_cache or resource.to_dict())['r']
+        if self.minify:
+            fragment = strip_empty_properties({'Resources': {name: fragment}})['Resources'][name]
+        return fragment
+
+    def __iter__(self):
+        return iter(self.resources)
+
+    def __len__(self):
+        return len(self.resources)
+
+
+def iter_json(template, minify=False):
+    """
+    Yields the same text as json.dumps(template), one section or resource
+    at a time
+    :param template: Template dict
+    :param minify: Use compact separators
+    """
+    item_separator, key_separator = (',', ':') if minify else (', ', ': ')
+
+    def dumps(value):
+        return json.dumps(value, cls=ValleyEncoderNoType,
+                          separators=(item_separator, key_separator))
+
+    yield '{'
+    for i, (key, value) in enumerate(template.items()):
+        if i:
+            yield item_separator
+        yield dumps(key) + key_separator
+        if key != 'Resources':
+            yield dumps(value)
+            continue
+        yield '{'
+        for j, (name, resource) in enumerate(value.items()):
+            if j:
+                yield item_separator
+            yield dumps(name) + key_separator + dumps(resource)
+        yield '}'
+    yield '}'
+
+
+def iter_yaml(template, minify=False):
+    """
+    Yields the same text as dumping the template with the template dumper,
+    one section or resource at a time. Keys are sorted like yaml.dump sorts
+    them. Each resource is dumped at its place in the document so line
+    wrapping matches the full dump.
+    :param template: Template dict
+    :param minify: Use flow style on a single line
+    """
+    from sammy import YAML_MAX_WIDTH, dumper
+
+    if minify:
+        def dump(value):
+            return dumper.dump(value, default_flow_style=True, width=YAML_MAX_WIDTH)[:-1]
+
+        yield '{'
+        for i, key in enumerate(sorted(template)):
+            if i:
+                yield ', '
+            if key != 'Resources':
+                yield dump({key: template[key]})[1:-1]
+                continue
+            yield 'Resources: {'
+            for j, name in enumerate(sorted(template[key])):
+                if j:
+                    yield ', '
+                yield dump({name: template[key][name]})[1:-1]
+            yield '}'
+        yield '}\n'
+        return
+
+    for key in sorted(template):
+        if key != 'Resources' or not template[key]:
+            yield dumper.dump({key: template[key]}, default_flow_style=False)
+            continue
+        yield 'Resources:\n'
+        for name in sorted(template[key]):
+            fragment = dumper.dump({key: {name: template[key][name]}}, default_flow_style=False)
+            yield fragment[len('Resources:\n'):]
+
+
+class S3StreamWriter(object):
+    """
+    File-like object that uploads what is written to an S3 object. Data is
+    sent in parts of part_size bytes through a multipart upload. Objects
+    smaller than one part are uploaded with a single put.
+    """
+
+    def __init__(self, s3_object, part_size=MIN_PART_SIZE):
+        """
+        :param s3_object: boto3 S3 Object resource
+        :param part_size: Bytes per part. S3 rejects parts under 5 MiB except the last.
+        """
+        self.s3_object = s3_object
+        self.part_size = part_size
+        self.buffer = io.BytesIO()
+        self.upload = None
+        self.parts = []
+        self.bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.buffer.write(data)
+        self.bytes += len(data)
+        if self.buffer.tell() >= self.part_size:
+            self.flush_part()
+        return len(data)
+
+    def flush_part(self):
+        if self.upload is None:
+            self.upload = instrumentation.call('s3.create_multipart_upload',
+                                               self.s3_object.initiate_multipart_upload)
+        body = self.buffer.getvalue()
+        self.buffer = io.BytesIO()
+        number = len(self.parts) + 1
+        part = self.upload.Part(number)
+        with instrumentation.span('s3.upload_part', bytes=len(body)):
+            response = part.upload(Body=body)
+        self.parts.append({'PartNumber': number, 'ETag': response['ETag']})
+
+    def close(self):
+        """
+        Uploads the buffered data and completes the upload
+        """
+        if self.upload is None:
+            instrumentation.call('s3.put_object', self.s3_object.put,
+                                 Body=self.buffer.getvalue())
+            return
+        if self.buffer.tell():
+            self.flush_part()
+        instrumentation.call('s3.complete_multipart_upload', self.upload.complete,
+                             MultipartUpload={'Parts': self.parts})
+
+    def abort(self):
+        if self.upload is not None:
+            instrumentation.call('s3.abort_multipart_upload', self.upload.abort)
@@ -1,7 +1,40 @@
 import unittest
+import collections
+import contextlib
+import datetime
+import gc
+import io
+import json
 import pathlib as pl
+import pickle
 import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+import weakref
+import zipfile
+
+import botocore.exceptions
 import yaml
+from valley.exceptions import ValidationException
+
+import sammy as sm
+from sammy import cli
+from sammy import clients
+from sammy import diff as sdiff
+from sammy import hoisting
+from sammy import instrumentation
+from sammy import packaging
+from sammy import partition
+from sammy import references
+from sammy import streaming
+from sammy.deploy import infer_dependencies, publish_many
+from sammy.exceptions import DeployFailedError, StackFailedError
+from sammy.fake import FakeAWS
+from sammy.waiters import Backoff
 
 from sammy.examples.alexa_skill import sam as al
 from sammy.examples.api_backend import sam as ab
@@ -17,7 +50,7 @@ class AlexaTestCase(unittest.TestCase):
             pl.PurePath(
                 os.path.abspath(__file__)).parent / 'examples/yaml', self.template_name)
         with open(template_path, 'r') as f:
-            self.template_dict = yaml.load(f)
+            self.template_dict = yaml.safe_load(f)
 
     def test_template(self):
         s = yaml.safe_load(self.template.get_template())
@@ -31,4 +64,1491 @@ class APIBackendTestCase(AlexaTestCase):
 
 class HelloWorldTestCase(AlexaTestCase):
     template_name = 'hello_world.yaml'
-    template = hw
\ No newline at end of file
+    template = hw
+
+class YAMLRenderTestCase(unittest.TestCase):
+
+    def test_shared_schema_objects_render_without_aliases(self):
+        table = sm.Ref(Ref='Table')
+        sam = sm.SAM()
+        for name in ('GetFunction', 'PutFunction'):
+            sam.add_resource(sm.Function(
+                name=name, Handler='index.handler', Runtime='python3.6',
+                Environment=sm.Environment(Variables={'TABLE_NAME': table})))
+        rendered = sam.to_yaml()
+        self.assertNotIn('&id', rendered)
+        self.assertEqual(
+            yaml.safe_load(rendered)['Resources']['PutFunction']['Properties']['Environment'],
+            {'Variables': {'TABLE_NAME': {'Ref': 'Table'}}})
+
+
+class RenderCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = sm.Environment(Variables={'STAGE': 'dev'})
+        self.sam = sm.SAM()
+        for name in ('GetFunction', 'PutFunction', 'DeleteFunction'):
+            self.sam.add_resource(sm.Function(
+                name=name, Handler='index.handler', Runtime='python3.6'))
+        self.sam.add_resource(sm.Function(
+            name='EnvFunction', Handler='index.handler', Runtime='python3.6',
+            Environment=self.env))
+
+    def test_unchanged_template_is_reused(self):
+        first = self.sam.get_template()
+        self.assertIs(self.sam.get_template(), first)
+        self.assertEqual(self.sam.cache_info(), sm.CacheInfo(0, 4, 1, 1))
+
+    def test_only_changed_resources_are_rendered_again(self):
+        self.sam.get_template()
+        self.sam.render_stats.clear()
+        self.env.Variables = {'STAGE': 'prod'}
+        s = yaml.safe_load(self.sam.get_template())
+        self.assertEqual(self.sam.cache_info(), sm.CacheInfo(3, 1, 0, 1))
+        self.assertEqual(
+            s['Resources']['EnvFunction']['Properties']['Environment']['Variables'],
+            {'STAGE': 'prod'})
+
+
+class ResourceRegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sam = sm.SAM(render_type='json')
+        self.sam.add_resources(sm.SimpleTable(name='Table{}'.format(i)) for i in range(5))
+
+    def test_resources_render_in_insertion_order(self):
+        self.assertEqual(list(self.sam.to_dict()['Resources']),
+                         ['Table{}'.format(i) for i in range(5)])
+
+    def test_duplicate_logical_name(self):
+        table = self.sam.get_resource('Table0')
+        self.sam.add_resource(table)
+        self.assertEqual(len(self.sam.resources), 5)
+        with self.assertRaises(sm.DuplicateLogicalIdError):
+            self.sam.add_resource(sm.SimpleTable(name='Table0'))
+        replacement = sm.SimpleTable(name='Table0')
+        self.sam.add_resource(replacement, replace=True)
+        self.assertIs(self.sam.get_resource('Table0'), replacement)
+
+    def test_failing_batch_adds_nothing(self):
+        batches = [[sm.SimpleTable(name='New'), sm.SimpleTable(name='Table1')],
+                   [sm.SimpleTable(name='New'), sm.SimpleTable(name='New')]]
+        for batch in batches:
+            with self.assertRaises(sm.DuplicateLogicalIdError):
+                self.sam.add_resources(batch)
+            self.assertIsNone(self.sam.get_resource('New'))
+        with self.assertRaises(sm.DuplicateLogicalIdError):
+            self.sam.add_resources(batches[1], replace=True)
+        with self.assertRaises(sm.DuplicateLogicalIdError):
+            self.sam.resources = batches[1]
+        self.assertEqual(len(self.sam.resources), 5)
+
+    def test_remove_resource(self):
+        self.sam.remove_resource('Table3')
+        self.assertIsNone(self.sam.get_resource('Table3'))
+        self.assertNotIn('Table3', self.sam.to_dict()['Resources'])
+
+
+def stack_event(logical_id, status, seconds, resource_type='AWS::CloudFormation::Stack',
+                reason=None):
+    return {'EventId': '{}-{}-{}'.format(logical_id, status, seconds),
+            'LogicalResourceId': logical_id, 'ResourceType': resource_type,
+            'ResourceStatus': status, 'ResourceStatusReason': reason,
+            'Timestamp': datetime.datetime(2020, 1, 1) + datetime.timedelta(seconds=seconds)}
+
+
+class StubCloudFormation(object):
+
+    def __init__(self, changeset_statuses, stack_statuses, stack_exists=False, tags=None):
+        self.changeset_statuses = list(changeset_statuses)
+        self.stack_statuses = list(stack_statuses)
+        self.stack_exists = stack_exists
+        self.tags = tags or []
+        self.calls = []
+        self.changesets = []
+        self.events = []
+
+    def describe_stacks(self, StackName):
+        self.calls.append('describe_stacks')
+        if self.stack_statuses and self.calls.count('execute_change_set'):
+            return {'Stacks': [{'StackStatus': self.stack_statuses.pop(0)}]}
+        if not self.stack_exists:
+            raise botocore.exceptions.ClientError(
+                {'Error': {'Code': 'ValidationError',
+                           'Message': 'Stack with id {} does not exist'.format(StackName)}},
+                'DescribeStacks')
+        return {'Stacks': [{'StackStatus': 'CREATE_COMPLETE', 'Tags': self.tags}]}
+
+    def create_change_set(self, **kwargs):
+        self.calls.append('create_change_set')
+        self.changesets.append(kwargs)
+        return {'Id': 'changeset-arn'}
+
+    def describe_change_set(self, ChangeSetName):
+        self.calls.append('describe_change_set')
+        if len(self.changeset_statuses) > 1:
+            return {'Status': self.changeset_statuses.pop(0)}
+        return {'Status': self.changeset_statuses[0], 'StatusReason': 'No updates'}
+
+    def execute_change_set(self, **kwargs):
+        self.calls.append('execute_change_set')
+
+    def describe_stack_events(self, StackName, NextToken=None):
+        self.calls.append('describe_stack_events')
+        if not self.events:
+            self.events.append(stack_event(StackName, 'CREATE_COMPLETE', 0))
+        if self.stack_statuses and self.calls.count('execute_change_set'):
+            self.events.insert(0, stack_event(
+                StackName, self.stack_statuses.pop(0), len(self.events)))
+        return {'StackEvents': list(self.events)}
+
+
+class StubCloudFormationResource(object):
+
+    def Stack(self, name):
+        return name
+
+
+class PublishTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sleeps = []
+        self.sam = sm.SAM()
+        self.sam.add_resource(sm.SimpleTable(name='Table'))
+        self.sam.cf_resource = StubCloudFormationResource()
+        self.sam.changeset_wait = Backoff(min_delay=1, max_delay=4, jitter=False,
+                                          sleep=self.sleeps.append)
+        self.sam.stack_wait = Backoff(min_delay=1, max_delay=4, jitter=False,
+                                      sleep=self.sleeps.append)
+
+    def test_finished_changeset_does_not_sleep(self):
+        self.sam.cf_client = StubCloudFormation(['CREATE_COMPLETE'], ['CREATE_COMPLETE'])
+        result = self.sam.publish_stack('stack')
+        self.assertEqual(self.sleeps, [])
+        self.assertEqual(result.status, 'CREATE_COMPLETE')
+        self.assertEqual(result.polls, {'changeset': 1, 'execute': 1})
+        self.assertEqual(result.stack, 'stack')
+
+    def test_backoff_grows_until_max_delay(self):
+        self.sam.cf_client = StubCloudFormation(
+            ['CREATE_PENDING', 'CREATE_IN_PROGRESS', 'CREATE_COMPLETE'],
+            ['UPDATE_IN_PROGRESS'] * 4 + ['UPDATE_COMPLETE'], stack_exists=True)
+        result = self.sam.publish_stack('stack')
+        self.assertEqual(self.sleeps, [1, 2, 1, 2, 4, 4])
+        self.assertEqual(result.changeset_type, 'UPDATE')
+        self.assertIn('execute', result.timings)
+
+    def test_failed_stack_raises(self):
+        self.sam.cf_client = StubCloudFormation(['CREATE_COMPLETE'], ['ROLLBACK_COMPLETE'])
+        with self.assertRaises(DeployFailedError):
+            self.sam.publish_stack('stack')
+
+    def test_failed_changeset_is_reported(self):
+        self.sam.cf_client = StubCloudFormation(['FAILED'], [])
+        result = self.sam.publish_stack('stack')
+        self.assertEqual((result.status, result.status_reason), ('FAILED', 'No updates'))
+        self.assertNotIn('execute_change_set', self.sam.cf_client.calls)
+
+
+class RecordingCFT(sm.CFT):
+
+    def __init__(self, fail=False, **kwargs):
+        super(RecordingCFT, self).__init__(**kwargs)
+        self.fail = fail
+        self.calls = []
+
+    def publish_stack(self, stack_name, parameters=None):
+        self.calls.append((stack_name, parameters, time.time()))
+        if self.fail:
+            raise DeployFailedError('boom')
+        result = sm.PublishResult(stack_name)
+        result.stack = stack_name
+        return result
+
+
+class PublishManyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.exporter = RecordingCFT()
+        self.exporter.add_resource(sm.SimpleTable(name='Table'))
+        self.exporter.add_output(sm.Output(
+            name='TableArn', Value=sm.Ref(Ref='Table'), Export={'Name': 'TableArn'}))
+        self.importer = RecordingCFT()
+        self.importer.add_resource(sm.Role(name='Role', Policies=[
+            {'PolicyDocument': {'Resource': {'Fn::ImportValue': 'TableArn'}}}]))
+        self.independent = RecordingCFT()
+        self.independent.add_resource(sm.SNS(name='Topic'))
+
+    def test_imports_wait_for_exports(self):
+        report = publish_many([(self.importer, 'consumer', {'Stage': 'dev'}),
+                               (self.exporter, 'producer', None),
+                               (self.independent, 'other', None)], max_workers=3)
+        self.assertTrue(report.ok)
+        self.assertEqual(report['consumer'].depends_on, ['producer'])
+        self.assertGreaterEqual(self.importer.calls[0][2], report['producer'].finished)
+        self.assertEqual(self.importer.calls[0][1], {'Stage': 'dev'})
+
+    def test_failed_dependency_skips_dependents(self):
+        self.exporter.fail = True
+        report = publish_many([(self.exporter, 'producer', None),
+                               (self.importer, 'consumer', None),
+                               (self.independent, 'other', None)])
+        self.assertEqual([i.status for i in report], ['FAILED', 'SKIPPED', 'SUCCEEDED'])
+        self.assertEqual(self.importer.calls, [])
+
+    def test_inferring_dependencies_reuses_renders(self):
+        self.independent.add_resource(sm.Role(name='Role', Policies=[
+            {'PolicyDocument': {'Resource': sm.Sub(
+                Sub='${Arn}/*', Map={'Arn': {'Fn::ImportValue': 'TableArn'}})}}]))
+        targets = [(self.exporter, 'producer', None), (self.independent, 'other', None)]
+        self.assertEqual(infer_dependencies(targets), {'other': {'producer'}})
+        self.independent.render_stats.clear()
+        self.independent.get_template()
+        self.assertEqual(self.independent.cache_info().misses, 0)
+
+    def test_cycles_are_rejected(self):
+        with self.assertRaises(ValueError):
+            publish_many([(self.exporter, 'a', None), (self.importer, 'b', None)],
+                         dependencies={'a': ['b'], 'b': ['a']})
+
+
+class ClientPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        clients.clear()
+
+    def test_rendering_builds_no_clients(self):
+        ab.get_template()
+        self.assertEqual(clients._clients, {})
+        self.assertEqual(clients._sessions, {})
+
+    def test_clients_are_shared_and_lazy(self):
+        first = sm.SAM(region_name='us-west-2')
+        second = sm.CFT(region_name='us-west-2')
+        self.assertIs(first.cf_client, second.cf_client)
+        self.assertIsNot(first.cf_client, sm.SAM(region_name='eu-west-1').cf_client)
+        self.assertEqual(len(clients._sessions), 1)
+
+    def test_assigned_client_overrides_pool(self):
+        sam = sm.SAM()
+        sam.cf_client = 'stub'
+        self.assertEqual(sam.cf_client, 'stub')
+        self.assertNotEqual(sm.SAM().cf_client, 'stub')
+
+    def test_resources_are_per_thread_and_released(self):
+        resource = clients.get_resource('s3')
+        self.assertIs(clients.get_resource('s3'), resource)
+        created = []
+
+        def work():
+            created.append(weakref.ref(clients.get_resource('s3')))
+
+        worker = threading.Thread(target=work)
+        worker.start()
+        worker.join()
+        gc.collect()
+        # The worker's resource goes away with the worker
+        self.assertIsNone(created[0]())
+        clients.clear()
+        self.assertIsNot(clients.get_resource('s3'), resource)
+
+    def test_session_clients_are_cached(self):
+        aws = FakeAWS()
+        calls = collections.Counter()
+
+        class Session(object):
+            def client(self, service_name, region_name):
+                calls['client'] += 1
+                return aws.client(service_name, region_name=region_name)
+
+            def resource(self, service_name, region_name):
+                calls['resource'] += 1
+                return aws.resource(service_name, region_name=region_name)
+
+        sam = sm.SAM()
+        sam.build_clients_resources(session=Session())
+        self.assertIs(sam.cf_client, sam.cf_client)
+        self.assertIs(sam.s3, sam.s3)
+        resources = []
+        worker = threading.Thread(target=lambda: resources.append(sam.s3))
+        worker.start()
+        worker.join()
+        self.assertIsNot(resources[0], sam.s3)
+        self.assertEqual(calls, {'client': 1, 'resource': 2})
+
+    def test_resources_are_created_under_the_lock(self):
+        class Session(object):
+            def resource(self, service_name, region_name):
+                return clients._lock._is_owned()
+
+        clients._sessions['default'] = Session()
+        self.assertTrue(clients.get_resource('sqs'))
+
+
+class SkipUnchangedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sam = sm.SAM()
+        self.sam.add_resource(sm.SimpleTable(name='Table'))
+        self.sam.cf_resource = StubCloudFormationResource()
+        self.sam.skip_unchanged = True
+        self.sam.digest_store = 'tag'
+        self.sam.changeset_wait = Backoff(jitter=False, sleep=lambda i: None)
+        self.sam.stack_wait = Backoff(jitter=False, sleep=lambda i: None)
+
+    def test_digest_is_stable(self):
+        self.assertEqual(self.sam.template_digest({'A': '1', 'B': '2'}),
+                         self.sam.template_digest({'B': '2', 'A': '1'}))
+        self.assertNotEqual(self.sam.template_digest({'A': '1'}),
+                            self.sam.template_digest({'A': '2'}))
+
+    def test_matching_tag_skips_changeset(self):
+        digest = self.sam.template_digest({'Stage': 'dev'})
+        self.sam.cf_client = StubCloudFormation([], [], stack_exists=True, tags=[
+            {'Key': sm.DIGEST_TAG, 'Value': digest}])
+        result = self.sam.publish_stack('stack', {'Stage': 'dev'})
+        self.assertTrue(result.skipped)
+        self.assertEqual(result.stack, 'stack')
+        self.assertNotIn('create_change_set', self.sam.cf_client.calls)
+
+    def test_changed_template_updates_tag(self):
+        self.sam.cf_client = StubCloudFormation(
+            ['CREATE_COMPLETE'], ['UPDATE_COMPLETE'], stack_exists=True, tags=[
+                {'Key': 'team', 'Value': 'api'}, {'Key': sm.DIGEST_TAG, 'Value': 'old'}])
+        result = self.sam.publish_stack('stack', {'Stage': 'dev'})
+        self.assertFalse(result.skipped)
+        self.assertEqual(self.sam.cf_client.changesets[0]['Tags'], [
+            {'Key': 'team', 'Value': 'api'}, {'Key': sm.DIGEST_TAG, 'Value': result.digest}])
+
+    def test_state_file(self):
+        self.assertEqual(sm.SAM().digest_store, 'file')
+        with tempfile.TemporaryDirectory() as tmp:
+            self.sam.digest_store = 'file'
+            self.sam.state_file = os.path.join(tmp, 'state.json')
+            self.sam.cf_client = StubCloudFormation(['CREATE_COMPLETE'], ['CREATE_COMPLETE'])
+            self.assertFalse(self.sam.publish_stack('stack').skipped)
+            # The file store leaves the stack tags, and so the resource tags, alone
+            self.assertNotIn('Tags', self.sam.cf_client.changesets[0])
+            self.sam.cf_client = StubCloudFormation([], [], stack_exists=True)
+            self.assertTrue(self.sam.publish_stack('stack').skipped)
+
+
+class StubS3Object(object):
+
+    def __init__(self, store, bucket, key):
+        self.store = store
+        self.path = (bucket, key)
+
+    def load(self):
+        if self.path not in self.store:
+            raise botocore.exceptions.ClientError(
+                {'Error': {'Code': '404', 'Message': 'Not Found'}}, 'HeadObject')
+
+    def put(self, Body):
+        self.store[self.path] = Body
+        self.store.setdefault('puts', []).append(self.path)
+
+    def upload_file(self, Filename):
+        with open(Filename, 'rb') as f:
+            self.store[self.path] = f.read()
+        self.store.setdefault('uploads', []).append(self.path)
+
+
+class StubS3(object):
+
+    def __init__(self):
+        self.store = {}
+
+    def Object(self, bucket, key):
+        return StubS3Object(self.store, bucket, key)
+
+
+class TemplateUploadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sam = sm.SAM(region_name='eu-west-1')
+        self.sam.add_resources(sm.SNS(name='Topic{:05d}'.format(i)) for i in range(1500))
+        self.sam.s3 = StubS3()
+        self.sam.cf_resource = StubCloudFormationResource()
+        self.sam.cf_client = StubCloudFormation(['CREATE_COMPLETE'], ['CREATE_COMPLETE'])
+        self.sam.changeset_wait = Backoff(jitter=False, sleep=lambda i: None)
+        self.sam.stack_wait = Backoff(jitter=False, sleep=lambda i: None)
+
+    def test_oversized_template_needs_bucket(self):
+        with self.assertRaises(DeployFailedError):
+            self.sam.publish_stack('stack')
+
+    def test_oversized_template_is_uploaded_once(self):
+        self.sam.template_bucket = 'templates'
+        result = self.sam.publish_stack('stack')
+        changeset = self.sam.cf_client.changesets[0]
+        self.assertNotIn('TemplateBody', changeset)
+        self.assertEqual(changeset['TemplateURL'], result.template_url)
+        self.assertTrue(result.template_url.startswith(
+            'https://templates.s3.eu-west-1.amazonaws.com/'))
+        self.sam.upload_template()
+        self.assertEqual(len(self.sam.s3.store['puts']), 1)
+
+    def test_small_template_stays_inline(self):
+        self.sam.template_bucket = 'templates'
+        self.sam.resources = [sm.SNS(name='Topic')]
+        self.assertIn('TemplateBody', self.sam.template_source())
+        self.sam.upload_all_templates = True
+        self.assertIn('TemplateURL', self.sam.template_source())
+
+
+class MinifyTestCase(unittest.TestCase):
+
+    def test_minified_templates_are_equivalent(self):
+        expected = yaml.safe_load(ab.to_yaml())
+        self.assertEqual(yaml.safe_load(ab.to_yaml(minify=True)), expected)
+        self.assertEqual(json.loads(ab.get_template('json-compact')), expected)
+        self.assertNotIn(', ', ab.get_template('json-compact'))
+
+    def test_size_report(self):
+        report = ab.size_report()
+        self.assertEqual(report.original - report.minified, report.saved)
+        self.assertGreater(report.saved, 0)
+
+    def test_empty_properties_are_dropped(self):
+        template = {'Resources': {
+            'Topic': {'Type': 'AWS::SNS::Topic', 'Properties': {}},
+            'Function': {'Type': 'AWS::Serverless::Function', 'Properties': {
+                'Events': {'Skill': {'Type': 'AlexaSkill', 'Properties': {}}}}}}}
+        self.assertEqual(sm.strip_empty_properties(template), {'Resources': {
+            'Topic': {'Type': 'AWS::SNS::Topic'},
+            'Function': {'Type': 'AWS::Serverless::Function', 'Properties': {
+                'Events': {'Skill': {'Type': 'AlexaSkill'}}}}}})
+        self.assertEqual(template['Resources']['Topic']['Properties'], {})
+
+
+class FalsyValueTestCase(unittest.TestCase):
+
+    def test_zero_and_false_are_rendered(self):
+        queue = sm.SQS(name='Queue', DelaySeconds=0, FifoQueue=False, QueueName='')
+        self.assertEqual(queue.render()['r']['Properties'],
+                         {'DelaySeconds': 0, 'FifoQueue': False})
+        queue.VisibilityTimeout = 0
+        self.assertEqual(queue.render()['r']['Properties']['VisibilityTimeout'], 0)
+
+    def test_unset_booleans_are_left_out(self):
+        queue = sm.SQS(name='Queue')
+        self.assertIs(queue.FifoQueue, False)
+        self.assertEqual(queue.render()['r'], {'Type': 'AWS::SQS::Queue'})
+
+    def test_events_follow_the_other_properties(self):
+        function = sm.Function(name='Function', Handler='index.handler', Runtime='python3.6',
+                               Events=[sm.SNSEvent(name='Topic', Topic='arn')], Timeout=0)
+        self.assertEqual(list(function.render()['r']['Properties']),
+                         ['Handler', 'Runtime', 'Timeout', 'Events'])
+
+
+class GlobalsTestCase(unittest.TestCase):
+
+    def build_sam(self, **kwargs):
+        sam = sm.SAM(render_type='json', **kwargs)
+        for name, memory in (('Get', 128), ('Put', 128), ('Delete', 512)):
+            sam.add_resource(sm.Function(
+                name=name, Handler='index.' + name.lower(), Runtime='python3.12',
+                CodeUri='s3://bucket/code.zip', MemorySize=memory, Tags={'team': 'api'},
+                Environment=sm.Environment(Variables={'TABLE': sm.Ref('Table'), 'OP': name})))
+        sam.add_resource(sm.SimpleTable(name='Table'))
+        return sam
+
+    def test_globals_are_rendered(self):
+        sam = self.build_sam(Globals=sm.Globals(Function=sm.FunctionGlobals(
+            Timeout=0, Environment=sm.Environment(Variables={'STAGE': 'prod'}))))
+        self.assertEqual(json.loads(sam.get_template())['Globals'], {'Function': {
+            'Timeout': 0, 'Environment': {'Variables': {'STAGE': 'prod'}}}})
+        self.assertNotIn('Globals', sm.SAM().to_dict())
+
+    def test_shared_values_are_hoisted(self):
+        sam = self.build_sam()
+        original = json.loads(sam.get_template())
+        sam.hoist_globals = sam.verify_globals = True
+        template = json.loads(sam.get_template())
+        self.assertEqual(template['Globals'], {'Function': {
+            'Runtime': 'python3.12', 'CodeUri': 's3://bucket/code.zip', 'MemorySize': 128,
+            'Environment': {'Variables': {'TABLE': {'Ref': 'Table'}}}, 'Tags': {'team': 'api'}}})
+        self.assertEqual(template['Resources']['Delete']['Properties'], {
+            'Handler': 'index.delete', 'MemorySize': 512,
+            'Environment': {'Variables': {'OP': 'Delete'}}})
+        self.assertEqual(hoisting.compare(original, template), [])
+        self.assertFalse(sdiff.diff(original, template))
+        self.assertLess(len(sam.get_template()), len(json.dumps(original)))
+
+    def test_existing_globals_are_hoisted_again(self):
+        template = self.build_sam(Globals=sm.Globals(Function=sm.FunctionGlobals(
+            Layers=['base'], Runtime='python3.8'))).get_template_dict()
+        hoisted = hoisting.hoist(template, verify=True)
+        self.assertEqual(hoisted['Globals']['Function']['Runtime'], 'python3.12')
+        self.assertEqual(hoisted['Globals']['Function']['Layers'], ['base'])
+        self.assertEqual(hoisting.expand(hoisted), hoisting.expand(template))
+
+    def test_verification_reports_changed_resources(self):
+        template = self.build_sam().get_template_dict()
+        broken = hoisting.hoist(template)
+        del broken['Resources']['Delete']['Properties']['MemorySize']
+        self.assertEqual(hoisting.compare(template, broken), ['Delete'])
+        self.assertEqual(hoisting.merge({'A': [1], 'B': {'Ref': 'X'}}, {'A': [2], 'B': {'C': 1}}),
+                         {'A': [1, 2], 'B': {'C': 1}})
+
+    def test_api_globals_skip_implicit_apis(self):
+        template = ab.get_template_dict()
+        template = dict(template, Resources=dict(template['Resources'], Api={
+            'Type': 'AWS::Serverless::Api', 'Properties': {'StageName': 'a', 'Variables': {}}}))
+        self.assertNotIn('Api', hoisting.hoist(template, verify=True)['Globals'])
+
+
+class ReferencesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sam = sm.SAM(render_type='json', parameters=[
+            sm.Parameter(name='Stage', Type='String'),
+            sm.Parameter(name='Subnets', Type='CommaDelimitedList'),
+            sm.Parameter(name='Secret', Type='AWS::SSM::Parameter::Value<String>')])
+        self.sam.add_resources([
+            sm.SQS(name='Queue', KmsMasterKeyId=sm.Sub('${Stage}-${AWS::Region}')),
+            sm.SNS(name='DebugTopic', prunable=True),
+            sm.SQS(name='DebugQueue', prunable=True, KmsMasterKeyId=sm.Ref('DebugTopic')),
+            sm.Function(name='Worker', Handler='app.handler', Runtime='python3.12',
+                        CodeUri='s3://bucket/code.zip', Environment=sm.Environment(Variables={
+                            'QUEUE': sm.Ref('Queue'), 'SECRET': sm.Ref('Secret'),
+                            'SUBNETS': sm.Ref('Subnets'), 'ARN': sm.Sub('${Worker.Arn}'),
+                            'NAME': sm.Sub('${Prefix}-${Stage}-${!Id}', Map={'Prefix': 'app'})}))])
+
+    def test_reference_index(self):
+        index = self.sam.references()
+        self.assertIn(references.Edge('Worker', 'Queue', None, 'Ref'), index.edges)
+        self.assertIn(references.Edge('Worker', 'Worker', 'Arn', 'Fn::Sub'), index.edges)
+        self.assertEqual(index.unreferenced(), ['DebugQueue', 'Worker'])
+        self.assertEqual(index.dangling(), [])
+
+    def test_known_parameters_are_folded(self):
+        self.sam.fold_parameters = True
+        template = json.loads(self.sam.get_template(parameters={
+            'Stage': 'prod', 'Subnets': 'a,b', 'Secret': '/app/secret'}))
+        variables = template['Resources']['Worker']['Properties']['Environment']['Variables']
+        self.assertEqual(variables, {'QUEUE': {'Ref': 'Queue'}, 'SECRET': {'Ref': 'Secret'},
+                                     'SUBNETS': ['a', 'b'], 'ARN': {'Fn::Sub': '${Worker.Arn}'},
+                                     'NAME': 'app-prod-${Id}'})
+        self.assertEqual(template['Resources']['Queue']['Properties']['KmsMasterKeyId'],
+                         {'Fn::Sub': 'prod-${AWS::Region}'})
+        self.assertIn('Stage', template['Parameters'])
+        self.assertEqual(references.fold({'Fn::Join': ['-', [{'Ref': 'Stage'}, 'api']]},
+                                         {'Stage': 'dev'}, set()), 'dev-api')
+        self.assertIn('${Prefix}-${Stage}', self.sam.get_template())
+
+    def test_unreferenced_prunable_resources_are_pruned(self):
+        self.sam.prune_resources = True
+        self.assertEqual(list(json.loads(self.sam.get_template())['Resources']),
+                         ['Queue', 'Worker'])
+        self.assertEqual(self.sam.optimize_template().pruned, ['DebugQueue', 'DebugTopic'])
+        self.sam.get_resource('Worker').Environment = sm.Environment(Variables={
+            'TOPIC': sm.Ref('DebugTopic')})
+        self.assertEqual(self.sam.optimize_template().pruned, ['DebugQueue'])
+
+    def test_dangling_references_fail_before_the_changeset(self):
+        aws = FakeAWS()
+        self.sam.build_clients_resources(session=aws)
+        self.sam.check_references = True
+        self.sam.get_resource('Worker').Role = sm.Ref('WorkerRol')
+        with self.assertRaises(sm.DanglingReferenceError) as cm:
+            self.sam.publish_stack('app', {'Stage': 'prod'})
+        self.assertEqual(cm.exception.errors, ['Worker: Ref WorkerRol is not declared in the template'])
+        self.assertEqual(aws.calls['create_change_set'], 0)
+        self.sam.get_resource('Worker').Role = sm.Ref('WorkerRole')
+        self.sam.fold_parameters = True
+        self.assertEqual(self.sam.publish_stack('app', {'Stage': 'prod'}).status, 'CREATE_COMPLETE')
+
+
+class StubStackSets(object):
+
+    def __init__(self, statuses, instances):
+        self.statuses = list(statuses)
+        self.instances = instances
+        self.calls = []
+
+    def create_stack_set(self, **kwargs):
+        self.calls.append(('create_stack_set', kwargs))
+
+    def create_stack_instances(self, **kwargs):
+        self.calls.append(('create_stack_instances', kwargs))
+        return {'OperationId': 'op-1'}
+
+    def describe_stack_set_operation(self, StackSetName, OperationId):
+        return {'StackSetOperation': {'Status': self.statuses.pop(0)}}
+
+    def list_stack_instances(self, StackSetName, NextToken=None):
+        page = int(NextToken or 0)
+        response = {'Summaries': self.instances[page:page + 2]}
+        if page + 2 < len(self.instances):
+            response['NextToken'] = str(page + 2)
+        return response
+
+
+class StubSTS(object):
+
+    def get_caller_identity(self):
+        return {'Account': '123456789012'}
+
+
+class PublishGlobalTestCase(unittest.TestCase):
+    regions = ['us-east-1', 'us-west-2', 'eu-west-1']
+
+    def setUp(self):
+        self.sleeps = []
+        self.sam = sm.CFT()
+        self.sam.add_resource(sm.SNS(name='Topic'))
+        self.sam.sts = StubSTS()
+        self.sam.stackset_wait = Backoff(min_delay=5, jitter=False, sleep=self.sleeps.append)
+
+    def instances(self, *statuses):
+        return [{'Region': r, 'Status': s, 'StatusReason': 'reason {}'.format(r)}
+                for r, s in zip(self.regions, statuses)]
+
+    def test_waits_on_operation_and_paginates(self):
+        self.sam.cf_client = StubStackSets(
+            ['RUNNING', 'SUCCEEDED'], self.instances('OUTDATED', 'CURRENT', 'CURRENT'))
+        operation = self.sam.publish_global('stackset', self.regions)
+        self.assertEqual(operation.status, 'SUCCEEDED')
+        self.assertEqual(len(operation.instances), 3)
+        self.assertEqual(self.sleeps, [5])
+        create = self.sam.cf_client.calls[1][1]
+        self.assertEqual(create['OperationPreferences']['RegionConcurrencyType'], 'PARALLEL')
+
+    def test_fails_fast_on_failed_instance(self):
+        self.sam.cf_client = StubStackSets(
+            ['RUNNING'], self.instances('CURRENT', 'OUTDATED', 'INOPERABLE'))
+        with self.assertRaises(DeployFailedError) as e:
+            self.sam.publish_global('stackset', self.regions)
+        self.assertIn('eu-west-1: reason eu-west-1', str(e.exception))
+
+    def test_non_blocking(self):
+        self.sam.cf_client = StubStackSets(['SUCCEEDED'], self.instances('CURRENT'))
+        operation = self.sam.publish_global('stackset', self.regions[:1], wait=False)
+        self.assertIsNone(operation.status)
+        self.assertTrue(operation.done())
+
+
+class DeferredValidationTestCase(unittest.TestCase):
+
+    def test_errors_are_collected_at_render_time(self):
+        with sm.deferred_validation():
+            sam = sm.SAM(render_type='xml')
+            table = sm.Ref(Ref='Table')
+            sam.add_resource(sm.Function(name='Sized', Handler='index.handler', Runtime='python3.6',
+                                         MemorySize='big', Timeout='long',
+                                         Environment=sm.Environment(Variables={'T': table})))
+            sam.add_resource(sm.Function(name='NoVariables', Handler='index.handler',
+                                         Runtime='python3.6', Environment=sm.Environment()))
+        with self.assertRaises(ValidationException):
+            sam.add_resource('not a resource')
+        with self.assertRaises(sm.TemplateValidationError) as e:
+            sam.get_template()
+        self.assertEqual(len(e.exception.errors), 4)
+        self.assertIn('NoVariables.Environment: Variables: This value is required',
+                      e.exception.errors)
+        with self.assertRaises(sm.TemplateValidationError):
+            sam.get_template()
+
+    def test_shared_objects_are_validated_once(self):
+        with sm.deferred_validation():
+            environment = sm.Environment(Variables={'T': sm.Ref(Ref='Table')})
+            sam = sm.SAM()
+            sam.add_resources(sm.Function(
+                name='Function{}'.format(i), Handler='index.handler', Runtime='python3.6',
+                Environment=environment) for i in range(3))
+        calls = []
+        validation_errors = environment.validation_errors
+        environment.validation_errors = lambda: calls.append(1) or validation_errors()
+        yaml.safe_load(sam.get_template())
+        sam.add_resource(sm.SimpleTable(name='Table'))
+        sam.get_template()
+        self.assertEqual(len(calls), 1)
+
+    def test_eager_validation_is_unchanged(self):
+        with self.assertRaises(ValidationException):
+            sm.Environment()
+
+    def test_property_hooks_run(self):
+        class Checked(sm.SimpleTable):
+            def name_validate(self, value):
+                if not value[0].isupper():
+                    raise ValidationException('name: {} should be capitalized'.format(value))
+
+        with self.assertRaises(ValidationException):
+            Checked(name='table')
+        with sm.deferred_validation():
+            sam = sm.SAM()
+            sam.add_resource(Checked(name='table'))
+        with self.assertRaises(sm.TemplateValidationError) as e:
+            sam.get_template()
+        self.assertEqual(e.exception.errors, ['table: name: table should be capitalized'])
+
+    def test_pending_objects_only_affect_their_templates(self):
+        sam = sm.SAM()
+        sam.add_resource(sm.SimpleTable(name='Table'))
+        with sm.deferred_validation():
+            invalid = sm.Environment()
+            valid = sm.Environment(Variables={'A': 'a'})
+        with instrumentation.SpanCollector() as collector:
+            sam.get_template()
+            sam.add_resource(sm.Function(name='Function', Handler='index.handler',
+                                         Runtime='python3.6', Environment=valid))
+            sam.get_template()
+            sam.get_template(render_type='json')
+        walks = [i for i in collector.spans if i.name == 'validate_tree']
+        self.assertEqual([i.attrs['validated'] for i in walks], [1])
+        self.assertTrue(invalid._unvalidated)
+
+    def test_template_validation_mode(self):
+        with self.assertRaises(ValueError):
+            sm.SAM(validate='lazy')
+        sam = sm.SAM(validate='deferred', render_type='xml')
+        sam.add_resources([sm.SimpleTable(name='Table'), sm.Parameter(name='Stage', Type='String')])
+        with self.assertRaises(ValidationException):
+            sam.add_resource('not a resource')
+        with self.assertRaises(sm.TemplateValidationError) as e:
+            sam.get_template()
+        self.assertEqual(len(e.exception.errors), 2)
+
+
+class IntrinsicTestCase(unittest.TestCase):
+
+    def test_identical_intrinsics_are_interned(self):
+        self.assertIs(sm.Ref(Ref='Table'), sm.Ref('Table'))
+        self.assertIs(sm.Sub('${A}', {'A': sm.Ref('B')}), sm.Sub(Sub='${A}', Map={'A': sm.Ref('B')}))
+        self.assertIsNot(sm.Sub('${A}'), sm.Sub('${A}', {'A': 'x'}))
+        self.assertEqual({sm.Ref('Table'): 1}[sm.Ref(Ref='Table')], 1)
+
+    def test_intrinsics_are_immutable_and_validated(self):
+        with self.assertRaises(AttributeError):
+            sm.Ref('Table').Ref = 'Other'
+        with self.assertRaises(ValidationException):
+            sm.Ref(Ref=None)
+        with self.assertRaises(ValidationException):
+            sm.Sub(Sub='${A}', Map='A')
+        variables = {'A': 'x'}
+        sub = sm.Sub('${A}', variables)
+        variables['A'] = 'y'
+        with self.assertRaises(TypeError):
+            sub.Map['A'] = 'y'
+        self.assertIs(sm.Sub('${A}', {'A': 'x'}), sub)
+        self.assertEqual(sub.to_dict(), {'Fn::Sub': ['${A}', {'A': 'x'}]})
+        self.assertEqual(pickle.loads(pickle.dumps(sub)), sub)
+
+    def test_intrinsics_render(self):
+        sam = sm.SAM(render_type='json')
+        sam.add_resource(sm.SQS(name='Queue', QueueName=sm.Ref('Name'),
+                                KmsMasterKeyId=sm.Sub('${Key}', {'Key': sm.Ref('KeyId')})))
+        properties = json.loads(sam.get_template())['Resources']['Queue']['Properties']
+        self.assertEqual(properties, {
+            'QueueName': {'Ref': 'Name'},
+            'KmsMasterKeyId': {'Fn::Sub': ['${Key}', {'Key': {'Ref': 'KeyId'}}]}})
+        self.assertEqual(pickle.loads(pickle.dumps(sm.Ref('Name'))), sm.Ref('Name'))
+
+    def test_s3_uris_are_interned_leaves(self):
+        uri = sm.S3URI(Bucket=sm.Ref('Bucket'), Key='code.zip')
+        self.assertIs(sm.S3URI(sm.Ref('Bucket'), 'code.zip'), uri)
+        self.assertFalse(hasattr(uri, '__dict__'))
+        with self.assertRaises(AttributeError):
+            uri.Key = 'other.zip'
+        with self.assertRaises(ValidationException):
+            sm.S3URI(Bucket='bucket', Key=None)
+        self.assertEqual(pickle.loads(pickle.dumps(uri)), uri)
+        function = sm.Function(name='Function', Handler='index.handler', Runtime='python3.6',
+                               CodeUri=uri)
+        self.assertEqual(function.to_dict()['r']['Properties']['CodeUri'].to_dict(),
+                         {'Bucket': sm.Ref('Bucket'), 'Key': 'code.zip'})
+
+
+class DiffTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sam = sm.SAM()
+        self.sam.add_resources([
+            sm.SQS(name='Queue', QueueName='jobs-v2', VisibilityTimeout=60),
+            sm.SNS(name='Topic'),
+            sm.S3(name='Bucket', BucketName=sm.Ref('BucketName'))])
+        self.deployed = textwrap.dedent("""
+            Resources:
+              Queue:
+                Type: AWS::SQS::Queue
+                Properties:
+                  QueueName: jobs
+              Bucket:
+                Type: AWS::S3::Bucket
+                Properties:
+                  BucketName: !Sub '${AWS::StackName}-bucket'
+              Table:
+                Type: AWS::Serverless::SimpleTable
+            """)
+
+    def test_diff_against_saved_template(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.yaml') as f:
+            f.write(self.deployed)
+            f.flush()
+            changes = self.sam.diff(template=f.name)
+        self.assertEqual([(i.action, i.logical_id) for i in changes], [
+            ('Modify', 'Queue'), ('Add', 'Topic'), ('Modify', 'Bucket'), ('Remove', 'Table')])
+        queue = changes.modified[0]
+        self.assertEqual([i.name for i in queue.properties], ['QueueName', 'VisibilityTimeout'])
+        self.assertEqual(queue.replacement, 'True')
+        self.assertEqual(changes.modified[1].replacement, 'Conditional')
+        self.assertEqual(len(changes.replacements), 2)
+
+    def test_identical_templates(self):
+        template = json.loads(self.sam.to_json())
+        self.assertFalse(sdiff.diff(template, self.sam.to_yaml()))
+
+    def test_type_change_is_replacement(self):
+        changes = sdiff.diff({'Resources': {'A': {'Type': 'AWS::SNS::Topic'}}},
+                             {'Resources': {'A': {'Type': 'AWS::SQS::Queue'}}})
+        self.assertEqual(str(changes), '~ A (AWS::SQS::Queue) [replacement: True]')
+
+
+class InstrumentationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sam = sm.SAM()
+        self.sam.add_resource(sm.SimpleTable(name='Table'))
+        self.sam.cf_resource = StubCloudFormationResource()
+        self.sam.cf_client = StubCloudFormation(
+            ['CREATE_PENDING', 'CREATE_COMPLETE'], ['CREATE_IN_PROGRESS', 'CREATE_COMPLETE'])
+        self.sam.changeset_wait = Backoff(jitter=False, sleep=lambda i: None)
+        self.sam.stack_wait = Backoff(jitter=False, sleep=lambda i: None)
+
+    def test_publish_spans(self):
+        with instrumentation.SpanCollector() as collector:
+            self.sam.publish_stack('stack')
+        totals = collector.totals()
+        self.assertEqual(list(totals)[:3], ['cloudformation.describe_stacks', 'get_template',
+                                            'to_dict'])
+        self.assertEqual(totals['to_dict']['resources'], 1)
+        self.assertEqual(totals['get_template']['bytes'], len(self.sam.get_template()))
+        self.assertEqual(totals['changeset_wait']['polls'], 2)
+        self.assertEqual(totals['stack_wait']['polls'], 2)
+        self.assertEqual(totals['cloudformation.describe_change_set']['calls'], 2)
+        self.assertEqual(totals['cloudformation.execute_change_set']['calls'], 1)
+        nested = [i for i in collector.spans if i.name == 'cloudformation.describe_change_set']
+        self.assertEqual(nested[0].parent.name, 'changeset_wait')
+
+    def test_publish_prints_breakdown(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.sam.publish('stack')
+        self.assertIn('Timing breakdown:', out.getvalue())
+        self.assertIn('polls=2', out.getvalue())
+
+    def test_failing_hook_and_other_threads_are_isolated(self):
+        def broken(span):
+            raise RuntimeError('hook failed')
+
+        instrumentation.add_hook(broken)
+        try:
+            with instrumentation.SpanCollector() as collector:
+                worker = threading.Thread(target=self.sam.to_dict)
+                worker.start()
+                worker.join()
+                self.sam.to_dict()
+        finally:
+            instrumentation.remove_hook(broken)
+        self.assertEqual([i.name for i in collector.spans], ['to_dict'])
+
+
+class PagedStackEvents(object):
+    """
+    Serves stack events newest first, two per page, revealing one more
+    batch of events on every poll
+    """
+
+    def __init__(self, history, batches):
+        self.events = list(reversed(history))
+        self.batches = list(batches)
+        self.requests = []
+
+    def describe_stack_events(self, StackName, NextToken=None):
+        if NextToken is None:
+            self.requests.append([])
+            if self.requests[1:] and self.batches:
+                self.events[:0] = reversed(self.batches.pop(0))
+        start = int(NextToken or 0)
+        self.requests[-1].append(start)
+        response = {'StackEvents': self.events[start:start + 2]}
+        if start + 2 < len(self.events):
+            response['NextToken'] = str(start + 2)
+        return response
+
+
+class StackEventTailTestCase(unittest.TestCase):
+
+    def setUp(self):
+        history = [stack_event('app', 'CREATE_IN_PROGRESS', 0),
+                   stack_event('Old', 'CREATE_COMPLETE', 1, 'AWS::SNS::Topic'),
+                   stack_event('app', 'CREATE_COMPLETE', 2)]
+        self.batches = [
+            [stack_event('app', 'UPDATE_IN_PROGRESS', 10),
+             stack_event('Table', 'UPDATE_IN_PROGRESS', 11, 'AWS::DynamoDB::Table'),
+             stack_event('Bucket', 'UPDATE_IN_PROGRESS', 11, 'AWS::S3::Bucket')],
+            [stack_event('Bucket', 'UPDATE_FAILED', 14, 'AWS::S3::Bucket', 'Access Denied'),
+             stack_event('Table', 'UPDATE_FAILED', 15, 'AWS::DynamoDB::Table',
+                         'Resource update cancelled'),
+             stack_event('app', 'UPDATE_ROLLBACK_IN_PROGRESS', 15)],
+            [stack_event('app', 'UPDATE_ROLLBACK_COMPLETE', 30)],
+        ]
+        self.cf = PagedStackEvents(history, self.batches)
+        self.tail = sm.StackEventTail(self.cf, 'app', echo=None)
+
+    def test_polls_fetch_only_new_events(self):
+        self.tail.mark()
+        self.assertEqual(self.cf.requests, [[0]])
+        self.assertIsNone(self.tail.poll())
+        self.assertIsNone(self.tail.poll())
+        self.assertEqual(self.tail.poll(), 'UPDATE_ROLLBACK_COMPLETE')
+        # Pages stop at the last seen event instead of walking the history
+        self.assertEqual(self.cf.requests, [[0], [0, 2], [0, 2], [0]])
+        self.assertEqual([i['LogicalResourceId'] for i in self.tail.events],
+                         ['app', 'Table', 'Bucket', 'Bucket', 'Table', 'app', 'app'])
+
+    def test_first_failure_and_durations(self):
+        self.tail.mark()
+        while self.tail.poll() is None:
+            pass
+        self.assertEqual(self.tail.failure['LogicalResourceId'], 'Bucket')
+        self.assertEqual(self.tail.failure_reason(),
+                         'Bucket (AWS::S3::Bucket) UPDATE_FAILED: Access Denied')
+        self.assertEqual(self.tail.slowest(), [('Table', 4.0), ('Bucket', 3.0)])
+
+    def test_publish_reports_failing_resource(self):
+        sam = sm.SAM()
+        sam.add_resource(sm.SimpleTable(name='Table'))
+        sam.cf_resource = StubCloudFormationResource()
+        sam.cf_client = StubCloudFormation(['CREATE_COMPLETE'], [])
+        sam.cf_client.describe_stack_events = self.cf.describe_stack_events
+        sam.stack_wait = Backoff(jitter=False, sleep=lambda i: None)
+        sam.changeset_wait = Backoff(jitter=False, sleep=lambda i: None)
+        with self.assertRaises(StackFailedError) as ctx:
+            sam.publish_stack('app')
+        self.assertEqual(ctx.exception.status, 'UPDATE_ROLLBACK_COMPLETE')
+        self.assertIn('First failure: Bucket (AWS::S3::Bucket) UPDATE_FAILED: Access Denied',
+                      str(ctx.exception))
+        self.assertIsInstance(ctx.exception, DeployFailedError)
+
+    def test_stack_given_by_arn(self):
+        arn = 'arn:aws:cloudformation:us-east-1:123456789012:stack/app/1'
+        child = 'arn:aws:cloudformation:us-east-1:123456789012:stack/app-Child/2'
+        batches = [[stack_event('app', 'UPDATE_IN_PROGRESS', 10),
+                    stack_event('Child', 'UPDATE_COMPLETE', 11)],
+                   [stack_event('app', 'UPDATE_COMPLETE', 12)]]
+        for event in [i for batch in batches for i in batch]:
+            event['StackId'] = arn
+            event['PhysicalResourceId'] = child if event['LogicalResourceId'] == 'Child' else arn
+        tail = sm.StackEventTail(PagedStackEvents([], batches), arn, echo=None)
+        self.assertIsNone(tail.poll())
+        # A nested stack's events in the parent are not the parent's own
+        self.assertIsNone(tail.poll())
+        self.assertEqual(tail.status, 'UPDATE_IN_PROGRESS')
+        self.assertEqual(tail.poll(), 'UPDATE_COMPLETE')
+
+
+class ImportTimeTestCase(unittest.TestCase):
+    """
+    Render-only users should not pay for importing the AWS SDK or PyYAML
+    """
+    budget_ms = float(os.environ.get('SAMMY_IMPORT_BUDGET_MS', 200))
+
+    def run_python(self, code):
+        return subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True, check=True)
+
+    def test_import_is_lazy_and_within_budget(self):
+        process = self.run_python(
+            'import sys, sammy; print(" ".join(sorted(m for m in ("boto3", "botocore", "yaml") '
+            'if m in sys.modules)))')
+        self.assertEqual(process.stdout.strip(), '')
+        cumulative = [int(i.split('|')[1]) for i in process.stderr.splitlines()
+                      if i.rstrip().endswith('| sammy')]
+        self.assertLess(cumulative[0] / 1000.0, self.budget_ms)
+
+    def test_json_render_does_not_load_yaml(self):
+        process = self.run_python(
+            'import sys, sammy as sm; s = sm.SAM(render_type="json"); '
+            's.add_resource(sm.SimpleTable(name="Table")); s.get_template(); '
+            'print("yaml" in sys.modules, "boto3" in sys.modules)')
+        self.assertEqual(process.stdout.split(), ['False', 'False'])
+
+
+class PartitionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        resources = collections.OrderedDict()
+        for i in range(6):
+            resources['Queue{}'.format(i)] = {
+                'Type': 'AWS::SQS::Queue', 'Properties': {'QueueName': {'Ref': 'Stage'}}}
+        resources['Role'] = {'Type': 'AWS::IAM::Role', 'Properties': {
+            'Policies': [{'Fn::GetAtt': ['Queue{}'.format(i), 'Arn']} for i in range(6)]}}
+        resources['Alarm'] = {'Type': 'AWS::CloudWatch::Alarm', 'DependsOn': 'Queue0',
+                              'Properties': {'AlarmName': {'Fn::Sub': '${Role.Arn}-alarm'}}}
+        for i in range(3):
+            resources['Topic{}'.format(i)] = {'Type': 'AWS::SNS::Topic'}
+        self.template = {'AWSTemplateFormatVersion': '2010-09-09',
+                         'Parameters': {'Stage': {'Type': 'String'}},
+                         'Resources': resources,
+                         'Outputs': {'RoleArn': {'Value': {'Fn::Sub': 'arn=${Role.Arn}'}}}}
+
+    def test_children_within_limits_and_wired(self):
+        nested = partition.partition(self.template, max_resources=4)
+        owner = nested.partition_of
+        self.assertTrue(all(len(i['Resources']) <= 4 for i in nested.children.values()))
+        self.assertEqual(sorted(owner), sorted(self.template['Resources']))
+        # Growing from the role keeps two queues with it, so four queue ARNs
+        # and the role ARN for the parent output cross stacks
+        self.assertEqual(nested.cross_references, 5)
+
+        role_stack = nested.children[owner['Role']]
+        policies = role_stack['Resources']['Role']['Properties']['Policies']
+        for i, policy in enumerate(policies):
+            if owner['Queue{}'.format(i)] == owner['Role']:
+                self.assertEqual(policy, {'Fn::GetAtt': ['Queue{}'.format(i), 'Arn']})
+            else:
+                self.assertEqual(policy, {'Ref': 'Queue{}Arn'.format(i)})
+                self.assertEqual(role_stack['Parameters']['Queue{}Arn'.format(i)],
+                                 {'Type': 'String'})
+
+        parent = nested.parent_template({name: 'https://t/' + name for name in nested.names})
+        self.assertEqual(parent['Parameters'], {'Stage': {'Type': 'String'}})
+        self.assertEqual(parent['Outputs']['RoleArn']['Value'], {'Fn::Sub': [
+            'arn=${RoleArn}', {'RoleArn': {'Fn::GetAtt': [owner['Role'], 'Outputs.RoleArn']}}]})
+        alarm = nested.children[owner['Alarm']]['Resources']['Alarm']
+        if owner['Alarm'] == owner['Queue0']:
+            self.assertEqual(alarm['DependsOn'], ['Queue0'])
+        else:
+            self.assertNotIn('DependsOn', alarm)
+            self.assertIn(owner['Queue0'], parent['Resources'][owner['Alarm']]['DependsOn'])
+        levels = nested.levels()
+        self.assertEqual(sorted(sum(levels, [])), sorted(nested.names))
+        self.assertGreater(len(levels[0]), 1)
+
+    def test_implicit_api_functions_share_a_child(self):
+        resources = {}
+        for i in range(4):
+            resources['Fn{}'.format(i)] = {'Type': 'AWS::Serverless::Function', 'Properties': {
+                'Events': {'Get': {'Type': 'Api', 'Properties': {'Path': '/', 'Method': 'get'}}}}}
+        resources['Table'] = {'Type': 'AWS::Serverless::SimpleTable'}
+        template = {'Transform': 'AWS::Serverless-2016-10-31', 'Resources': resources,
+                    'Outputs': {'Url': {'Value': {'Fn::Sub': 'https://${ServerlessRestApi}'}}}}
+        nested = partition.partition(template, max_resources=4)
+        api_stack = nested.partition_of['Fn0']
+        self.assertEqual({nested.partition_of['Fn{}'.format(i)] for i in range(4)}, {api_stack})
+        self.assertEqual(nested.children[api_stack]['Transform'], 'AWS::Serverless-2016-10-31')
+        self.assertEqual(nested.children[api_stack]['Outputs'],
+                         {'ServerlessRestApi': {'Value': {'Ref': 'ServerlessRestApi'}}})
+        with self.assertRaises(ValueError):
+            partition.partition(template, max_resources=3)
+
+    def test_references_to_the_implicit_api_are_dependencies(self):
+        # Queue refers to the implicit API and Fn0 to Queue. Counting the
+        # first edge keeps the cycle in one child.
+        resources = collections.OrderedDict()
+        resources['Fn0'] = {'Type': 'AWS::Serverless::Function', 'Properties': {
+            'Environment': {'Variables': {'QUEUE': {'Ref': 'Queue'}}},
+            'Events': {'Get': {'Type': 'Api', 'Properties': {'Path': '/', 'Method': 'get'}}}}}
+        resources['Queue'] = {'Type': 'AWS::SQS::Queue', 'Properties': {
+            'QueueName': {'Fn::Sub': '${ServerlessRestApi}-queue'},
+            'Tags': [{'Key': 'topic', 'Value': {'Ref': 'Topic0'}}]}}
+        for i in range(2):
+            resources['Topic{}'.format(i)] = {'Type': 'AWS::SNS::Topic'}
+        template = {'Transform': 'AWS::Serverless-2016-10-31', 'Resources': resources}
+        nested = partition.partition(template, max_resources=2)
+        self.assertEqual(nested.partition_of['Queue'], nested.partition_of['Fn0'])
+        self.assertEqual(sorted(sum(nested.levels(), [])), sorted(nested.names))
+
+    def test_invalid_dependencies_are_reported(self):
+        resources = collections.OrderedDict(
+            ('Queue{}'.format(i), {'Type': 'AWS::SQS::Queue'}) for i in range(4))
+        resources['Queue3']['DependsOn'] = 'Nope'
+        with self.assertRaises(ValueError) as cm:
+            partition.partition({'Resources': resources}, max_resources=2)
+        self.assertIn('Queue3 depends on undeclared resource(s) Nope', str(cm.exception))
+
+        del resources['Queue3']['DependsOn']
+        nested = partition.partition({'Resources': resources}, max_resources=2)
+        nested.dependencies = {'Stack1': {'Stack2'}, 'Stack2': {'Stack1'}}
+        with self.assertRaises(ValueError):
+            nested.levels()
+
+    def test_publish_nested(self):
+        sam = sm.SAM()
+        sam.add_resources(sm.SNS(name='Topic{}'.format(i)) for i in range(5))
+        sam.s3 = StubS3()
+        sam.template_bucket = 'templates'
+        sam.cf_resource = StubCloudFormationResource()
+        sam.cf_client = StubCloudFormation(['CREATE_COMPLETE'], ['CREATE_COMPLETE'])
+        sam.changeset_wait = Backoff(jitter=False, sleep=lambda i: None)
+        sam.stack_wait = Backoff(jitter=False, sleep=lambda i: None)
+        sam.print_timings = False
+        result = sam.publish_nested('app', max_resources=2)
+        self.assertEqual(result.status, 'CREATE_COMPLETE')
+        self.assertEqual(len(sam.s3.store['puts']), 3)
+        changeset = sam.cf_client.changesets[0]
+        self.assertIn('CAPABILITY_AUTO_EXPAND', changeset['Capabilities'])
+        parent = json.loads(changeset['TemplateBody'])
+        self.assertEqual(sorted(parent['Resources']), ['Stack1', 'Stack2', 'Stack3'])
+        self.assertTrue(parent['Resources']['Stack1']['Properties']['TemplateURL'].endswith('.json'))
+
+
+class RenderCommandTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.targets = ['sammy.examples.hello_world', 'sammy.examples.alexa_skill:sam']
+
+    def render(self, targets=None, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            code = cli.main(['render'] + (targets or self.targets) +
+                            ['-o', self.output_dir, '-f', 'yaml', '-j', '2'] + kwargs.get('args', []))
+        manifest = cli.read_manifest(os.path.join(self.output_dir, cli.MANIFEST))
+        return code, manifest
+
+    def test_renders_in_workers_and_skips_unchanged(self):
+        code, manifest = self.render()
+        self.assertEqual(code, 0)
+        path = os.path.join(self.output_dir, 'sammy.examples.hello_world.yaml')
+        with open(path) as f:
+            self.assertEqual(f.read(), hw.to_yaml())
+
+        results = cli.render(self.targets, self.output_dir, 'yaml')
+        self.assertEqual([i[1]['status'] for i in results], [cli.UNCHANGED] * 2)
+
+        with open(path, 'a') as f:
+            f.write('# edited\n')
+        results = cli.render(self.targets, self.output_dir, 'yaml', jobs=1)
+        self.assertEqual([i[1]['status'] for i in results], [cli.RENDERED, cli.UNCHANGED])
+        self.assertIn('import', results[0][1])
+
+    def test_failed_target_sets_exit_code(self):
+        code, manifest = self.render(self.targets + ['sammy.examples.hello_world:missing'])
+        self.assertEqual(code, 1)
+        self.assertNotIn('sammy.examples.hello_world:missing', manifest)
+        self.assertEqual(len(manifest), 2)
+        code, manifest = self.render(['missing_module:sam', 'missing/*.py'])
+        self.assertEqual(code, 1)
+        self.assertEqual(len(manifest), 2)
+
+    def test_module_in_working_directory(self):
+        source_dir = tempfile.mkdtemp()
+        helper = os.path.join(source_dir, 'local_names.py')
+        with open(helper, 'w') as f:
+            f.write('TOPIC = "Topic"\n')
+        with open(os.path.join(source_dir, 'local_template.py'), 'w') as f:
+            f.write('import sammy as sm\nfrom local_names import TOPIC\n\nstack = sm.SAM()\n'
+                    'stack.add_resource(sm.SNS(name=TOPIC))\n')
+        cwd, path, version = os.getcwd(), list(sys.path), cli.__version__
+
+        def status():
+            return cli.render(['local_template:stack'], self.output_dir, 'yaml')[0][1]['status']
+
+        os.chdir(source_dir)
+        try:
+            code, manifest = self.render(['local_template:stack'])
+            statuses = [status()]
+            # Changing an imported module renders the target again
+            with open(helper, 'w') as f:
+                f.write('TOPIC = "Renamed"\n')
+            statuses.append(status())
+            # So does another sammy version
+            cli.__version__ = '0.0.0'
+            statuses.append(status())
+        finally:
+            os.chdir(cwd)
+            sys.path[:] = path
+            cli.__version__ = version
+        self.assertEqual(code, 0)
+        self.assertEqual(list(manifest['local_template:stack']['dependencies']), [helper])
+        self.assertEqual(statuses, [cli.UNCHANGED, cli.RENDERED, cli.RENDERED])
+        with open(manifest['local_template:stack']['output']) as f:
+            self.assertIn('AWS::SNS::Topic', f.read())
+
+
+class StubMultipartPart(object):
+
+    def __init__(self, multipart, number):
+        self.multipart = multipart
+        self.number = number
+
+    def upload(self, Body):
+        self.multipart.parts[self.number] = Body
+        return {'ETag': 'etag-{}'.format(self.number)}
+
+
+class StubMultipartUpload(object):
+
+    def __init__(self):
+        self.parts = {}
+        self.completed = None
+        self.aborted = False
+
+    def Part(self, number):
+        return StubMultipartPart(self, number)
+
+    def complete(self, MultipartUpload):
+        self.completed = MultipartUpload['Parts']
+
+    def abort(self):
+        self.aborted = True
+
+
+class StubStreamedObject(StubS3Object):
+
+    def initiate_multipart_upload(self):
+        self.multipart = StubMultipartUpload()
+        return self.multipart
+
+
+class StubStreamedS3(StubS3):
+
+    def Object(self, bucket, key):
+        return StubStreamedObject(self.store, bucket, key)
+
+
+class StreamingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sam = sm.SAM()
+        self.sam.add_parameter(sm.Parameter(name='Stage', Type='String'))
+        self.sam.add_resources(sm.SQS(name='Queue{}'.format(i), QueueName='queue-{}'.format(i),
+                                      VisibilityTimeout=i) for i in range(20))
+
+    def test_stream_matches_rendered_template(self):
+        for render_type in ('json', 'yaml', 'json-compact'):
+            for minify in (False, True):
+                out = io.StringIO()
+                written = self.sam.write_template(out, render_type, minify)
+                expected = self.sam.get_template(render_type, minify)
+                self.assertEqual(out.getvalue(), expected)
+                self.assertEqual(written, len(expected.encode('utf-8')))
+        fragments = list(self.sam.iter_template('yaml'))
+        self.assertGreater(len(fragments), 20)
+
+    def test_resources_are_rendered_one_at_a_time(self):
+        rendered = []
+
+        class CountingQueue(sm.SQS):
+            def to_dict(self):
+                rendered.append(self._data['name'])
+                return super(CountingQueue, self).to_dict()
+
+        sam = sm.SAM(render_type='json')
+        sam.add_resources(CountingQueue(name='Queue{}'.format(i)) for i in range(3))
+        writes = []
+
+        class Recorder(io.StringIO):
+            def write(self, data):
+                writes.append((data, list(rendered)))
+                return super(Recorder, self).write(data)
+
+        sam.write_template(Recorder())
+        seen = [done for data, done in writes if data.startswith('"Queue')]
+        self.assertEqual(seen, [['Queue0'], ['Queue0', 'Queue1'], ['Queue0', 'Queue1', 'Queue2']])
+        self.assertTrue(all(i._render_cache is None for i in sam.resources))
+
+        sam.hoist_globals = True
+        del rendered[:]
+        out = io.StringIO()
+        sam.write_template(out)
+        self.assertEqual(out.getvalue(), sam.get_template())
+
+    def test_binary_file(self):
+        out = io.BytesIO()
+        self.sam.write_template(out, 'json')
+        self.assertEqual(out.getvalue().decode('utf-8'), self.sam.get_template('json'))
+
+    def test_multipart_upload(self):
+        obj = StubStreamedObject({}, 'bucket', 'template.json')
+        with streaming.S3StreamWriter(obj, part_size=1000) as writer:
+            self.sam.write_template(writer, 'json')
+        upload = obj.multipart
+        body = b''.join(upload.parts[i] for i in sorted(upload.parts))
+        self.assertEqual(body.decode('utf-8'), self.sam.get_template('json'))
+        self.assertEqual([i['PartNumber'] for i in upload.completed],
+                         list(range(1, len(upload.parts) + 1)))
+        self.assertTrue(all(len(upload.parts[i]) >= 1000 for i in range(1, len(upload.parts))))
+
+    def test_small_template_is_put_and_failures_abort(self):
+        self.sam.s3 = StubStreamedS3()
+        self.sam.publish_template('bucket', 'app')
+        self.assertEqual(self.sam.s3.store[('bucket', 'app.yaml')].decode('utf-8'),
+                         self.sam.get_template())
+
+        obj = StubStreamedObject({}, 'bucket', 'template.json')
+        with self.assertRaises(RuntimeError):
+            with streaming.S3StreamWriter(obj, part_size=10) as writer:
+                writer.write('x' * 20)
+                raise RuntimeError('render failed')
+        self.assertTrue(obj.multipart.aborted)
+        self.assertIsNone(obj.multipart.completed)
+
+
+class PackagingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.code = os.path.join(self.tmp.name, 'code')
+        os.makedirs(os.path.join(self.code, 'lib', '__pycache__'))
+        for name, body in (('index.py', 'import lib'), ('lib/__init__.py', ''),
+                           ('lib/__pycache__/x.pyc', 'cached')):
+            with open(os.path.join(self.code, name), 'w') as f:
+                f.write(body)
+        self.handler = os.path.join(self.tmp.name, 'handler.py')
+        with open(self.handler, 'w') as f:
+            f.write('def handler(event, context): pass')
+        self.s3 = StubS3()
+
+    def build_sam(self):
+        sam = sm.SAM(render_type='json')
+        sam.add_resources([
+            sm.Function(name='GetFunction', Handler='index.get', Runtime='python3.6',
+                        CodeUri=self.code),
+            sm.Function(name='PutFunction', Handler='index.put', Runtime='python3.6',
+                        CodeUri=self.code),
+            sm.CFunction(name='Handler', Handler='handler.handler', Runtime='python3.6',
+                         Code=self.handler),
+            sm.Function(name='Deployed', Handler='index.get', Runtime='python3.6',
+                        CodeUri='s3://bucket/code.zip'),
+        ])
+        sam.s3 = self.s3
+        sam.code_bucket = 'code'
+        sam.code_prefix = 'lambda/'
+        return sam
+
+    def test_archives_are_deterministic(self):
+        first = packaging.build_archive(self.code, self.tmp.name)
+        os.utime(os.path.join(self.code, 'index.py'), (0, 0))
+        second = packaging.build_archive(self.code, self.tmp.name)
+        self.assertEqual(first.digest, second.digest)
+        with zipfile.ZipFile(first.path) as archive:
+            self.assertEqual(archive.namelist(), ['index.py', 'lib/__init__.py'])
+            self.assertEqual(archive.getinfo('index.py').date_time, packaging.ZIP_DATE_TIME)
+
+    def test_package_uploads_missing_archives(self):
+        sam = self.build_sam()
+        packaged = sam.package()
+        self.assertEqual([len(i.resources) for i in packaged], [2, 1])
+        self.assertEqual(len(self.s3.store['uploads']), 2)
+        resources = json.loads(sam.get_template())['Resources']
+        code_uri = resources['GetFunction']['Properties']['CodeUri']
+        self.assertEqual(code_uri, resources['PutFunction']['Properties']['CodeUri'])
+        self.assertEqual(code_uri['Bucket'], 'code')
+        self.assertTrue(code_uri['Key'].startswith('lambda/'))
+        self.assertEqual(resources['Handler']['Properties']['Code'],
+                         {'S3Bucket': 'code', 'S3Key': packaged[1].key})
+        self.assertEqual(resources['Deployed']['Properties']['CodeUri'], 's3://bucket/code.zip')
+        self.assertEqual(sam.package(), [])
+
+        again = self.build_sam().package(jobs=1)
+        self.assertEqual([i.key for i in again], [i.key for i in packaged])
+        self.assertFalse(any(i.uploaded for i in again))
+        self.assertEqual(len(self.s3.store['uploads']), 2)
+
+    def test_archives_keep_their_extension(self):
+        jar = os.path.join(self.tmp.name, 'Handler.JAR')
+        with zipfile.ZipFile(jar, 'w') as archive:
+            archive.writestr('Handler.class', 'bytecode')
+        sam = self.build_sam()
+        sam.add_resource(sm.Function(name='JavaFunction', Handler='Handler::handle',
+                                     Runtime='java11', CodeUri=jar))
+        keys = [i.key for i in sam.package()]
+        self.assertEqual([os.path.splitext(i)[1] for i in keys], ['.zip', '.zip', '.jar'])
+        self.assertEqual(self.s3.store[('code', keys[2])], pl.Path(jar).read_bytes())
+
+    def test_publish_packages_first(self):
+        sam = self.build_sam()
+        sam.cf_resource = StubCloudFormationResource()
+        sam.cf_client = StubCloudFormation(['CREATE_COMPLETE'], ['CREATE_COMPLETE'])
+        sam.stack_wait = Backoff(jitter=False, sleep=lambda i: None)
+        sam.code_bucket = None
+        with self.assertRaises(DeployFailedError):
+            sam.publish_stack('stack')
+        sam.template_bucket = 'templates'
+        result = sam.publish_stack('stack')
+        self.assertIn('package', result.timings)
+        template = json.loads(sam.cf_client.changesets[0]['TemplateBody'])
+        self.assertEqual(template['Resources']['GetFunction']['Properties']['CodeUri']['Bucket'],
+                         'templates')
+
+
+class FakeAWSTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.aws = FakeAWS()
+        self.sam = self.build_cft(sm.SNS(name='Topic'))
+        self.sam.add_output(sm.Output(name='TopicArn', Value=sm.Ref('Topic'),
+                                      Export={'Name': 'topic-arn'}))
+
+    def build_cft(self, *resources):
+        cft = sm.CFT(render_type='json')
+        cft.add_resources(resources)
+        cft.build_clients_resources(session=self.aws)
+        return cft
+
+    def test_publish_update_and_no_changes(self):
+        result = self.sam.publish_stack('network')
+        self.assertEqual(result.status, 'CREATE_COMPLETE')
+        self.assertEqual(result.stack.outputs[0]['ExportName'], 'topic-arn')
+        result = self.sam.publish_stack('network')
+        self.assertTrue(result.no_changes)
+        self.sam.add_resource(sm.SQS(name='Queue'))
+        self.assertEqual([i.logical_id for i in self.sam.diff('network').added], ['Queue'])
+        result = self.sam.publish_stack('network')
+        self.assertEqual(result.status, 'UPDATE_COMPLETE')
+        self.assertEqual(set(result.resource_durations), {'Queue'})
+
+    def test_injected_failures(self):
+        self.aws.fail_resource('Topic', 'Topic limit exceeded')
+        with self.assertRaises(StackFailedError) as cm:
+            self.sam.publish_stack('network')
+        self.assertEqual(cm.exception.status, 'ROLLBACK_COMPLETE')
+        self.assertEqual(cm.exception.failure['ResourceStatusReason'], 'Topic limit exceeded')
+        self.aws.fail_call('describe_stacks', 'Throttling')
+        with self.assertRaises(botocore.exceptions.ClientError):
+            self.sam.has_stack('network')
+        self.assertTrue(self.sam.has_stack('network'))
+
+    def test_exports_and_imports(self):
+        app = self.build_cft(sm.Role(name='Role', AssumeRolePolicyDocument={
+            'Fn::ImportValue': 'topic-arn'}))
+        result = app.publish_stack('app')
+        self.assertEqual(result.status, 'FAILED')
+        self.assertIn('No export named topic-arn', result.status_reason)
+        self.sam.publish_stack('network')
+        app.unpublish('app')
+        self.assertEqual(app.publish_stack('app').status, 'CREATE_COMPLETE')
+        self.sam.unpublish('network')
+        self.assertEqual(self.sam.get_stack_status('network'), 'DELETE_FAILED')
+        app.unpublish('app')
+        self.sam.unpublish('network')
+        self.assertFalse(self.sam.has_stack('network'))
+
+    def test_simulated_time(self):
+        clock = [0]
+        aws = FakeAWS(changeset_seconds=3, resource_seconds=10, clock=lambda: clock[0])
+        self.sam.build_clients_resources(session=aws)
+        sleep = lambda i: clock.__setitem__(0, clock[0] + i)
+        self.sam.changeset_wait = Backoff(min_delay=1, max_delay=4, jitter=False, sleep=sleep)
+        self.sam.stack_wait = Backoff(min_delay=2, max_delay=4, jitter=False, sleep=sleep)
+        result = self.sam.publish_stack('network')
+        self.assertEqual(result.polls, {'changeset': 3, 'execute': 4})
+        self.assertEqual(result.resource_durations, {'Topic': 10})
+
+    def test_stack_sets_and_uploads(self):
+        self.sam.template_bucket = 'templates'
+        self.sam.upload_all_templates = True
+        self.aws.fail_region('eu-west-1', 'Bucket already exists')
+        self.sam.stackset_wait = Backoff(jitter=False, sleep=lambda i: None)
+        with self.assertRaises(DeployFailedError) as cm:
+            self.sam.publish_global('global', ['us-east-1', 'eu-west-1'])
+        self.assertIn('eu-west-1: Bucket already exists', str(cm.exception))
+        self.assertEqual(len(self.aws.objects), 1)
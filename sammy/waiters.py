@@ -0,0 +1,64 @@
+import collections
+import random
+import time
+
+from sammy.exceptions import WaitTimeoutError
+
+
+WaitResult = collections.namedtuple("WaitResult", ["value", "polls", "elapsed"])
+
+
+class Backoff(object):
+    """
+    Exponential backoff with jitter for polling AWS operations. The check is
+    always made before sleeping, so an operation that has already finished
+    costs a single call and no sleep.
+    """
+
+    def __init__(self, min_delay=1, max_delay=30, factor=2, jitter=True,
+                 timeout=3600, sleep=time.sleep, clock=time.monotonic):
+        """
+        :param min_delay: Seconds to wait after the first unfinished check
+        :param max_delay: Upper bound for a single wait in seconds
+        :param factor: Multiplier applied to the delay after each check
+        :param jitter: Randomize each delay between half and all of its value
+        :param timeout: Seconds after which WaitTimeoutError is raised. None waits forever.
+        :param sleep: Function used to sleep, replaceable in tests
+        :param clock: Monotonic clock function, replaceable in tests
+        """
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.jitter = jitter
+        self.timeout = timeout
+        self.sleep = sleep
+        self.clock = clock
+
+    def delays(self):
+        delay = self.min_delay
+        while True:
+            if self.jitter:
+                yield max(self.min_delay, random.uniform(delay / 2.0, delay))
+            else:
+                yield delay
+            delay = min(delay * self.factor, self.max_delay)
+
+    def wait(self, check, description='operation'):
+        """
+        Calls check until it returns something other than None
+        :param check: Callable polled for a result
+        :param description: Used in the timeout error message
+        :return: WaitResult with the value returned by check, the number of polls and the elapsed seconds
+        """
+        start = self.clock()
+        polls = 0
+        for delay in self.delays():
+            polls += 1
+            value = check()
+            elapsed = self.clock() - start
+            if value is not None:
+                return WaitResult(value, polls, elapsed)
+            if self.timeout is not None and elapsed + delay > self.timeout:
+                raise WaitTimeoutError(
+                    'Timed out after {:.0f} seconds waiting for {}'.format(elapsed, description))
+            self.sleep(delay)
@@ -27,5 +27,8 @@ setup(
     license='GNU General Public License v3.0',
     install_requires=[str(ir.req) for ir in install_reqs],
     include_package_data=True,
+    entry_points={
+        'console_scripts': ['sammy = sammy.cli:main'],
+    },
     zip_safe=False,
 )